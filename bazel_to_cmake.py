@@ -2,7 +2,8 @@
 Bazel to CMake Converter
 
 Converts Bazel BUILD.bazel files to CMakeLists.txt with modern CMake syntax.
-Uses Python evaluation of BUILD files since they are valid Python syntax.
+BUILD files are parsed with Python's ast module (Starlark is a Python subset)
+and evaluated by a restricted interpreter rather than exec().
 
 Requirements:
 - Python 3.9+
@@ -11,136 +12,1582 @@ Requirements:
 Usage:
     python3 bazel_to_cmake.py [options]
 
+    or, in process:
+
+    from bazel_to_cmake import convert
+    result = convert(Path("BUILD.bazel"), project_name="my_project")
+    result.targets, result.cmake_text
+
 Examples:
     python3 bazel_to_cmake.py
     python3 bazel_to_cmake.py --build-file my_module/BUILD.bazel --project-name my_project
     python3 bazel_to_cmake.py --output my_cmake/CMakeLists.txt
+    python3 bazel_to_cmake.py --workspace-root . --project-name my_project
+    python3 bazel_to_cmake.py --build-file a/BUILD --output a/CMakeLists.txt \\
+                              --build-file b/BUILD --output b/CMakeLists.txt
+    python3 bazel_to_cmake.py --manifest build_files.txt
+    python3 bazel_to_cmake.py --workspace-root . --watch
+    python3 bazel_to_cmake.py --workspace-root . --compile-commands compile_commands.json
+    python3 bazel_to_cmake.py --workspace-root . --generator ninja && ninja test
+    python3 bazel_to_cmake.py serve --socket /tmp/bazel_to_cmake.sock --workspace-root .
 
 Features:
 - Header-only libraries as INTERFACE targets
 - FetchContent for external dependencies
-- Install rules and CTest integration
-- Modern CMake generator expressions
+- Install rules and CTest integration, with Bazel's test timeouts, tags,
+  flaky retries and sharding
+- Modern CMake generator expressions, including select() and config_setting
+- Optional precompiled headers, shared with REUSE_FROM between targets
+- Optional unity builds, batched or grouped by source size
+- Optional ccache/sccache compiler launcher and mold/lld linker
+- Optional Ninja job pools for linking and for heavy targets
+- Optional per-case GoogleTest registration with gtest_discover_tests
+- glob() and load() of .bzl macros, each .bzl file evaluated once per run
+- Workspace mode: one CMakeLists.txt per package, wired with add_subdirectory
+- compile_commands.json straight from the parsed targets and .bazelrc
+- A Ninja backend that writes build.ninja directly, without CMake
+- Serve mode: a daemon that keeps the workspace in memory and re-converts
+  single packages on request over a Unix socket
 """
 
 import argparse
+import ast
+import collections
+import contextlib
+import cProfile
+import ctypes
+import functools
+import hashlib
+import heapq
+import json
+import multiprocessing
+import operator
+import os
+import posixpath
+import re
+import select
+import shlex
+import socket
+import socketserver
+import string
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+# File names that mark a directory as a Bazel package, in order of preference
+BUILD_FILE_NAMES = ("BUILD.bazel", "BUILD")
+# File names that mark a directory as the root of a Bazel workspace
+WORKSPACE_FILE_NAMES = ("MODULE.bazel", "REPO.bazel", "WORKSPACE.bazel", "WORKSPACE")
+
+
+def _intern(value):
+    """Intern strings so labels repeated across targets are stored once"""
+    return sys.intern(value) if type(value) is str else value
+
+
+class Select:
+    """A select() inside a list attribute, kept unexpanded.
+
+    Maps condition labels to the values used when the condition holds.
+    It sits in the attribute's tuple next to plain values, so the
+    generator can emit one generator expression per branch instead of
+    expanding every configuration.
+    """
+
+    __slots__ = ("branches",)
+
+    DEFAULT = "//conditions:default"
+
+    def __init__(self, branches: dict):
+        self.branches: dict[str, tuple[str, ...]] = {
+            _intern(condition): tuple(_intern(v) for v in (values if isinstance(values, (list, tuple)) else [values]))
+            for condition, values in branches.items()
+        }
+
+    # `srcs = ["a.cc"] + select({...})` keeps both parts, as a list
+    def __add__(self, other):
+        return [self] + (other if isinstance(other, list) else [other])
+
+    def __radd__(self, other):
+        return (other if isinstance(other, list) else [other]) + [self]
+
+    def __eq__(self, other):
+        return isinstance(other, Select) and self.branches == other.branches
+
+    def __hash__(self):
+        return hash(tuple(self.branches))
+
+    def __repr__(self):
+        return f"select({self.branches!r})"
+
+    def to_dict(self) -> dict:
+        """Serialize to a JSON-compatible dict"""
+        return {"select": {condition: list(values) for condition, values in self.branches.items()}}
+
+
+def flatten(values: Iterable) -> list[str]:
+    """Plain values of an attribute, including those of every select() branch"""
+    flat = []
+    for value in values:
+        if isinstance(value, Select):
+            for branch in value.branches.values():
+                flat.extend(branch)
+        else:
+            flat.append(value)
+    return flat
 
 
 class BazelTarget:
-    """Bazel target (cc_library, cc_test, etc.)"""
-
-    def __init__(self, rule_type: str, name: str):
-        self.rule_type = rule_type
-        self.name = name
-        self.hdrs: list[str] = []
-        self.srcs: list[str] = []
-        self.deps: list[str] = []
-        self.visibility: list[str] = []
-        self.data: list[str] = []
-
-    def add_attribute(self, attr_name: str, values: list[str]):
-        """Add attribute values"""
-        if attr_name == "hdrs":
-            self.hdrs.extend(values)
-        elif attr_name == "srcs":
-            self.srcs.extend(values)
-        elif attr_name == "deps":
-            self.deps.extend(values)
-        elif attr_name == "visibility":
-            self.visibility.extend(values)
-        elif attr_name == "data":
-            self.data.extend(values)
+    """Bazel target (cc_library, cc_test, etc.)
+
+    Targets are slotted and hold interned strings in tuples, since a large
+    workspace keeps millions of them alive at once.
+    """
+
+    # Attributes holding lists of labels, file names or compiler flags (or,
+    # for a config_setting, constraint labels and "key=value" settings)
+    LIST_ATTRIBUTES = ("hdrs", "srcs", "deps", "visibility", "data", "copts", "defines", "local_defines",
+                       "includes", "tags", "constraint_values", "values")
+
+    # Single-valued test attributes; None when not given
+    SCALAR_ATTRIBUTES = ("size", "timeout", "flaky", "shard_count")
+
+    __slots__ = ("rule_type", "name", "package") + LIST_ATTRIBUTES + SCALAR_ATTRIBUTES
+
+    def __init__(self, rule_type: str, name: str, package: str = ""):
+        self.rule_type = _intern(rule_type)
+        self.name = _intern(name)
+        self.package = _intern(package)
+        self.hdrs: tuple[str, ...] = ()
+        self.srcs: tuple[str, ...] = ()
+        self.deps: tuple[str, ...] = ()
+        self.visibility: tuple[str, ...] = ()
+        self.data: tuple[str, ...] = ()
+        self.copts: tuple[str, ...] = ()
+        self.defines: tuple[str, ...] = ()
+        self.local_defines: tuple[str, ...] = ()
+        self.includes: tuple[str, ...] = ()
+        self.tags: tuple[str, ...] = ()
+        self.constraint_values: tuple[str, ...] = ()
+        self.values: tuple[str, ...] = ()
+        self.size: Optional[str] = None
+        self.timeout: Optional[str] = None
+        self.flaky: Optional[bool] = None
+        self.shard_count: Optional[int] = None
+
+    def add_attribute(self, attr_name: str, values: list[Union[str, Select]]):
+        """Add attribute values; select()s are kept as Select items"""
+        if attr_name in self.LIST_ATTRIBUTES:
+            setattr(self, attr_name, getattr(self, attr_name) + tuple(_intern(v) for v in values))
+
+    @property
+    def label(self) -> str:
+        """Canonical label, //package:name"""
+        return f"//{self.package}:{self.name}"
+
+    @property
+    def cmake_name(self) -> str:
+        """Name of the CMake target"""
+        return cmake_target_name(self.package, self.name)
+
+    def to_dict(self) -> dict:
+        """Serialize to a JSON-compatible dict"""
+        data = {"rule_type": self.rule_type, "name": self.name, "package": self.package}
+        for attr_name in self.LIST_ATTRIBUTES:
+            data[attr_name] = [v.to_dict() if isinstance(v, Select) else v for v in getattr(self, attr_name)]
+        for attr_name in self.SCALAR_ATTRIBUTES:
+            if getattr(self, attr_name) is not None:
+                data[attr_name] = getattr(self, attr_name)
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "BazelTarget":
+        """Deserialize from to_dict() output"""
+        target = cls(data["rule_type"], data["name"], data["package"])
+        for attr_name in cls.LIST_ATTRIBUTES:
+            target.add_attribute(attr_name, [Select(v["select"]) if isinstance(v, dict) else v
+                                             for v in data[attr_name]])
+        for attr_name in cls.SCALAR_ATTRIBUTES:
+            setattr(target, attr_name, data.get(attr_name))
+        return target
+
+    def conditions(self) -> list[str]:
+        """Condition labels of every select() in this target's attributes"""
+        return [condition for attr_name in self.LIST_ATTRIBUTES for value in getattr(self, attr_name)
+                if isinstance(value, Select) for condition in value.branches]
+
+
+class StarlarkError(Exception):
+    """Error raised while evaluating a BUILD file"""
+
+
+class ConversionError(Exception):
+    """Parsed targets that would produce a broken CMake project"""
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_cached(content: str) -> ast.Module:
+    return ast.parse(content)
+
+
+def _parse_starlark(content: str, filename: str) -> ast.Module:
+    """Parse BUILD file content, caching the syntax tree per content.
+
+    Identical files in different packages share one tree; syntax errors
+    are reported against `filename`.
+    """
+    try:
+        return _parse_cached(content)
+    except SyntaxError as e:
+        e.filename = filename
+        raise
+    except (RecursionError, MemoryError):
+        raise StarlarkError(f"{filename}: file is nested too deeply to parse") from None
+
+
+class _Struct:
+    """Starlark struct(): named, read-only fields (also the `native` module of .bzl files)"""
+
+    __slots__ = ("fields",)
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __eq__(self, other):
+        return isinstance(other, _Struct) and self.fields == other.fields
+
+    def __repr__(self):
+        return "struct(" + ", ".join(f"{name} = {value!r}" for name, value in self.fields.items()) + ")"
+
+
+class _Return(Exception):
+    """Unwinds a function body on `return`"""
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _Break(Exception):
+    """Unwinds a loop body on `break`"""
+
+
+class _Continue(Exception):
+    """Unwinds a loop body on `continue`"""
+
+
+# printf-style conversions of `str % value`, with any flags, width or precision
+_PERCENT_FIELD_RE = re.compile(r"%(?:\([^)]*\))?([-#0 +*.\d]*)[A-Za-z%]")
+
+# Functions currently executing, to reject recursion as Starlark does
+_call_stack: list["_StarlarkFunction"] = []
+
+# Evaluators currently executing; a function call charges its steps to the innermost
+_active_evaluators: list["_StarlarkEvaluator"] = []
+
+
+class _StarlarkFunction:
+    """A `def` from a BUILD or .bzl file, callable from any later evaluation.
+
+    Each call runs on a fresh evaluator that shares the step budget and
+    deadline of the calling file, and errors are reported against the
+    file the function was defined in.
+    """
+
+    __slots__ = ("name", "filename", "node", "globals", "defaults")
+
+    def __init__(self, filename: str, node: ast.FunctionDef, scope, defaults: dict):
+        self.name = node.name
+        self.filename = filename
+        self.node = node
+        self.globals = scope
+        self.defaults = defaults
+
+    def __repr__(self):
+        return f"<function {self.name}>"
+
+    def _bind(self, args: tuple, kwargs: dict) -> dict:
+        spec = self.node.args
+        names = [arg.arg for arg in spec.posonlyargs + spec.args]
+        keyword_only = [arg.arg for arg in spec.kwonlyargs]
+        if len(args) > len(names) and spec.vararg is None:
+            raise TypeError(f"{self.name}() takes {len(names)} positional arguments but {len(args)} were given")
+        local = dict(zip(names, args))
+        if spec.vararg is not None:
+            local[spec.vararg.arg] = tuple(args[len(names):])
+        extra = {}
+        for name, value in kwargs.items():
+            if name in local:
+                raise TypeError(f"{self.name}() got multiple values for argument '{name}'")
+            if name in names or name in keyword_only:
+                local[name] = value
+            elif spec.kwarg is not None:
+                extra[name] = value
+            else:
+                raise TypeError(f"{self.name}() got an unexpected keyword argument '{name}'")
+        if spec.kwarg is not None:
+            local[spec.kwarg.arg] = extra
+        for name, value in self.defaults.items():
+            local.setdefault(name, value)
+        for name in names + keyword_only:
+            if name not in local:
+                raise TypeError(f"{self.name}() missing argument '{name}'")
+        return local
+
+    def __call__(self, *args, **kwargs):
+        if self in _call_stack:
+            raise ValueError(f"function {self.name} called recursively")
+        scope = collections.ChainMap(self._bind(args, kwargs), self.globals)
+        _call_stack.append(self)
+        try:
+            return _StarlarkEvaluator(self.filename).call(self.node.body, scope)
+        finally:
+            _call_stack.pop()
+
+
+class _StarlarkEvaluator:
+    """Evaluates the Starlark subset used by BUILD and .bzl files from its Python AST.
+
+    Calls, literals, names, operators, subscripts, comprehensions, `def`,
+    `if` and `for` are interpreted; everything else (imports, lambdas,
+    while loops, attribute access outside a small method whitelist, ...)
+    is rejected. Evaluation is bounded by a step budget, a wall-clock
+    deadline, a cap on the size of any list or string it builds and a
+    cap on the magnitude of integers.
+    """
+
+    max_steps = 5_000_000
+    max_seconds = 30.0
+    max_value_size = 1_000_000
+    max_int_bits = 4096
+
+    _METHODS = {
+        str: {"count", "endswith", "find", "format", "join", "lower", "lstrip", "partition",
+              "removeprefix", "removesuffix", "replace", "rfind", "rpartition", "rsplit",
+              "rstrip", "split", "startswith", "strip", "upper"},
+        list: {"append", "count", "extend", "index", "insert", "pop", "remove"},
+        dict: {"get", "items", "keys", "pop", "setdefault", "update", "values"},
+    }
+
+    _VIEW_TYPES = (type({}.keys()), type({}.values()), type({}.items()))
+
+    _BINARY_OPS = {
+        ast.Add: operator.add,
+        ast.Sub: operator.sub,
+        ast.Mult: operator.mul,
+        ast.FloorDiv: operator.floordiv,
+        ast.Mod: operator.mod,
+        ast.BitOr: operator.or_,
+    }
+
+    _COMPARE_OPS = {
+        ast.Eq: operator.eq,
+        ast.NotEq: operator.ne,
+        ast.Lt: operator.lt,
+        ast.LtE: operator.le,
+        ast.Gt: operator.gt,
+        ast.GtE: operator.ge,
+        ast.In: lambda a, b: a in b,
+        ast.NotIn: lambda a, b: a not in b,
+    }
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._steps = 0
+        self._deadline = 0.0
+        self._lineno = 0
+        self._expr_handlers = {
+            ast.Constant: self._eval_constant,
+            ast.Name: self._eval_name,
+            ast.List: self._eval_list,
+            ast.Tuple: self._eval_tuple,
+            ast.Dict: self._eval_dict,
+            ast.BinOp: self._eval_binop,
+            ast.BoolOp: self._eval_boolop,
+            ast.UnaryOp: self._eval_unaryop,
+            ast.Compare: self._eval_compare,
+            ast.IfExp: self._eval_ifexp,
+            ast.Call: self._eval_call,
+            ast.Attribute: self._eval_attribute,
+            ast.Subscript: self._eval_subscript,
+            ast.ListComp: self._eval_listcomp,
+            ast.DictComp: self._eval_dictcomp,
+        }
+
+    def builtins(self) -> dict:
+        """Starlark builtins available to every BUILD file"""
+        return {
+            "True": True,
+            "False": False,
+            "None": None,
+            "all": all,
+            "any": any,
+            "bool": bool,
+            "dict": dict,
+            "enumerate": lambda seq, start=0: list(enumerate(seq, start)),
+            "fail": self._fail,
+            "int": self._int,
+            "len": len,
+            "list": list,
+            "max": max,
+            "min": min,
+            "print": lambda *args, **kwargs: None,
+            "range": self._range,
+            "reversed": lambda seq: list(reversed(seq)),
+            "select": self._select,
+            "sorted": sorted,
+            "str": self._str,
+            "struct": _Struct,
+            "tuple": tuple,
+            "type": lambda value: type(value).__name__,
+            "zip": lambda *seqs: list(zip(*seqs)),
+        }
+
+    def run(self, module: ast.Module, env: dict):
+        """Execute the module's statements in `env`"""
+        self._steps = 0
+        self._deadline = time.monotonic() + self.max_seconds
+        _active_evaluators.append(self)
+        try:
+            self._exec_block(module.body, env)
+        except _Return:
+            raise self._error("return outside function") from None
+        except (_Break, _Continue):
+            raise self._error("break or continue outside loop") from None
+        except RecursionError:
+            raise self._error("expressions or calls nested too deeply") from None
+        except MemoryError:
+            raise self._error("evaluation ran out of memory") from None
+        finally:
+            _active_evaluators.pop()
+
+    def call(self, body: list[ast.stmt], scope):
+        """Execute a function body in `scope` and return its result.
+
+        Steps are charged to the evaluator running the caller, if any, so
+        a file's budget holds across the functions it calls.
+        """
+        caller = _active_evaluators[-1] if _active_evaluators else None
+        if caller is None:
+            self._steps = 0
+            self._deadline = time.monotonic() + self.max_seconds
+        else:
+            self._steps = caller._steps
+            self._deadline = caller._deadline
+        _active_evaluators.append(self)
+        try:
+            self._exec_block(body, scope)
+        except _Return as result:
+            return result.value
+        except (_Break, _Continue):
+            raise self._error("break or continue outside loop") from None
+        finally:
+            _active_evaluators.pop()
+            if caller is not None:
+                caller._steps = self._steps
+        return None
+
+    def _error(self, message: str) -> StarlarkError:
+        return StarlarkError(f"{self.filename}:{self._lineno}: {message}")
+
+    def _fail(self, *args):
+        raise self._error("fail: " + " ".join(str(arg) for arg in args))
+
+    def _select(self, conditions: dict, no_match_error: str = "") -> Select:
+        if not isinstance(conditions, dict) or not conditions:
+            raise TypeError("select() expects a non-empty dict of conditions")
+        return Select(conditions)
+
+    def _range(self, *args) -> list[int]:
+        values = range(*args)
+        self._check_size(values)
+        return list(values)
+
+    def _int(self, *args) -> int:
+        # int() of a long digit string takes quadratic time before the result can be checked
+        if args and isinstance(args[0], str) and len(args[0]) > self.max_int_bits:
+            raise self._error(f"integer exceeds {self.max_int_bits} bits")
+        result = int(*args)
+        self._check_size(result)
+        return result
+
+    def _str(self, *args) -> str:
+        if args:
+            self._check_str_size(self._str_size(args[0]))
+        return str(*args)
+
+    def _format(self, template: str, *args, **kwargs) -> str:
+        # Starlark's str.format() has no format specs; a width or precision
+        # would allocate the padded string before its size is checked, and
+        # attribute or index lookups in field names would escape the sandbox
+        size, position = 0, 0
+        for literal, field, spec, conversion in string.Formatter().parse(template):
+            size += len(literal)
+            if field is None:
+                continue
+            if spec or conversion not in (None, "r", "s") or "." in field or "[" in field:
+                raise self._error(f"unsupported format field in {template!r}")
+            if not field:
+                field, position = str(position), position + 1
+            value = args[int(field)] if field.isdigit() and int(field) < len(args) else kwargs.get(field)
+            size += self._str_size(value, quoted=conversion == "r")
+        self._check_str_size(size)
+        return template.format(*args, **kwargs)
+
+    def _str_size(self, value, quoted: bool = False) -> int:
+        """A lower bound on len(str(value)), or repr() if `quoted`.
+
+        Walks containers without building any string, and stops as soon as
+        the bound exceeds max_value_size, so the walk itself is bounded.
+        """
+        size = 0
+        pending = [(value, quoted)]
+        while pending and size <= self.max_value_size:
+            value, quoted = pending.pop()
+            if isinstance(value, str):
+                size += len(value) + (2 if quoted else 0)
+            elif isinstance(value, (list, tuple, dict)):
+                # Brackets and ", " between items, plus ": " in dicts
+                size += 2 * len(value) + (2 * len(value) if isinstance(value, dict) else 0)
+                if size <= self.max_value_size:
+                    items = [*value.keys(), *value.values()] if isinstance(value, dict) else value
+                    pending.extend((item, True) for item in items)
+            elif isinstance(value, _Struct):
+                size += 8 + 5 * len(value.fields)
+                pending.extend((item, True) for item in value.fields.values())
+            else:
+                size += 1
+        return size
+
+    def _check_str_size(self, size: int):
+        if size > self.max_value_size:
+            raise self._error(f"value exceeds {self.max_value_size} elements")
+
+    def _check_str_method(self, receiver: str, name: str, args: list):
+        """Check the size of the string a str method would build, before building it"""
+        if name == "join" and args and hasattr(args[0], "__len__"):
+            items = args[0]
+            size = sum(len(item) for item in items if isinstance(item, str)) + len(receiver) * max(len(items) - 1, 0)
+        elif name == "replace" and len(args) >= 2 and isinstance(args[0], str) and isinstance(args[1], str):
+            old, new = args[0], args[1]
+            count = receiver.count(old) if old else len(receiver) + 1
+            if len(args) > 2 and isinstance(args[2], int) and args[2] >= 0:
+                count = min(count, args[2])
+            size = len(receiver) + count * (len(new) - len(old))
+        else:
+            return
+        self._check_str_size(size)
+
+    def _check_size(self, value):
+        if isinstance(value, (str, list, tuple, dict, range)) and len(value) > self.max_value_size:
+            raise self._error(f"value exceeds {self.max_value_size} elements")
+        if isinstance(value, int) and value.bit_length() > self.max_int_bits:
+            raise self._error(f"integer exceeds {self.max_int_bits} bits")
+
+    def _tick(self, node: ast.AST):
+        self._lineno = getattr(node, "lineno", self._lineno)
+        self._steps += 1
+        if self._steps > self.max_steps or self._steps & 0x3FF == 0:
+            self._check_budget()
+
+    def _check_budget(self):
+        if self._steps > self.max_steps:
+            raise self._error(f"evaluation exceeded {self.max_steps} steps")
+        if time.monotonic() > self._deadline:
+            raise self._error(f"evaluation exceeded {self.max_seconds} seconds")
+
+    # Statements
+
+    def _exec_block(self, statements: list[ast.stmt], scope):
+        for statement in statements:
+            self._exec(statement, scope)
+
+    def _exec(self, node: ast.stmt, scope):
+        self._tick(node)
+        if isinstance(node, ast.Expr):
+            self._eval(node.value, scope)
+        elif isinstance(node, ast.Assign):
+            value = self._eval(node.value, scope)
+            for target in node.targets:
+                self._assign(target, value, scope)
+        elif isinstance(node, ast.AugAssign) and type(node.op) in self._BINARY_OPS:
+            value = self._binary(node.op, self._eval(node.target, scope), self._eval(node.value, scope))
+            self._assign(node.target, value, scope)
+        elif isinstance(node, ast.Pass):
+            pass
+        elif isinstance(node, ast.If):
+            self._exec_block(node.body if self._eval(node.test, scope) else node.orelse, scope)
+        elif isinstance(node, ast.For) and not node.orelse:
+            self._exec_for(node, scope)
+        elif isinstance(node, ast.Break):
+            raise _Break()
+        elif isinstance(node, ast.Continue):
+            raise _Continue()
+        elif isinstance(node, ast.Return):
+            raise _Return(None if node.value is None else self._eval(node.value, scope))
+        elif isinstance(node, ast.FunctionDef) and not node.decorator_list:
+            self._exec_def(node, scope)
+        else:
+            raise self._error(f"unsupported statement: {type(node).__name__}")
+
+    def _exec_for(self, node: ast.For, scope):
+        iterable = self._eval(node.iter, scope)
+        if isinstance(iterable, dict):
+            iterable = list(iterable)
+        for item in iterable:
+            self._assign(node.target, item, scope)
+            try:
+                self._exec_block(node.body, scope)
+            except _Break:
+                break
+            except _Continue:
+                continue
+
+    def _exec_def(self, node: ast.FunctionDef, scope):
+        spec = node.args
+        names = [arg.arg for arg in spec.posonlyargs + spec.args]
+        # Defaults are evaluated once, when the function is defined
+        defaults = dict(zip(names[len(names) - len(spec.defaults):],
+                            (self._eval(default, scope) for default in spec.defaults)))
+        for arg, default in zip(spec.kwonlyargs, spec.kw_defaults):
+            if default is not None:
+                defaults[arg.arg] = self._eval(default, scope)
+        scope[node.name] = _StarlarkFunction(self.filename, node, scope, defaults)
+
+    def _assign(self, target: ast.expr, value, scope):
+        if isinstance(target, ast.Name):
+            scope[target.id] = value
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            values = list(value)
+            if len(values) != len(target.elts):
+                raise self._error(f"cannot unpack {len(values)} values into {len(target.elts)}")
+            for element, element_value in zip(target.elts, values):
+                self._assign(element, element_value, scope)
+        elif isinstance(target, ast.Subscript):
+            container = self._eval(target.value, scope)
+            if not isinstance(container, (list, dict)):
+                raise self._error(f"cannot assign to element of {type(container).__name__}")
+            try:
+                container[self._eval(target.slice, scope)] = value
+            except (IndexError, TypeError) as e:
+                raise self._error(str(e)) from None
+        else:
+            raise self._error(f"unsupported assignment target: {type(target).__name__}")
+
+    # Expressions
+
+    def _eval(self, node: ast.expr, scope):
+        # _tick() inlined: every expression node passes through here
+        self._lineno = node.lineno
+        steps = self._steps = self._steps + 1
+        if steps > self.max_steps or steps & 0x3FF == 0:
+            self._check_budget()
+        handler = self._expr_handlers.get(type(node))
+        if handler is None:
+            raise self._error(f"unsupported expression: {type(node).__name__}")
+        return handler(node, scope)
+
+    def _eval_constant(self, node: ast.Constant, scope):
+        if not isinstance(node.value, (str, int, float, bool, type(None))):
+            raise self._error(f"unsupported literal: {node.value!r}")
+        return node.value
+
+    def _eval_name(self, node: ast.Name, scope):
+        try:
+            return scope[node.id]
+        except KeyError:
+            raise self._error(f"name '{node.id}' is not defined") from None
+
+    def _eval_elements(self, elements: list[ast.expr], scope) -> list:
+        values = []
+        for element in elements:
+            if isinstance(element, ast.Starred):
+                values.extend(self._eval(element.value, scope))
+            else:
+                values.append(self._eval(element, scope))
+        return values
+
+    def _eval_list(self, node: ast.List, scope):
+        return self._eval_elements(node.elts, scope)
+
+    def _eval_tuple(self, node: ast.Tuple, scope):
+        return tuple(self._eval_elements(node.elts, scope))
+
+    def _eval_dict(self, node: ast.Dict, scope):
+        result = {}
+        for key, value in zip(node.keys, node.values):
+            if key is None:
+                result.update(self._eval(value, scope))
+            else:
+                result[self._eval(key, scope)] = self._eval(value, scope)
+        return result
+
+    def _binary(self, op: ast.operator, left, right):
+        function = self._BINARY_OPS.get(type(op))
+        if function is None:
+            raise self._error(f"unsupported operator: {type(op).__name__}")
+        if isinstance(op, ast.Mult):
+            # Check the size before allocating the repeated value or product
+            for sequence, count in ((left, right), (right, left)):
+                if isinstance(sequence, (str, list, tuple)) and isinstance(count, int) \
+                        and len(sequence) * count > self.max_value_size:
+                    raise self._error(f"value exceeds {self.max_value_size} elements")
+            if isinstance(left, int) and isinstance(right, int) \
+                    and left.bit_length() + right.bit_length() > self.max_int_bits + 1:
+                raise self._error(f"integer exceeds {self.max_int_bits} bits")
+        elif isinstance(op, ast.Mod) and isinstance(left, str):
+            # As in _format, a width or precision would allocate before the check
+            if any(match.group(1) for match in _PERCENT_FIELD_RE.finditer(left)):
+                raise self._error(f"unsupported format width or precision in {left!r}")
+            values = right.values() if isinstance(right, dict) else right if isinstance(right, tuple) else (right,)
+            self._check_str_size(len(left) + sum(self._str_size(value) for value in values))
+        try:
+            result = function(left, right)
+        except (TypeError, ValueError, ZeroDivisionError) as e:
+            raise self._error(str(e)) from None
+        self._check_size(result)
+        return result
+
+    def _eval_binop(self, node: ast.BinOp, scope):
+        return self._binary(node.op, self._eval(node.left, scope), self._eval(node.right, scope))
+
+    def _eval_boolop(self, node: ast.BoolOp, scope):
+        is_and = isinstance(node.op, ast.And)
+        value = None
+        for operand in node.values:
+            value = self._eval(operand, scope)
+            if bool(value) != is_and:
+                break
+        return value
+
+    def _eval_unaryop(self, node: ast.UnaryOp, scope):
+        value = self._eval(node.operand, scope)
+        try:
+            if isinstance(node.op, ast.Not):
+                return not value
+            if isinstance(node.op, ast.USub):
+                return -value
+            if isinstance(node.op, ast.UAdd):
+                return +value
+        except TypeError as e:
+            raise self._error(str(e)) from None
+        raise self._error(f"unsupported operator: {type(node.op).__name__}")
+
+    def _eval_compare(self, node: ast.Compare, scope):
+        left = self._eval(node.left, scope)
+        for op, comparator in zip(node.ops, node.comparators):
+            function = self._COMPARE_OPS.get(type(op))
+            if function is None:
+                raise self._error(f"unsupported comparison: {type(op).__name__}")
+            right = self._eval(comparator, scope)
+            try:
+                if not function(left, right):
+                    return False
+            except TypeError as e:
+                raise self._error(str(e)) from None
+            left = right
+        return True
+
+    def _eval_ifexp(self, node: ast.IfExp, scope):
+        if self._eval(node.test, scope):
+            return self._eval(node.body, scope)
+        return self._eval(node.orelse, scope)
+
+    def _eval_call(self, node: ast.Call, scope):
+        function = self._eval(node.func, scope)
+        if not callable(function):
+            raise self._error(f"'{type(function).__name__}' object is not callable")
+
+        args = self._eval_elements(node.args, scope)
+        kwargs = {}
+        for keyword in node.keywords:
+            if keyword.arg is None:
+                kwargs.update(self._eval(keyword.value, scope))
+            else:
+                kwargs[keyword.arg] = self._eval(keyword.value, scope)
+
+        receiver = getattr(function, "__self__", None)
+        if isinstance(receiver, str):
+            self._check_str_method(receiver, function.__name__, args)
+        # Methods that grow their receiver in place return None, so the
+        # receiver is checked before (extend, update) and after the call
+        if not isinstance(receiver, (list, dict)):
+            receiver = None
+        elif function.__name__ in ("extend", "update") and args and hasattr(args[0], "__len__") \
+                and len(receiver) + len(args[0]) > self.max_value_size:
+            raise self._error(f"value exceeds {self.max_value_size} elements")
+
+        lineno = self._lineno
+        try:
+            result = function(*args, **kwargs)
+        except StarlarkError:
+            raise
+        except (TypeError, ValueError, KeyError, IndexError, AttributeError) as e:
+            self._lineno = lineno
+            raise self._error(str(e)) from None
+
+        if isinstance(result, self._VIEW_TYPES):
+            result = list(result)
+        self._check_size(result)
+        if receiver is not None:
+            self._check_size(receiver)
+        return result
+
+    def _eval_attribute(self, node: ast.Attribute, scope):
+        value = self._eval(node.value, scope)
+        if isinstance(value, _Struct):
+            try:
+                return value.fields[node.attr]
+            except KeyError:
+                raise self._error(f"struct has no field '{node.attr}'") from None
+        allowed = self._METHODS.get(type(value), ())
+        if node.attr not in allowed:
+            raise self._error(f"'{type(value).__name__}' has no attribute '{node.attr}'")
+        if node.attr == "format":
+            return functools.partial(self._format, value)
+        return getattr(value, node.attr)
+
+    def _eval_subscript(self, node: ast.Subscript, scope):
+        value = self._eval(node.value, scope)
+        if isinstance(node.slice, ast.Slice):
+            index = slice(*(self._eval(part, scope) if part is not None else None
+                            for part in (node.slice.lower, node.slice.upper, node.slice.step)))
+        else:
+            index = self._eval(node.slice, scope)
+        try:
+            return value[index]
+        except (IndexError, KeyError, TypeError) as e:
+            raise self._error(f"invalid index {index!r}: {e}") from None
+
+    def _comprehension(self, generators: list[ast.comprehension], scope, emit):
+        generator, rest = generators[0], generators[1:]
+        iterable = self._eval(generator.iter, scope)
+        if isinstance(iterable, dict):
+            iterable = list(iterable)
+        for item in iterable:
+            self._assign(generator.target, item, scope)
+            if all(self._eval(condition, scope) for condition in generator.ifs):
+                if rest:
+                    self._comprehension(rest, scope, emit)
+                else:
+                    emit(scope)
+
+    def _eval_listcomp(self, node: ast.ListComp, scope):
+        result = []
+
+        def emit(inner):
+            result.append(self._eval(node.elt, inner))
+            self._check_size(result)
+
+        self._comprehension(node.generators, collections.ChainMap({}, scope), emit)
+        return result
+
+    def _eval_dictcomp(self, node: ast.DictComp, scope):
+        result = {}
+
+        def emit(inner):
+            result[self._eval(node.key, inner)] = self._eval(node.value, inner)
+            self._check_size(result)
+
+        self._comprehension(node.generators, collections.ChainMap({}, scope), emit)
+        return result
+
+
+# Tokens of BUILD files made only of literal rule calls. Any other
+# character becomes a one-character token that the scanner rejects.
+_LITERAL_TOKEN_RE = re.compile(r"""
+    \s*
+    ( [()\[\],=]                   # punctuation
+    | "[^"\\\n]*"                 # strings without escapes
+    | [A-Za-z_]\w*                 # names
+    | '[^'\\\n]*'
+    | -?\d+                        # integers
+    | \#[^\n]*                     # comments
+    | \S                           # everything else
+    )
+""", re.VERBOSE)
+
+_LITERAL_NAMES = {"True": True, "False": False, "None": None}
+
+
+def _scan_literal_calls(content: str) -> Optional[list[tuple[str, list, dict]]]:
+    """Scan a BUILD file made only of literal calls without compiling it.
+
+    Returns (function name, args, kwargs) for each top-level call, or None
+    as soon as anything dynamic (a variable, operator, comprehension, ...)
+    is seen so the caller can fall back to full evaluation.
+    """
+    tokens = iter([token for token in _LITERAL_TOKEN_RE.findall(content) if token[0] != "#"])
+
+    def value(token: str):
+        if token[0] in "\"'":
+            # A lone quote is an unterminated string, not an empty one
+            if len(token) < 2:
+                raise ValueError("unterminated string")
+            return token[1:-1]
+        if token == "[":
+            items = []
+            token = next(tokens)
+            while token != "]":
+                items.append(value(token))
+                token = next(tokens)
+                if token == ",":
+                    token = next(tokens)
+                elif token != "]":
+                    raise ValueError("expected ',' or ']'")
+            return items
+        if token in _LITERAL_NAMES:
+            return _LITERAL_NAMES[token]
+        return int(token)
+
+    calls = []
+    try:
+        for function in tokens:
+            if not function.isidentifier() or next(tokens) != "(":
+                return None
+            args, kwargs = [], {}
+            token = next(tokens)
+            while token != ")":
+                following = next(tokens)
+                if following == "=":
+                    if not token.isidentifier() or token in kwargs:
+                        return None
+                    kwargs[token] = value(next(tokens))
+                    following = next(tokens)
+                elif kwargs or token == "[":
+                    # Positional lists would need a second token of lookahead
+                    return None
+                else:
+                    args.append(value(token))
+                if following == ",":
+                    token = next(tokens)
+                elif following == ")":
+                    token = following
+                else:
+                    return None
+            calls.append((function, args, kwargs))
+    except (ValueError, StopIteration):
+        return None
+
+    return calls
 
 
 class BazelParser:
-    """Parses Bazel BUILD files by evaluating them as Python"""
+    """Parses Bazel BUILD files by evaluating them as Starlark"""
 
-    def __init__(self):
+    # Native rules and the BazelTarget rule type each one creates
+    RULES = ("cc_library", "cc_test", "cc_binary", "config_setting")
+
+    def __init__(self, fast_path: bool = True, snapshot: Optional["WorkspaceSnapshot"] = None,
+                 modules: Optional["BzlModules"] = None, workspace_root: Optional[Path] = None):
         self.targets: list[BazelTarget] = []
+        self.fast_path = fast_path
+        # Listing glob() matches against and the .bzl module table load()
+        # uses; both are created on first use if not given
+        self.snapshot = snapshot
+        self.modules = modules
+        self.workspace_root = workspace_root
+        self._package = ""
+        self._filename = ""
 
-    def parse_file(self, filepath: Path) -> list[BazelTarget]:
-        """Parse BUILD.bazel file by evaluating as Python"""
+        # Built once per parser; each parse only resets the target list
+        self._rules = {"load": self._load, "glob": self._glob, "package_name": self._package_name}
+        for rule_type in self.RULES:
+            self._rules[rule_type] = functools.partial(self._add_target, rule_type)
+
+    def parse_file(self, filepath: Path, package: str = "") -> list[BazelTarget]:
+        """Parse BUILD.bazel file by evaluating as Starlark"""
         with open(filepath, 'r') as f:
             content = f.read()
 
-        # Define Bazel functions that capture target definitions
-        def load(*args, **kwargs):
-            """Mock load function - ignore load statements"""
-            pass
+        return self.parse_string(content, str(filepath), package)
 
-        def cc_library(**kwargs):
-            """Mock cc_library function"""
-            target = BazelTarget("cc_library", kwargs.get("name", ""))
-            self._populate_target(target, kwargs)
-            self.targets.append(target)
+    def parse_string(self, content: str, filename: str = "BUILD.bazel", package: str = "") -> list[BazelTarget]:
+        """Parse BUILD file content by evaluating as Starlark.
 
-        def cc_test(**kwargs):
-            """Mock cc_test function"""
-            target = BazelTarget("cc_test", kwargs.get("name", ""))
-            self._populate_target(target, kwargs)
-            self.targets.append(target)
+        `package` is the workspace-relative package path ("" for the root)
+        that relative labels in this file are resolved against. Each call
+        returns only the targets of this file, so one parser can be reused
+        across many files.
+        """
+        self.targets = []
+        self._package = package
+        self._filename = filename
 
-        def cc_binary(**kwargs):
-            """Mock cc_binary function"""
-            target = BazelTarget("cc_binary", kwargs.get("name", ""))
-            self._populate_target(target, kwargs)
-            self.targets.append(target)
+        # Fast path: files made only of literal rule calls need no
+        # evaluation, unless they load workspace .bzl files that may
+        # rebind names
+        if self.fast_path:
+            calls = _scan_literal_calls(content)
+            if calls is not None and all(function in self._rules for function, _, _ in calls) \
+                    and not any(function == "load" and args and isinstance(args[0], str)
+                                and bzl_path(args[0], package) is not None for function, args, _ in calls):
+                try:
+                    for function, args, kwargs in calls:
+                        self._rules[function](*args, **kwargs)
+                    return self.targets
+                except Exception:
+                    # Let the evaluator report the error with a location
+                    self.targets = []
 
         # Create execution environment with our mock functions
-        exec_globals = {
-            "load": load,
-            "cc_library": cc_library,
-            "cc_test": cc_test,
-            "cc_binary": cc_binary,
-        }
+        evaluator = _StarlarkEvaluator(filename)
+        env = evaluator.builtins()
+        env.update(self._rules)
+        env["load"] = functools.partial(self._load_into, env)
 
-        # Execute the BUILD file content
-        exec(content, exec_globals)
+        # Evaluate the BUILD file content; macros called from it add
+        # targets to this parser through native.*
+        _active_parsers.append(self)
+        try:
+            evaluator.run(_parse_starlark(content, filename), env)
+        finally:
+            _active_parsers.pop()
 
         return self.targets
 
+    def _workspace_root(self) -> Path:
+        if self.workspace_root is not None:
+            return self.workspace_root
+        # The workspace root is as many levels above the BUILD file as the package is deep
+        root = Path(self._filename).parent
+        for _ in Path(self._package).parts:
+            root = root.parent
+        return root
+
+    def _load_into(self, env: dict, label: str, *names: str, **aliases: str):
+        """load() on the evaluator path"""
+        # Most files only load native rules from external repositories; the
+        # .bzl module table is created by the first load of a workspace file
+        if self.modules is None:
+            if bzl_path(label, self._package) is None:
+                BzlModules.bind_native(env, names, aliases)
+                return
+            self.modules = BzlModules(self._workspace_root())
+        self.modules.load_into(env, self._package, label, *names, **aliases)
+
+    def _load(self, *args, **kwargs):
+        """load() on the fast path, which only sees loads from external repositories"""
+        pass
+
+    def _package_name(self) -> str:
+        """package_name(): the package of the BUILD file being evaluated"""
+        return self._package
+
+    def _glob(self, include: list[str], exclude: list[str] = (), exclude_directories: int = 1,
+              allow_empty: bool = True) -> list[str]:
+        """glob(), matched against the workspace snapshot"""
+        if self.snapshot is None:
+            self.snapshot = WorkspaceSnapshot(self._workspace_root())
+        matches = self.snapshot.glob(self._package, include, exclude, exclude_directories)
+        if not matches and not allow_empty:
+            raise ValueError(f"glob({include!r}) matched no files")
+        return matches
+
+    def _add_target(self, rule_type: str, /, **kwargs):
+        """Mock rule function, e.g. cc_library(**kwargs)"""
+        target = BazelTarget(rule_type, kwargs.get("name", ""), self._package)
+        self._populate_target(target, kwargs)
+        self.targets.append(target)
+
     def _populate_target(self, target: BazelTarget, kwargs: dict):
         """Populate target with attributes from kwargs"""
-        for attr_name in ["hdrs", "srcs", "deps", "visibility", "data"]:
+        if "define_values" in kwargs:
+            # config_setting(define_values = {"k": "v"}) is values = {"define": "k=v"}
+            target.add_attribute("values", [f"define={k}={v}" for k, v in sorted(kwargs["define_values"].items())])
+        for attr_name in BazelTarget.LIST_ATTRIBUTES:
             if attr_name in kwargs:
                 values = kwargs[attr_name]
                 if isinstance(values, list):
                     target.add_attribute(attr_name, values)
+                elif isinstance(values, dict):
+                    target.add_attribute(attr_name, [f"{k}={v}" for k, v in sorted(values.items())])
                 else:
                     target.add_attribute(attr_name, [values])
+        for attr_name in BazelTarget.SCALAR_ATTRIBUTES:
+            # A select() of a test attribute cannot be mapped; keep the default
+            if attr_name in kwargs and not isinstance(kwargs[attr_name], Select):
+                setattr(target, attr_name, _intern(kwargs[attr_name]))
+
+
+# Parsers evaluating a BUILD file, innermost last
+_active_parsers: list[BazelParser] = []
+
+
+def _native(function: str, /, *args, **kwargs):
+    """native.<function>(...) in a .bzl file, run on the parser of the current BUILD file"""
+    if not _active_parsers:
+        raise ValueError(f"native.{function}() can only be called while a BUILD file is evaluated")
+    return _active_parsers[-1]._rules[function](*args, **kwargs)
+
+
+_NATIVE = _Struct(**{name: functools.partial(_native, name)
+                     for name in BazelParser.RULES + ("glob", "package_name")})
+
+
+def cmake_target_name(package: str, name: str) -> str:
+    """CMake target name of //package:name.
+
+    CMake target names are global across add_subdirectory(), so targets
+    in a package are qualified by its path; those of the root package,
+    and of BUILD files converted on their own, keep their Bazel name.
+    """
+    return re.sub(r"\W", "_", f"{package}_{name}") if package else name
+
+
+def canonical_label(label: str, package: str) -> str:
+    """Canonicalize a main-repository label relative to `package` as //package:name.
+
+    External labels (@repo//...) are returned unchanged.
+    """
+    if label.startswith("@//"):
+        label = label[1:]
+    if label.startswith("@"):
+        return label
+    if label.startswith("//"):
+        path, separator, name = label[2:].partition(":")
+        if not separator:
+            name = path.rsplit("/", 1)[-1]
+        return f"//{path}:{name}"
+    return f"//{package}:{label[1:] if label.startswith(':') else label}"
+
+
+class TargetGraph:
+    """Index of all parsed targets by canonical label, with dependency edges.
+
+    Built once from every parsed target so dependencies resolve with a dict
+    lookup, targets can be ordered dependencies-first, and dangling deps
+    and cycles are found before a broken project is handed to CMake.
+    """
+
+    def __init__(self, targets: list[BazelTarget]):
+        self.targets: dict[str, BazelTarget] = {}
+        self.packages: dict[str, list[str]] = {}
+        self.edges: dict[str, tuple[str, ...]] = {}
+        # Reverse edges, kept even for missing deps so removals can be traced
+        self.dependents: dict[str, set[str]] = collections.defaultdict(set)
+        self.duplicates: list[str] = []
+        # Labels of the rules that become CMake targets, by CMake target name
+        self.names: dict[str, set[str]] = collections.defaultdict(set)
+
+        for target in targets:
+            self._add(target)
+
+    def _add(self, target: BazelTarget):
+        label = target.label
+        if label in self.targets:
+            self.duplicates.append(label)
+            return
+        self.targets[label] = target
+        self.packages.setdefault(target.package, []).append(label)
+        if target.rule_type.startswith("cc_"):
+            self.names[target.cmake_name].add(label)
+        # select() conditions are edges too, so a missing config_setting is
+        # caught and its users are refreshed when it changes
+        deps = [canonical_label(dep, target.package) for dep in (*flatten(target.deps), *target.conditions())]
+        self.edges[label] = tuple(dict.fromkeys(dep for dep in deps if not dep.startswith("@") and dep != Select.DEFAULT))
+        for dep in self.edges[label]:
+            self.dependents[dep].add(label)
+
+    def replace_package(self, package: str, targets: list[BazelTarget]) -> set[str]:
+        """Swap in a package's newly parsed targets (none if it was deleted).
+
+        Returns the labels whose validity or output may have changed: the
+        package's old and new targets, plus the dependents of targets that
+        were added or removed and of config_settings. Dependents of other
+        targets that merely changed still resolve to the same names, so
+        they are left alone.
+        """
+        old = set(self.packages.pop(package, []))
+        settings = {label for label in old if self.targets[label].rule_type == "config_setting"}
+        for label in old:
+            self.names[self.targets.pop(label).cmake_name].discard(label)
+            for dep in self.edges.pop(label):
+                self.dependents[dep].discard(label)
+        self.duplicates = [label for label in self.duplicates
+                           if label[2:].partition(":")[0] != package]
+
+        for target in targets:
+            self._add(target)
+        new = set(self.packages.get(package, []))
+        settings.update(label for label in new if self.targets[label].rule_type == "config_setting")
+        affected = old | new
+        for label in (old ^ new) | settings:
+            affected.update(self.dependents.get(label, ()))
+        return affected
+
+    def resolve(self, label: str, package: str = "") -> Optional[BazelTarget]:
+        """Look up the target a (possibly relative) label refers to"""
+        return self.targets.get(canonical_label(label, package))
+
+    def dangling_deps(self, labels: Optional[Iterable[str]] = None) -> list[tuple[str, str]]:
+        """(target, dep) pairs whose dep names a missing target in a parsed package.
+
+        Deps into packages that were not parsed at all are not dangling;
+        they simply point outside the converted set of BUILD files. Only
+        `labels` are checked if given.
+        """
+        dangling = []
+        for label in self.edges if labels is None else labels:
+            for dep in self.edges.get(label, ()):
+                if dep not in self.targets and dep[2:].partition(":")[0] in self.packages:
+                    dangling.append((label, dep))
+        return dangling
+
+    def name_collisions(self, labels: Optional[Iterable[str]] = None) -> list[list[str]]:
+        """Labels of targets that would become the same CMake target, e.g. //a_b:c and //a:b_c.
+
+        Only the names of `labels` are checked if given.
+        """
+        names = self.names if labels is None else {self.targets[label].cmake_name for label in labels
+                                                   if label in self.targets}
+        return [sorted(self.names[name]) for name in sorted(names) if len(self.names.get(name, ())) > 1]
+
+    def strongly_connected_components(self, roots: Optional[Iterable[str]] = None,
+                                      package: Optional[str] = None) -> list[list[str]]:
+        """Tarjan's algorithm, iteratively; components come out dependencies-first.
+
+        With `roots`, only the part of the graph reachable from them is visited;
+        with `package`, only edges between targets of that package are followed.
+        """
+        index: dict[str, int] = {}
+        lowlink: dict[str, int] = {}
+        stack: list[str] = []
+        on_stack: set[str] = set()
+        components: list[list[str]] = []
+
+        def visit(label: str):
+            index[label] = lowlink[label] = len(index)
+            stack.append(label)
+            on_stack.add(label)
+            deps = self.edges[label]
+            if package is not None:
+                deps = [dep for dep in deps if dep[2:].partition(":")[0] == package]
+            work.append((label, iter(deps)))
+
+        for root in self.targets if roots is None else roots:
+            if root in index or root not in self.targets:
+                continue
+            work: list = []
+            visit(root)
+            while work:
+                label, deps = work[-1]
+                for dep in deps:
+                    if dep not in self.targets:
+                        continue
+                    if dep not in index:
+                        visit(dep)
+                        break
+                    if dep in on_stack:
+                        lowlink[label] = min(lowlink[label], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[label])
+                    if lowlink[label] == index[label]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == label:
+                                break
+                        components.append(component[::-1])
+
+        return components
+
+    def cycles(self, labels: Optional[Iterable[str]] = None) -> list[list[str]]:
+        """Dependency cycles, as the labels of each cyclic component.
+
+        Only cycles reachable from `labels` are found if given.
+        """
+        return [component for component in self.strongly_connected_components(labels)
+                if len(component) > 1 or component[0] in self.edges[component[0]]]
+
+    def topological_order(self) -> list[str]:
+        """All labels, each after the targets it depends on"""
+        return [label for component in self.strongly_connected_components() for label in component]
+
+    def sort_targets(self, targets: list[BazelTarget]) -> list[BazelTarget]:
+        """Sort one package's targets dependencies-first.
+
+        Only edges inside the package matter for the order of its own
+        CMakeLists.txt, so this never walks other packages and a package
+        always renders the same way whether the workspace was converted
+        in full or just this package was refreshed.
+        """
+        if not targets:
+            return []
+        components = self.strongly_connected_components((t.label for t in targets), targets[0].package)
+        order = {label: i for i, label in enumerate(label for c in components for label in c)}
+        return sorted(targets, key=lambda t: order.get(t.label, len(order)))
+
+    def errors(self, labels: Optional[Iterable[str]] = None) -> list[str]:
+        """Problems that would produce a broken CMake project.
+
+        Dangling deps and cycles are only looked for from `labels` if given,
+        e.g. the labels returned by replace_package().
+        """
+        if labels is not None:
+            labels = list(labels)
+        errors = [f"duplicate target {label}" for label in self.duplicates]
+        errors.extend(f"{label} depends on missing target {dep}" for label, dep in self.dangling_deps(labels))
+        errors.extend("dependency cycle: " + " -> ".join(cycle + cycle[:1]) for cycle in self.cycles(labels))
+        errors.extend("targets share the CMake target name " + self.targets[collision[0]].cmake_name + ": "
+                      + ", ".join(collision) for collision in self.name_collisions(labels))
+        return errors
 
 
 class CMakeGenerator:
     """Generates CMakeLists.txt files"""
 
-    def __init__(self, project_name: str = "strong_typedefs"):
+    # @platforms//os constraints and the CMake PLATFORM_ID each one means
+    PLATFORM_IDS = {"linux": "Linux", "windows": "Windows", "macos": "Darwin", "osx": "Darwin",
+                    "android": "Android", "freebsd": "FreeBSD", "ios": "iOS"}
+    # config_setting(values = {"compilation_mode": ...}) conditions
+    COMPILATION_MODES = {"dbg": "$<CONFIG:Debug>", "opt": "$<CONFIG:Release>"}
+    # Supported compiler launchers, and linkers with the program names
+    # find_program() looks for and their CMAKE_LINKER_TYPE
+    COMPILER_LAUNCHERS = ("ccache", "sccache")
+    LINKERS = {"mold": (("mold",), "MOLD"), "lld": (("ld.lld", "lld"), "LLD")}
+    # Bazel's timeout for each test size, and the seconds of each timeout
+    TEST_SIZE_TIMEOUTS = {"small": "short", "medium": "moderate", "large": "long", "enormous": "eternal"}
+    TEST_TIMEOUTS = {"short": 60, "moderate": 300, "long": 900, "eternal": 3600}
+    # Runs of a flaky test before it counts as failed, as in Bazel
+    FLAKY_ATTEMPTS = 3
+    FLAKY_SCRIPT = "run_flaky_test.cmake"
+    # Ninja job pools, and the tag that puts a target in the heavy one
+    LINK_POOL = "link_pool"
+    HEAVY_POOL = "heavy_compile_pool"
+    HEAVY_TAG = "heavy"
+
+    def __init__(self, project_name: str = "strong_typedefs", precompile_headers: Iterable[str] = (),
+                 precompile_min_users: int = 0, unity_build: Optional[str] = None, unity_batch_size: int = 8,
+                 unity_exclude: Iterable[str] = (), compiler_launcher: Optional[str] = None,
+                 linker: Optional[str] = None, link_pool_depth: int = 0, heavy_pool_depth: int = 0,
+                 heavy_targets: Iterable[str] = (), gtest_discover_tests: bool = False):
         self.project_name = project_name
         self.cmake_minimum_version = "3.20"
         self.cpp_standard = "20"
+        # Workspace-relative headers (or their labels) to precompile, and the
+        # number of compiled direct dependents from which a library's
+        # headers are precompiled automatically (0 disables that)
+        self.precompile_headers = frozenset(map(self._header_path, precompile_headers))
+        self.precompile_min_users = precompile_min_users
+        self._precompile_plan: Optional[dict[str, tuple[tuple[str, ...], Optional[str]]]] = None
+        # "batch" or "group" to emit unity builds, the sources per unity TU,
+        # and target or source file labels that must not be merged
+        if unity_build not in (None, "batch", "group"):
+            raise ValueError(f"unknown unity build mode {unity_build!r}")
+        if unity_batch_size < 1:
+            raise ValueError("unity batch size must be at least 1")
+        self.unity_build = unity_build
+        self.unity_batch_size = unity_batch_size
+        self.unity_exclude = frozenset(canonical_label(label, "") for label in unity_exclude)
+        # Compiler launcher and linker to use when they are installed
+        if compiler_launcher not in (None, *self.COMPILER_LAUNCHERS):
+            raise ValueError(f"unknown compiler launcher {compiler_launcher!r}")
+        if linker not in (None, *self.LINKERS):
+            raise ValueError(f"unknown linker {linker!r}")
+        self.compiler_launcher = compiler_launcher
+        self.linker = linker
+        # Ninja job pool depths (0 for no pool) for linking binaries and
+        # tests and for compiling heavy targets: those tagged "heavy" or
+        # listed in `heavy_targets`
+        self.link_pool_depth = link_pool_depth
+        self.heavy_pool_depth = heavy_pool_depth
+        self.heavy_targets = frozenset(canonical_label(label, "") for label in heavy_targets)
+        # Register each GoogleTest case as its own CTest test
+        self.gtest_discover_tests = gtest_discover_tests
+        # Directory that package paths are relative to, for source file sizes
+        self.source_root: Optional[Path] = None
+        # Graph of every parsed target; when set, deps are resolved through
+        # it and targets are emitted dependencies-first
+        self.graph: Optional[TargetGraph] = None
+        # select() conditions with no CMake equivalent, as cache variables
+        # of the package being rendered, and whether it has flaky tests or
+        # discovers GoogleTest cases
+        self._condition_variables: dict[str, str] = {}
+        self._flaky_script = False
+        self._googletest_module = False
 
-    def generate_cmake(self, targets: list[BazelTarget], output_path: Path):
-        """Generate CMakeLists.txt from targets"""
-        lines = []
+    def generate_cmake(self, targets: list[BazelTarget], output_path: Path) -> bool:
+        """Generate CMakeLists.txt from targets.
+
+        Returns False if the file already had identical content and was
+        left untouched, so CMake does not see a new mtime and reconfigure.
+        """
+        return write_if_changed(output_path, self.render_cmake(targets))
+
+    def render_cmake(self, targets: list[BazelTarget], subdirectories: Optional[list[str]] = None,
+                     is_root: bool = True, external_deps: Optional[set[str]] = None) -> str:
+        """Render CMakeLists.txt content for one package.
 
-        lines.extend(self._generate_header())
-        lines.append("")
+        Only the root package gets the project header and external
+        dependencies; `external_deps` defaults to those of `targets`.
+        """
+        lines = []
 
-        external_deps = self._find_external_deps(targets)
-        if external_deps:
-            lines.extend(self._generate_find_package_section(external_deps))
+        if is_root:
+            lines.extend(self._generate_header())
             lines.append("")
 
+            if external_deps is None:
+                external_deps = self._find_external_deps(targets)
+            if external_deps:
+                lines.extend(self._generate_find_package_section(external_deps))
+                lines.append("")
+
+        if self.graph is not None:
+            targets = self.graph.sort_targets(targets)
+
+        self._condition_variables = {}
+        self._flaky_script = False
+        self._googletest_module = False
+        target_lines = []
         for target in targets:
-            lines.extend(self._generate_target(target))
+            if target.rule_type != "config_setting":
+                target_lines.extend(self._generate_target(target))
+                target_lines.append("")
+
+        if self._condition_variables:
+            lines.append("# select() conditions without a CMake equivalent")
+            for variable, label in sorted(self._condition_variables.items()):
+                lines.append(f'option({variable} "Bazel condition {label}" OFF)')
+            lines.append("")
+        if self._googletest_module:
+            lines.extend(["include(GoogleTest)", ""])
+        if self._flaky_script:
+            lines.extend(self._generate_flaky_script())
+        lines.extend(target_lines)
+
+        if subdirectories:
+            lines.append("# Packages")
+            for subdirectory in subdirectories:
+                lines.append(f"add_subdirectory({subdirectory})")
             lines.append("")
 
         library_targets = [t for t in targets if t.rule_type == "cc_library"]
         if library_targets:
             lines.extend(self._generate_install_rules(library_targets))
 
-        with open(output_path, 'w') as f:
-            f.write('\n'.join(lines))
+        return '\n'.join(lines)
+
+    def workspace_layout(self, package_dirs: list[Path]) -> dict[Path, list[str]]:
+        """Map each package directory to the subdirectories it must add.
+
+        Every package is added by its nearest ancestor package, and the
+        workspace root (Path(".")) is always present so the tree has a
+        single top-level CMakeLists.txt.
+        """
+        layout: dict[Path, list[str]] = {Path("."): []}
+        for package_dir in package_dirs:
+            layout.setdefault(package_dir, [])
+
+        for package_dir in sorted(layout):
+            if package_dir == Path("."):
+                continue
+            parent = package_dir.parent
+            while parent not in layout:
+                parent = parent.parent
+            layout[parent].append(package_dir.relative_to(parent).as_posix())
+
+        return layout
+
+    def options(self) -> dict:
+        """Settings that affect the generated output (part of cache keys)"""
+        return {
+            "project_name": self.project_name,
+            "cmake_minimum_version": self.cmake_minimum_version,
+            "cpp_standard": self.cpp_standard,
+            "precompile_headers": sorted(self.precompile_headers),
+            "precompile_min_users": self.precompile_min_users,
+            "unity_build": self.unity_build,
+            "unity_batch_size": self.unity_batch_size,
+            "unity_exclude": sorted(self.unity_exclude),
+            "compiler_launcher": self.compiler_launcher,
+            "linker": self.linker,
+            "link_pool_depth": self.link_pool_depth,
+            "heavy_pool_depth": self.heavy_pool_depth,
+            "heavy_targets": sorted(self.heavy_targets),
+            "gtest_discover_tests": self.gtest_discover_tests,
+        }
+
+    @staticmethod
+    def _header_path(header: str) -> str:
+        """Workspace-relative path of a header given as a path or a //package:file label"""
+        if header.startswith(("//", "@//", ":")):
+            path, _, name = canonical_label(header, "")[2:].partition(":")
+            return posixpath.join(path, name)
+        return posixpath.normpath(header)
+
+    def invalidate(self):
+        """Forget what was derived from the graph, after it was replaced or changed"""
+        self._precompile_plan = None
+
+    def precompile_plan(self) -> dict[str, tuple[tuple[str, ...], Optional[str]]]:
+        """Precompiled headers of every compiled target, and the target whose PCH it reuses.
+
+        A target precompiles the chosen headers of itself and its direct
+        deps, the only headers Bazel's layering check lets it include.
+        Targets with the same headers, copts and defines, including those
+        propagated from deps, share one PCH: one of them builds it and the
+        others get REUSE_FROM it (None for the builder).
+        The plan spans all packages and is kept until invalidate().
+        """
+        if self._precompile_plan is not None:
+            return self._precompile_plan
+        self._precompile_plan = plan = {}
+        if self.graph is None or not (self.precompile_headers or self.precompile_min_users):
+            return plan
+
+        graph = self.graph
+        chosen: dict[str, tuple[str, ...]] = {}
+        for label, target in graph.targets.items():
+            if target.rule_type != "cc_library":
+                continue
+            paths = [posixpath.join(target.package, hdr) for hdr in target.hdrs if not isinstance(hdr, Select)]
+            headers = [path for path in paths if path in self.precompile_headers]
+            if not headers and self.precompile_min_users:
+                users = sum(1 for user in graph.dependents.get(label, ())
+                            if user in graph.targets and self._compiles_cxx(graph.targets[user]))
+                headers = paths if users >= self.precompile_min_users else []
+            if headers:
+                chosen[label] = tuple(headers)
+        if not chosen:
+            return plan
+
+        # REUSE_FROM makes a target depend on the PCH builder, so builders
+        # are picked lowest in the dependency graph to never close a cycle
+        defines: dict[str, tuple] = {}
+        height: dict[str, int] = {}
+        for label in graph.topological_order():
+            propagated = dict.fromkeys(graph.targets[label].defines)
+            height[label] = 0
+            for dep in graph.edges[label]:
+                propagated.update(dict.fromkeys(defines.get(dep, ())))
+                height[label] = max(height[label], height.get(dep, -1) + 1)
+            defines[label] = tuple(propagated)
+
+        builders: dict[tuple, str] = {}
+        for label in sorted(graph.targets, key=lambda label: (height[label], label)):
+            target = graph.targets[label]
+            if not self._compiles_cxx(target):
+                continue
+            headers = tuple(sorted({header for dep in (label, *graph.edges[label]) for header in chosen.get(dep, ())}))
+            if headers:
+                builder = builders.setdefault((headers, target.copts, target.local_defines, defines[label]), label)
+                plan[label] = (headers, None if builder == label else builder)
+        return plan
+
+    @staticmethod
+    def _compiles_cxx(target: BazelTarget) -> bool:
+        return target.rule_type.startswith("cc_") and any(
+            src.endswith(CompileFlags.CXX_EXTENSIONS) for src in flatten(target.srcs))
 
     def _generate_header(self) -> list[str]:
         """Generate CMakeLists.txt header"""
@@ -152,17 +1599,72 @@ class CMakeGenerator:
             "set(CMAKE_CXX_STANDARD_REQUIRED ON)",
             "set(CMAKE_CXX_EXTENSIONS OFF)",
             "",
+            *self._generate_toolchain_section(),
             "# Enable testing",
             "include(CTest)",
             "enable_testing()"
         ]
 
+    def _generate_toolchain_section(self) -> list[str]:
+        """Compiler launcher and linker, each used only if installed and not already chosen, and job pools"""
+        lines = []
+        if self.compiler_launcher:
+            variable = f"{self.compiler_launcher.upper()}_PROGRAM"
+            lines.extend([
+                "# Compiler launcher",
+                f"find_program({variable} {self.compiler_launcher})",
+                f"if({variable} AND NOT CMAKE_CXX_COMPILER_LAUNCHER)",
+                f'    set(CMAKE_CXX_COMPILER_LAUNCHER "${{{variable}}}")',
+                "endif()",
+                "",
+            ])
+        if self.linker:
+            names, linker_type = self.LINKERS[self.linker]
+            variable = f"{self.linker.upper()}_PROGRAM"
+            lines.extend([
+                "# Linker",
+                f"find_program({variable} NAMES {' '.join(names)})",
+                f"if({variable} AND NOT CMAKE_LINKER_TYPE)",
+                "    if(CMAKE_VERSION VERSION_GREATER_EQUAL 3.29)",
+                f"        set(CMAKE_LINKER_TYPE {linker_type})",
+                "    elseif(NOT MSVC)",
+                f"        add_link_options(-fuse-ld={self.linker})",
+                "    endif()",
+                "endif()",
+                "",
+            ])
+        pools = [f"{pool}={depth}" for pool, depth in ((self.LINK_POOL, self.link_pool_depth),
+                                                        (self.HEAVY_POOL, self.heavy_pool_depth)) if depth]
+        if pools:
+            lines.extend([
+                "# Ninja job pools",
+                f"set_property(GLOBAL APPEND PROPERTY JOB_POOLS {' '.join(pools)})",
+                "",
+            ])
+        return lines
+
+    @classmethod
+    def is_heavy(cls, target: BazelTarget, heavy_targets: frozenset[str]) -> bool:
+        """Whether the target's sources compile in the heavy job pool; shared with NinjaGenerator"""
+        return cls.HEAVY_TAG in target.tags or target.label in heavy_targets
+
+    def _generate_job_pools(self, target: BazelTarget) -> list[str]:
+        """JOB_POOL_COMPILE for heavy targets and JOB_POOL_LINK for binaries and tests"""
+        properties = []
+        if self.heavy_pool_depth and self.is_heavy(target, self.heavy_targets):
+            properties.append(f"    JOB_POOL_COMPILE {self.HEAVY_POOL}")
+        if self.link_pool_depth and target.rule_type in ("cc_test", "cc_binary"):
+            properties.append(f"    JOB_POOL_LINK {self.LINK_POOL}")
+        if not properties:
+            return []
+        return [f"set_target_properties({target.cmake_name} PROPERTIES", *properties, ")"]
+
     def _find_external_deps(self, targets: list[BazelTarget]) -> set[str]:
         """Find external dependencies"""
         external_deps = set()
 
         for target in targets:
-            for dep in target.deps:
+            for dep in flatten(target.deps):
                 if dep.startswith("@"):
                     if "googletest" in dep or "gtest" in dep:
                         external_deps.add("GTest")
@@ -209,39 +1711,48 @@ class CMakeGenerator:
         is_header_only = not target.srcs and target.hdrs
 
         if is_header_only:
-            lines.append(f"add_library({target.name} INTERFACE)")
+            lines.append(f"add_library({target.cmake_name} INTERFACE)")
 
             if target.hdrs:
                 # INTERFACE libraries use target_sources
-                lines.append(f"target_sources({target.name} INTERFACE")
-                for hdr in target.hdrs:
-                    lines.append(f"    ${{CMAKE_CURRENT_SOURCE_DIR}}/{hdr}")
+                lines.append(f"target_sources({target.cmake_name} INTERFACE")
+                for hdr in self._expand(target.hdrs, target.package,
+                                        lambda hdr: [f"${{CMAKE_CURRENT_SOURCE_DIR}}/{hdr}"]):
+                    lines.append(f"    {hdr}")
                 lines.append(")")
 
-            lines.append(f"target_include_directories({target.name} INTERFACE")
+            lines.append(f"target_include_directories({target.cmake_name} INTERFACE")
             lines.append("    $<BUILD_INTERFACE:${CMAKE_CURRENT_SOURCE_DIR}>")
             lines.append("    $<INSTALL_INTERFACE:include>")
             lines.append(")")
 
         else:
             # Regular library with sources
-            sources = target.srcs + target.hdrs
-            lines.append(f"add_library({target.name}")
+            sources = self._expand(target.srcs + target.hdrs, target.package)
+            lines.append(f"add_library({target.cmake_name}")
             for src in sources:
                 lines.append(f"    {src}")
             lines.append(")")
 
-            lines.append(f"target_include_directories({target.name} PUBLIC")
+            lines.append(f"target_include_directories({target.cmake_name} PUBLIC")
             lines.append("    $<BUILD_INTERFACE:${CMAKE_CURRENT_SOURCE_DIR}>")
             lines.append("    $<INSTALL_INTERFACE:include>")
             lines.append(")")
 
+        if target.package:
+            # package::name, close to the Bazel label, for hand-written CMake code
+            alias = "::".join(re.sub(r"[^\w.+-]", "_", part) for part in (*target.package.split("/"), target.name))
+            lines.append(f"add_library({alias} ALIAS {target.cmake_name})")
+
+        lines.extend(self._generate_compile_settings(target, "INTERFACE" if is_header_only else "PUBLIC",
+                                                     compiled=not is_header_only))
+
         # Add dependencies
         if target.deps:
-            cmake_deps = self._convert_deps_to_cmake(target.deps)
+            cmake_deps = self._convert_deps_to_cmake(target.deps, target.package)
             if cmake_deps:
                 scope = "INTERFACE" if is_header_only else "PUBLIC"
-                lines.append(f"target_link_libraries({target.name} {scope}")
+                lines.append(f"target_link_libraries({target.cmake_name} {scope}")
                 for dep in cmake_deps:
                     lines.append(f"    {dep}")
                 lines.append(")")
@@ -252,62 +1763,306 @@ class CMakeGenerator:
         """Generate CMake test target"""
         lines = [f"# Test: {target.name}"]
 
-        lines.append(f"add_executable({target.name}")
-        for src in target.srcs:
+        lines.append(f"add_executable({target.cmake_name}")
+        for src in self._expand(target.srcs, target.package):
             lines.append(f"    {src}")
         lines.append(")")
+        lines.extend(self._generate_compile_settings(target, "PRIVATE"))
 
-        cmake_deps = self._convert_deps_to_cmake(target.deps)
+        cmake_deps = self._convert_deps_to_cmake(target.deps, target.package)
         if cmake_deps:
-            lines.append(f"target_link_libraries({target.name}")
+            lines.append(f"target_link_libraries({target.cmake_name}")
             for dep in cmake_deps:
                 lines.append(f"    {dep}")
             lines.append(")")
 
-        lines.append(f"add_test(NAME {target.name} COMMAND {target.name})")
+        lines.extend(self._generate_tests(target))
+
+        return lines
+
+    def _generate_tests(self, target: BazelTarget) -> list[str]:
+        """add_test() for a cc_test, one per shard, with the CTest properties Bazel schedules by.
 
+        size/timeout become TIMEOUT, tags become LABELS and "exclusive"
+        RUN_SERIAL. Flaky tests run through a script that retries them,
+        and shards get GTest's sharding environment variables.
+
+        With gtest_discover_tests, GoogleTest cases are instead found
+        when ctest runs (PRE_TEST) and registered one by one, which
+        parallelizes better than shards. Flaky tests keep the retrying
+        add_test(), since discovered tests cannot be wrapped.
+        """
+        attempts = self.FLAKY_ATTEMPTS if target.flaky else 1
+        properties = self._test_properties(target, attempts)
+        if self.gtest_discover_tests and attempts == 1 and self._uses_googletest(target):
+            self._googletest_module = True
+            lines = [f"gtest_discover_tests({target.cmake_name}", "    DISCOVERY_MODE PRE_TEST",
+                     f"    TEST_PREFIX {target.cmake_name}.", ")"]
+            if properties:
+                # PROPERTIES of gtest_discover_tests splits list values such as
+                # LABELS, so set them from a ctest include run after discovery
+                script = f"${{CMAKE_CURRENT_BINARY_DIR}}/{target.cmake_name}_test_properties.cmake"
+                lines.extend([f'file(CONFIGURE OUTPUT "{script}" @ONLY CONTENT [=[',
+                              f"if({target.cmake_name}_TESTS)",
+                              f"    set_tests_properties(${{{target.cmake_name}_TESTS}} PROPERTIES"])
+                lines.extend(f"    {line}" for line in properties)
+                lines.extend(["    )", "endif()", "]=])",
+                              f'set_property(DIRECTORY APPEND PROPERTY TEST_INCLUDE_FILES "{script}")'])
+            return lines
+
+        command = target.cmake_name
+        if attempts > 1:
+            self._flaky_script = True
+            command = (f"${{CMAKE_COMMAND}} -DTEST_COMMAND=$<TARGET_FILE:{target.cmake_name}> -DATTEMPTS={attempts} "
+                       f"-P ${{CMAKE_CURRENT_BINARY_DIR}}/{self.FLAKY_SCRIPT}")
+
+        shards = target.shard_count if target.shard_count and target.shard_count > 1 else 1
+        name = target.cmake_name
+        names = [name] if shards == 1 else [f"{name}_shard_{i + 1}_of_{shards}" for i in range(shards)]
+        lines = []
+        for index, name in enumerate(names):
+            lines.append(f"add_test(NAME {name} COMMAND {command})")
+            test_properties = list(properties)
+            if shards > 1:
+                test_properties.append(f'    ENVIRONMENT "GTEST_TOTAL_SHARDS={shards};GTEST_SHARD_INDEX={index}"')
+            if test_properties:
+                lines.append(f"set_tests_properties({name} PROPERTIES")
+                lines.extend(test_properties)
+                lines.append(")")
         return lines
 
+    def _test_properties(self, target: BazelTarget, attempts: int) -> list[str]:
+        """TIMEOUT, LABELS and RUN_SERIAL lines shared by every CTest test of a cc_test"""
+        properties = []
+        # Tests without a size are medium in Bazel, so they too get a timeout
+        size = target.size or "medium"
+        timeout = self.TEST_TIMEOUTS.get(target.timeout or self.TEST_SIZE_TIMEOUTS.get(size, ""))
+        if timeout:
+            # Bazel's timeout applies to each attempt
+            properties.append(f"    TIMEOUT {timeout * attempts}")
+        if target.tags:
+            properties.append(f'    LABELS "{";".join(target.tags)}"')
+        if "exclusive" in target.tags:
+            properties.append("    RUN_SERIAL TRUE")
+        return properties
+
+    @staticmethod
+    def _uses_googletest(target: BazelTarget) -> bool:
+        return any(dep.startswith("@") and ("googletest" in dep or "gtest" in dep) for dep in flatten(target.deps))
+
+    def _generate_flaky_script(self) -> list[str]:
+        """Script that runs a test until it passes, at most ATTEMPTS times"""
+        return [
+            "# Flaky tests are retried until they pass, like Bazel's flaky = True",
+            f"file(CONFIGURE OUTPUT ${{CMAKE_CURRENT_BINARY_DIR}}/{self.FLAKY_SCRIPT} @ONLY CONTENT [=[",
+            "foreach(attempt RANGE 1 ${ATTEMPTS})",
+            "    execute_process(COMMAND ${TEST_COMMAND} RESULT_VARIABLE result)",
+            "    if(result EQUAL 0)",
+            "        return()",
+            "    endif()",
+            '    message("Attempt ${attempt} of ${ATTEMPTS} failed: ${result}")',
+            "endforeach()",
+            'message(FATAL_ERROR "Failed ${ATTEMPTS} attempts")',
+            "]=])",
+            "",
+        ]
+
     def _generate_binary_target(self, target: BazelTarget) -> list[str]:
         """Generate CMake binary target"""
         lines = [f"# Binary: {target.name}"]
 
-        lines.append(f"add_executable({target.name}")
-        for src in target.srcs:
+        lines.append(f"add_executable({target.cmake_name}")
+        for src in self._expand(target.srcs, target.package):
             lines.append(f"    {src}")
         lines.append(")")
+        lines.extend(self._generate_compile_settings(target, "PRIVATE"))
 
-        cmake_deps = self._convert_deps_to_cmake(target.deps)
+        cmake_deps = self._convert_deps_to_cmake(target.deps, target.package)
         if cmake_deps:
-            lines.append(f"target_link_libraries({target.name}")
+            lines.append(f"target_link_libraries({target.cmake_name}")
             for dep in cmake_deps:
                 lines.append(f"    {dep}")
             lines.append(")")
 
         return lines
 
-    def _convert_deps_to_cmake(self, bazel_deps: list[str]) -> list[str]:
-        """Convert Bazel dependencies to CMake targets"""
-        cmake_deps = []
-
-        for dep in bazel_deps:
-            if dep.startswith(":"):
-                cmake_deps.append(dep[1:])  # Remove ':'
-            elif dep.startswith("//"):
-                target_name = dep.split(":")[-1] if ":" in dep else dep.split("/")[-1]
-                cmake_deps.append(target_name)
-            elif "@com_google_googletest//:gtest_main" in dep:
-                cmake_deps.append("GTest::gtest_main")
-            elif "@com_google_googletest//:gtest" in dep:
-                cmake_deps.append("GTest::gtest")
-            elif dep.startswith("@"):
-                if "googletest" in dep or "gtest" in dep:
-                    if "main" in dep:
-                        cmake_deps.append("GTest::gtest_main")
-                    else:
-                        cmake_deps.append("GTest::gtest")
-
-        return cmake_deps
+    def _generate_compile_settings(self, target: BazelTarget, scope: str, compiled: bool = True) -> list[str]:
+        """Include directories, definitions, options and precompiled headers of a target.
+
+        includes and defines propagate to dependents, so they get `scope`;
+        local_defines, copts and precompiled headers only apply to the
+        target's own sources and are dropped when it has none to compile.
+        """
+        package = target.package
+        headers, builder = self.precompile_plan().get(target.label, ((), None)) if compiled else ((), None)
+        sections = [
+            ("target_include_directories", scope,
+             self._expand(target.includes, package, lambda include: [
+                 f"$<BUILD_INTERFACE:${{CMAKE_CURRENT_SOURCE_DIR}}{'' if include in ('', '.') else '/' + include}>"])),
+            ("target_compile_definitions", scope, self._expand(target.defines, package)),
+        ]
+        if compiled:
+            sections.append(("target_compile_definitions", "PRIVATE", self._expand(target.local_defines, package)))
+            sections.append(("target_compile_options", "PRIVATE", self._expand(target.copts, package)))
+            if builder is None:
+                sections.append(("target_precompile_headers", "PRIVATE",
+                                 [f"${{PROJECT_SOURCE_DIR}}/{header}" for header in headers]))
+
+        lines = []
+        for command, section_scope, values in sections:
+            if values:
+                lines.append(f"{command}({target.cmake_name} {section_scope}")
+                for value in values:
+                    lines.append(f"    {value}")
+                lines.append(")")
+        if compiled:
+            lines.extend(self._generate_unity_build(target))
+            lines.extend(self._generate_job_pools(target))
+        if builder is not None:
+            # The builder may live in a package that is added later
+            lines.append(f'cmake_language(DEFER DIRECTORY "${{PROJECT_SOURCE_DIR}}" CALL target_precompile_headers '
+                         f'{target.cmake_name} REUSE_FROM {self.graph.targets[builder].cmake_name})')
+        return lines
+
+    def _unity_sources(self, target: BazelTarget) -> tuple[list[str], list[str]]:
+        """C++ sources of a target that may be merged into unity TUs, and those opted out"""
+        sources, excluded = [], []
+        for src in dict.fromkeys(flatten(target.srcs)):
+            if src.endswith(CompileFlags.CXX_EXTENSIONS):
+                (excluded if f"//{target.package}:{src}" in self.unity_exclude else sources).append(src)
+        return sources, excluded
+
+    def unity_groups(self, target: BazelTarget) -> Optional[list[list[str]]]:
+        """Sources of each unity TU in group mode, balanced by file size.
+
+        Groups are as many as batch mode would make, filled largest file
+        first into the smallest group (LPT scheduling), so every unity TU
+        costs about the same to compile. Sizes are rounded to 4 KiB so
+        small edits do not reshuffle the groups. Returns None if the mode
+        is not "group" or a size is unknown, in which case batches apply.
+        """
+        if self.unity_build != "group" or self.source_root is None or target.label in self.unity_exclude:
+            return None
+        sources, _ = self._unity_sources(target)
+        if len(sources) < 2:
+            return None
+        blocks = {}
+        for src in sources:
+            try:
+                blocks[src] = -(-(self.source_root / target.package / src).stat().st_size // 4096)
+            except OSError:
+                return None
+        groups = [(0, i, []) for i in range(-(-len(sources) // self.unity_batch_size))]
+        for src in sorted(sources, key=lambda src: (-blocks[src], src)):
+            size, i, members = heapq.heappop(groups)
+            members.append(src)
+            heapq.heappush(groups, (size + blocks[src], i, members))
+        return [sorted(members) for _, _, members in sorted(groups, key=operator.itemgetter(1)) if members]
+
+    def _generate_unity_build(self, target: BazelTarget) -> list[str]:
+        """UNITY_BUILD properties, with explicit groups in group mode"""
+        if self.unity_build is None or target.label in self.unity_exclude:
+            return []
+        sources, excluded = self._unity_sources(target)
+        if len(sources) < 2:
+            return []
+        groups = self.unity_groups(target)
+        lines = [f"set_target_properties({target.cmake_name} PROPERTIES", "    UNITY_BUILD ON"]
+        if groups is None:
+            lines.append(f"    UNITY_BUILD_BATCH_SIZE {self.unity_batch_size}")
+        else:
+            lines.append("    UNITY_BUILD_MODE GROUP")
+        lines.append(")")
+        for i, group in enumerate(groups or []):
+            lines.append("set_source_files_properties(")
+            lines.extend(f"    {src}" for src in group)
+            lines.append(f"    PROPERTIES UNITY_GROUP {target.cmake_name}_{i}")
+            lines.append(")")
+        if excluded:
+            lines.append("set_source_files_properties(")
+            lines.extend(f"    {src}" for src in excluded)
+            lines.append("    PROPERTIES SKIP_UNITY_BUILD_INCLUSION ON")
+            lines.append(")")
+        return lines
+
+    def _convert_deps_to_cmake(self, bazel_deps: list[str], package: str = "") -> list[str]:
+        """Convert Bazel dependencies to CMake targets"""
+        return self._expand(bazel_deps, package, lambda dep: self._convert_dep(dep, package))
+
+    def _convert_dep(self, dep: str, package: str) -> list[str]:
+        """The CMake target for one Bazel dependency, if it has one"""
+        target = self.graph.resolve(dep, package) if self.graph is not None else None
+        if target is not None:
+            return [target.cmake_name]
+        elif dep.startswith((":", "//")):
+            dep_package, _, name = canonical_label(dep, package)[2:].partition(":")
+            return [cmake_target_name(dep_package, name)]
+        elif "@com_google_googletest//:gtest_main" in dep:
+            return ["GTest::gtest_main"]
+        elif "@com_google_googletest//:gtest" in dep:
+            return ["GTest::gtest"]
+        elif dep.startswith("@"):
+            if "googletest" in dep or "gtest" in dep:
+                if "main" in dep:
+                    return ["GTest::gtest_main"]
+                else:
+                    return ["GTest::gtest"]
+        return []
+
+    def _expand(self, values: Iterable, package: str, convert=lambda value: [value]) -> list[str]:
+        """Convert attribute values, wrapping those of select() branches in generator expressions.
+
+        Each branch's values become $<condition:value>; the default branch
+        applies when none of the other conditions holds.
+        """
+        items = []
+        for value in values:
+            if not isinstance(value, Select):
+                items.extend(convert(value))
+                continue
+            conditions = {condition: self._condition(condition, package)
+                          for condition in value.branches if condition != Select.DEFAULT}
+            for condition, branch in value.branches.items():
+                if condition != Select.DEFAULT:
+                    expression = conditions[condition]
+                elif conditions:
+                    expression = f"$<NOT:$<OR:{','.join(conditions.values())}>>"
+                else:
+                    expression = None
+                for branch_value in branch:
+                    items.extend(f"$<{expression}:{item}>" if expression else item for item in convert(branch_value))
+        return items
+
+    def _condition(self, condition: str, package: str) -> str:
+        """Generator expression for a select() condition label.
+
+        Conditions CMake cannot express become an option() named after
+        the label, e.g. //config:with_tracing -> ${CONFIG_WITH_TRACING}.
+        """
+        label = canonical_label(condition, package)
+        expression = self._known_condition(label)
+        if expression is None:
+            variable = re.sub(r"\W+", "_", label.lstrip("@/")).strip("_").upper()
+            self._condition_variables[variable] = label
+            expression = f"$<BOOL:${{{variable}}}>"
+        return expression
+
+    def _known_condition(self, label: str) -> Optional[str]:
+        if label.startswith("@platforms//os:"):
+            platform = self.PLATFORM_IDS.get(label.rpartition(":")[2])
+            return f"$<PLATFORM_ID:{platform}>" if platform else None
+        setting = self.graph.resolve(label) if self.graph is not None else None
+        if setting is None or setting.rule_type != "config_setting":
+            return None
+        # Every part of a config_setting must hold
+        parts = [self._known_condition(canonical_label(constraint, setting.package))
+                 for constraint in setting.constraint_values]
+        for value in setting.values:
+            key, _, mode = value.partition("=")
+            parts.append(self.COMPILATION_MODES.get(mode) if key == "compilation_mode" else None)
+        if not parts or None in parts:
+            return None
+        return parts[0] if len(parts) == 1 else f"$<AND:{','.join(parts)}>"
 
     def _generate_install_rules(self, library_targets: list[BazelTarget]) -> list[str]:
         """Generate install rules"""
@@ -316,11 +2071,11 @@ class CMakeGenerator:
         for target in library_targets:
             if target.hdrs:
                 lines.append("install(FILES")
-                for hdr in target.hdrs:
+                for hdr in self._expand(target.hdrs, target.package):
                     lines.append(f"    {hdr}")
                 lines.append("    DESTINATION include)")
 
-        target_names = [t.name for t in library_targets]
+        target_names = [t.cmake_name for t in library_targets]
         if target_names:
             lines.append("install(TARGETS")
             for name in target_names:
@@ -334,52 +2089,2067 @@ class CMakeGenerator:
         return lines
 
 
-def main():
+def _ninja_escape(text: str) -> str:
+    """Escape a path for a Ninja build line"""
+    return re.sub(r"([$ :\n])", r"$\1", text)
+
+
+# The same include flags recur for thousands of targets
+_shell_quote = functools.lru_cache(maxsize=None)(shlex.quote)
+
+
+def _ninja_command(arguments: Iterable[str]) -> str:
+    """Shell-quote arguments for a Ninja variable holding part of a command"""
+    return " ".join(map(_shell_quote, arguments)).replace("$", "$$")
+
+
+class NinjaGenerator:
+    """Generates one build.ninja for a whole workspace, skipping CMake.
+
+    Compile flags come from CompileFlags, so objects are built exactly as
+    compile_commands.json describes them. Libraries with sources become
+    static archives; header-only ones only add include paths. Binaries
+    and tests link their own objects plus the archives of everything
+    they depend on, and each test gets a run_<name> target, all of which
+    the phony "test" target runs.
+    """
+
+    # External deps and the linker flags standing in for them, as the
+    # libraries are expected to be installed on the host
+    EXTERNAL_LINK_FLAGS = {"gtest_main": ("-lgtest_main", "-lgtest", "-pthread"), "gtest": ("-lgtest", "-pthread")}
+
+    def __init__(self, project_name: str = "strong_typedefs", build_dir: str = "ninja-out", link_pool_depth: int = 0,
+                 heavy_pool_depth: int = 0, heavy_targets: Iterable[str] = ()):
+        self.project_name = project_name
+        self.build_dir = build_dir
+        # Job pools as in CMakeGenerator: binaries and tests link in one,
+        # heavy targets compile in the other
+        self.link_pool_depth = link_pool_depth
+        self.heavy_pool_depth = heavy_pool_depth
+        self.heavy_targets = frozenset(canonical_label(label, "") for label in heavy_targets)
+        self.cpp_standard = "20"
+        self.ar = os.environ.get("AR", "ar")
+        self.graph: Optional[TargetGraph] = None
+        # Topological index and external link flags of every target, for
+        # the build.ninja being rendered
+        self._order: dict[str, int] = {}
+        self._external_link_flags: dict[str, list[str]] = {}
+
+    def options(self) -> dict:
+        """Settings that affect the generated output"""
+        return {"project_name": self.project_name, "build_dir": self.build_dir, "cpp_standard": self.cpp_standard,
+                "link_pool_depth": self.link_pool_depth, "heavy_pool_depth": self.heavy_pool_depth,
+                "heavy_targets": sorted(self.heavy_targets)}
+
+    def generate_ninja(self, output_path: Path, bazelrc: dict[str, list[str]]) -> bool:
+        """Write build.ninja; returns False if it already had identical content"""
+        return write_if_changed(output_path, self.render_ninja(bazelrc))
+
+    def render_ninja(self, bazelrc: dict[str, list[str]]) -> str:
+        """Render build.ninja for every target in the graph; header-only libraries get no edges"""
+        flags = CompileFlags(self.graph, bazelrc, self.cpp_standard)
+        cxx, cc = flags.compiler("x.cc"), flags.compiler("x.c")
+        lines = [
+            f"# Generated by bazel_to_cmake.py for {self.project_name}; do not edit",
+            "ninja_required_version = 1.3",
+            f"builddir = {_ninja_escape(self.build_dir)}",
+            f"cxx = {_ninja_command(cxx[:1])}",
+            f"cxxflags = {_ninja_command(cxx[1:])}",
+            f"cc = {_ninja_command(cc[:1])}",
+            f"cflags = {_ninja_command(cc[1:])}",
+            f"ar = {_ninja_command([self.ar])}",
+            f"linkflags = {_ninja_command(bazelrc['linkopt'])}",
+            "",
+            "rule cxx",
+            "  command = $cxx $cxxflags $flags -MD -MF $out.d -c $in -o $out",
+            "  depfile = $out.d",
+            "  deps = gcc",
+            "  description = CXX $out",
+            "rule cc",
+            "  command = $cc $cflags $flags -MD -MF $out.d -c $in -o $out",
+            "  depfile = $out.d",
+            "  deps = gcc",
+            "  description = CC $out",
+            "rule ar",
+            "  command = rm -f $out && $ar crs $out $in",
+            "  description = AR $out",
+            "rule link",
+            "  command = $cxx $in -o $out $linkflags $libs",
+            "  description = LINK $out",
+            "rule run",
+            "  command = $in",
+            "  description = TEST $in",
+            "",
+        ]
+        for pool, depth in ((CMakeGenerator.LINK_POOL, self.link_pool_depth),
+                            (CMakeGenerator.HEAVY_POOL, self.heavy_pool_depth)):
+            if depth:
+                lines.extend([f"pool {pool}", f"  depth = {depth}", ""])
+
+        # Archive of every library with sources, known up front since
+        # packages are not emitted dependencies-first
+        archives = {label: self._output_path(target.package, f"lib{target.name}.a")
+                    for label, target in self.graph.targets.items()
+                    if target.rule_type == "cc_library" and flags.sources(target)}
+        self._order = {label: i for i, label in enumerate(self.graph.topological_order())}
+        self._external_link_flags = {
+            label: [flag for dep in flatten(target.deps) if dep.startswith("@")
+                    for flag in self.EXTERNAL_LINK_FLAGS.get(dep.rpartition(":")[2], ())]
+            for label, target in self.graph.targets.items()
+        }
+        outputs, tests = [], []
+        for labels in self.graph.packages.values():
+            for label in labels:
+                target = self.graph.targets[label]
+                if not target.rule_type.startswith("cc_") or (target.rule_type == "cc_library" and label not in archives):
+                    continue
+                lines.append(f"# {target.rule_type}: {label}")
+                objects = self._generate_objects(target, flags, len(outputs), lines)
+                if target.rule_type == "cc_library":
+                    output = archives[label]
+                    lines.append(f"build {output}: ar {' '.join(objects)}")
+                else:
+                    output = self._output_path(target.package, target.name)
+                    libs, link_flags = self._link_inputs(label, archives)
+                    lines.append(f"build {output}: link {' '.join(objects + libs)}")
+                    if link_flags:
+                        lines.append(f"  libs = {_ninja_command(link_flags)}")
+                    if self.link_pool_depth:
+                        lines.append(f"  pool = {CMakeGenerator.LINK_POOL}")
+                    if target.rule_type == "cc_test":
+                        # Named after the CMake target, as both generators name targets alike
+                        tests.append(f"run_{_ninja_escape(target.cmake_name)}")
+                        lines.append(f"build {tests[-1]}: run {output}")
+                outputs.append(output)
+                lines.append("")
+
+        lines.append(f"build all: phony {' '.join(outputs)}")
+        lines.append(f"build test: phony {' '.join(tests)}")
+        lines.append("default all")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _output_path(*parts: str) -> str:
+        """Escaped path of a build output under $builddir"""
+        return "$builddir/" + _ninja_escape(posixpath.join(*parts))
+
+    def _generate_objects(self, target: BazelTarget, flags: "CompileFlags", index: int, lines: list[str]) -> list[str]:
+        """Append compile edges for the target's sources; returns the object paths"""
+        sources = flags.sources(target)
+        if not sources:
+            return []
+        # Flags are shared by all of a target's sources, so they are written once
+        variable = f"flags_{index}"
+        lines.append(f"{variable} = {_ninja_command(flags.target_flags(target))}")
+        heavy = self.heavy_pool_depth and CMakeGenerator.is_heavy(target, self.heavy_targets)
+        objects = []
+        for src in sources:
+            obj = self._output_path(target.package, "_objs", target.name, src + ".o")
+            rule = "cc" if src.endswith(CompileFlags.C_EXTENSIONS) else "cxx"
+            lines.append(f"build {obj}: {rule} {_ninja_escape(posixpath.join(target.package, src))}")
+            lines.append(f"  flags = ${variable}")
+            if heavy:
+                lines.append(f"  pool = {CMakeGenerator.HEAVY_POOL}")
+            objects.append(obj)
+        return objects
+
+    def _link_inputs(self, label: str, archives: dict[str, str]) -> tuple[list[str], list[str]]:
+        """Archives of everything `label` depends on, dependents first, and flags for external deps"""
+        closure, stack = {label}, [label]
+        while stack:
+            for dep in self.graph.edges[stack.pop()]:
+                if dep not in closure and dep in self.graph.targets:
+                    closure.add(dep)
+                    stack.append(dep)
+        libs, link_flags = [], []
+        for dep in sorted(closure, key=self._order.__getitem__, reverse=True):
+            if dep in archives:
+                libs.append(archives[dep])
+            link_flags.extend(self._external_link_flags.get(dep, ()))
+        return libs, list(dict.fromkeys(link_flags))
+
+
+@contextlib.contextmanager
+def atomic_open(path: Path):
+    """Open a temporary file next to `path` that replaces it on success.
+
+    Readers never observe a half-written file, and a failed write leaves
+    the previous content in place.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as f:
+            yield f
+        # mkstemp creates files as 0600; keep the mode of the file being replaced
+        mode = path.stat().st_mode & 0o777 if path.exists() else 0o644
+        os.chmod(tmp_name, mode)
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def write_if_changed(path: Path, content: str) -> bool:
+    """Atomically write `content` unless `path` already holds it; return whether it was written"""
+    try:
+        if path.read_bytes() == content.encode("utf-8"):
+            return False
+    except OSError:
+        pass
+
+    with atomic_open(path) as f:
+        f.write(content)
+    return True
+
+
+def find_build_files(workspace_root: Path) -> list[Path]:
+    """Find one BUILD file per package under a workspace root, in sorted order"""
+    build_files = []
+
+    for dirpath, dirnames, filenames in os.walk(workspace_root):
+        # Skip hidden directories and Bazel's output symlinks
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith((".", "bazel-")))
+        for name in BUILD_FILE_NAMES:
+            if name in filenames:
+                build_files.append(Path(dirpath) / name)
+                break
+
+    return build_files
+
+
+def find_workspace_root(directory: Path) -> Optional[Path]:
+    """Nearest directory at or above `directory` holding a MODULE.bazel or WORKSPACE file"""
+    directory = directory.resolve()
+    for candidate in (directory, *directory.parents):
+        if any((candidate / name).is_file() for name in WORKSPACE_FILE_NAMES):
+            return candidate
+    return None
+
+
+def package_name(package_dir: Path) -> str:
+    """Bazel package name of a workspace-relative directory ("" for the root)"""
+    return "" if package_dir == Path(".") else package_dir.as_posix()
+
+
+_LOAD_RE = re.compile(r"""^\s*load\(\s*["']([^"']+)["']""", re.M)
+
+
+def bzl_path(label: str, package: str) -> Optional[Path]:
+    """Workspace-relative path of a loaded .bzl label, or None for external repositories"""
+    label = canonical_label(label, package)
+    if label.startswith("@"):
+        return None
+    package, _, name = label[2:].partition(":")
+    return Path(package or ".") / name
+
+
+def loaded_bzl_files(content: str, package_dir: Path) -> set[Path]:
+    """Workspace-relative .bzl files a BUILD or .bzl file loads directly"""
+    paths = (bzl_path(label, package_name(package_dir)) for label in _LOAD_RE.findall(content))
+    return {path for path in paths if path is not None}
+
+
+class BzlModules:
+    """The .bzl files of one run, each evaluated at most once per process.
+
+    Exported symbols (top-level names not starting with "_") are kept in
+    a module table by workspace-relative path, so a macro file loaded by
+    thousands of packages is evaluated once. Macros call native rules on
+    whichever BazelParser is evaluating a BUILD file at the time.
+    """
+
+    def __init__(self, workspace_root: Path):
+        self.workspace_root = workspace_root
+        self.exports: dict[Path, dict] = {}
+        self.evaluations = 0
+        self._sources: dict[Path, Optional[str]] = {}
+        self._loading: list[Path] = []
+
+    def __getstate__(self):
+        # Evaluated modules hold syntax trees and closures; a parse worker
+        # that is not forked evaluates the files again itself
+        return {"workspace_root": self.workspace_root}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state["workspace_root"])
+
+    def _read(self, path: Path) -> Optional[str]:
+        try:
+            return (self.workspace_root / path).read_text()
+        except OSError:
+            return None
+
+    def source(self, path: Path) -> Optional[str]:
+        """Content of a .bzl file as first read in this run, None if missing"""
+        if path not in self._sources:
+            self._sources[path] = self._read(path)
+        return self._sources[path]
+
+    def closure(self, paths: Iterable[Path]) -> set[Path]:
+        """The given .bzl files and every .bzl file they load, transitively"""
+        found = set()
+        pending = list(paths)
+        while pending:
+            path = pending.pop()
+            if path not in found:
+                found.add(path)
+                pending.extend(loaded_bzl_files(self.source(path) or "", path.parent))
+        return found
+
+    def digest(self, paths: Iterable[Path]) -> str:
+        """Hash of the given .bzl files and everything they load, for cache keys"""
+        digest = hashlib.sha256()
+        for path in sorted(self.closure(paths)):
+            digest.update(f"{path.as_posix()}\0{self.source(path)}\0".encode())
+        return digest.hexdigest()
+
+    def stale(self) -> set[Path]:
+        """Files read in this run whose content has changed on disk since"""
+        return {path for path, source in self._sources.items() if self._read(path) != source}
+
+    def load(self, path: Path) -> dict:
+        """Exported symbols of a .bzl file, evaluating it on first use"""
+        exports = self.exports.get(path)
+        if exports is not None:
+            return exports
+        if path in self._loading:
+            raise ValueError("load cycle: " + " -> ".join(p.as_posix() for p in self._loading + [path]))
+        source = self.source(path)
+        if source is None:
+            raise ValueError(f"cannot load {path.as_posix()}: file not found")
+
+        filename = str(self.workspace_root / path)
+        evaluator = _StarlarkEvaluator(filename)
+        env = evaluator.builtins()
+        env["native"] = _NATIVE
+        env["load"] = functools.partial(self.load_into, env, package_name(path.parent))
+        predefined = set(env)
+        self._loading.append(path)
+        try:
+            evaluator.run(_parse_starlark(source, filename), env)
+        finally:
+            self._loading.pop()
+        self.evaluations += 1
+
+        exports = {name: value for name, value in env.items()
+                   if name not in predefined and not name.startswith("_")}
+        self.exports[path] = exports
+        return exports
+
+    def load_into(self, env: dict, package: str, label: str, *names: str, **aliases: str):
+        """load(label, *names, **aliases): bind symbols of a .bzl file in `env`.
+
+        Of external repositories only native rules can be bound (e.g.
+        cc_library from @rules_cc//cc:defs.bzl); other symbols are skipped.
+        """
+        path = bzl_path(label, package)
+        if path is None:
+            self.bind_native(env, names, aliases)
+            return
+        symbols = dict(zip(names, names))
+        symbols.update(aliases)
+        exports = self.load(path)
+        for local, name in symbols.items():
+            if name not in exports:
+                raise ValueError(f"{label} does not export '{name}'")
+            env[local] = exports[name]
+
+    @staticmethod
+    def bind_native(env: dict, names: tuple, aliases: dict):
+        """Bind the native rules among the symbols loaded from an external repository"""
+        symbols = dict(zip(names, names))
+        symbols.update(aliases)
+        for local, name in symbols.items():
+            if name in BazelParser.RULES:
+                env[local] = _NATIVE.fields[name]
+
+
+@functools.lru_cache(maxsize=None)
+def _glob_regex(pattern: str) -> "re.Pattern[str]":
+    """Compile a glob() pattern: `*` matches within one path segment, `**` any number of segments"""
+    segments = pattern.split("/")
+    if any(segment in ("", ".", "..") for segment in segments):
+        raise ValueError(f"invalid glob pattern '{pattern}'")
+    parts = []
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == "**":
+            parts.append(".*" if last else "(?:[^/]+/)*")
+        elif "**" in segment:
+            raise ValueError(f"invalid glob pattern '{pattern}': '**' must be a whole path segment")
+        else:
+            parts.append("[^/]*".join(map(re.escape, segment.split("*"))) + ("" if last else "/"))
+    return re.compile("".join(parts))
+
+
+def uses_glob(content: str) -> bool:
+    """Whether a BUILD file may call glob() and so depends on the files next to it"""
+    return "glob" in content
+
+
+class WorkspaceSnapshot:
+    """One os.scandir listing of a workspace, shared by every glob() call.
+
+    The tree is listed once up front. Each package's file list and each
+    (package, pattern) match are computed on first use and memoized, so
+    glob() never touches the file system.
+    """
+
+    def __init__(self, workspace_root: Path):
+        self.workspace_root = workspace_root
+        # Workspace-relative directory ("" for the root) -> (file names, subdirectory names)
+        self.listings: dict[str, tuple[tuple[str, ...], tuple[str, ...]]] = {}
+        self._package_files: dict[str, tuple[tuple[str, bool], ...]] = {}
+        self._matches: dict[tuple[str, str, bool], frozenset[str]] = {}
+        self._scan("")
+
+    def _scan(self, directory: str):
+        pending = [directory]
+        while pending:
+            directory = pending.pop()
+            files, subdirectories = [], []
+            with contextlib.suppress(OSError), os.scandir(self.workspace_root / directory) as entries:
+                for entry in entries:
+                    if not entry.is_dir(follow_symlinks=False):
+                        files.append(entry.name)
+                    elif not entry.name.startswith((".", "bazel-")):
+                        # Same directories find_build_files() skips
+                        subdirectories.append(entry.name)
+            # Our own outputs, written to the root and next to each BUILD
+            # file, must not change what the next run globs; CMakeLists.txt
+            # files elsewhere are hand-written sources like any other
+            if not directory or any(name in files for name in BUILD_FILE_NAMES):
+                files = [name for name in files if name != "CMakeLists.txt"]
+            self.listings[directory] = (tuple(sorted(files)), tuple(sorted(subdirectories)))
+            pending.extend(f"{directory}/{name}" if directory else name for name in subdirectories)
+
+    def rescan(self, directory: str):
+        """List a workspace-relative directory tree again after files under it changed"""
+        prefix = directory + "/" if directory else ""
+        for listed in [d for d in self.listings if d == directory or d.startswith(prefix)]:
+            del self.listings[listed]
+        self._package_files.clear()
+        self._matches.clear()
+        self._scan(directory)
+
+    def package_files(self, package: str) -> tuple[tuple[str, bool], ...]:
+        """Sorted (path, is_directory) pairs below a package, relative to it.
+
+        As in Bazel, subpackages (directories with their own BUILD file)
+        are not entered.
+        """
+        entries = self._package_files.get(package)
+        if entries is not None:
+            return entries
+        found = []
+        pending = [""]
+        while pending:
+            relative = pending.pop()
+            directory = "/".join(part for part in (package, relative) if part)
+            files, subdirectories = self.listings.get(directory, ((), ()))
+            found.extend((f"{relative}/{name}" if relative else name, False) for name in files)
+            for name in subdirectories:
+                subdirectory_files = self.listings.get(f"{directory}/{name}" if directory else name, ((), ()))[0]
+                if any(build_file in subdirectory_files for build_file in BUILD_FILE_NAMES):
+                    continue
+                path = f"{relative}/{name}" if relative else name
+                found.append((path, True))
+                pending.append(path)
+        entries = self._package_files[package] = tuple(sorted(found))
+        return entries
+
+    def glob(self, package: str, include: list[str], exclude: list[str] = (),
+             exclude_directories: int = 1) -> list[str]:
+        """Sorted paths below `package` matching `include` but not `exclude`"""
+        if isinstance(include, str) or isinstance(exclude, str):
+            raise TypeError("glob() patterns must be a list of strings")
+        matched = set()
+        for pattern in include:
+            matched |= self._match(package, pattern, bool(exclude_directories))
+        for pattern in exclude:
+            matched -= self._match(package, pattern, False)
+        return sorted(matched)
+
+    def _match(self, package: str, pattern: str, files_only: bool) -> frozenset[str]:
+        key = (package, pattern, files_only)
+        matches = self._matches.get(key)
+        if matches is None:
+            regex = _glob_regex(pattern)
+            matches = self._matches[key] = frozenset(
+                path for path, is_directory in self.package_files(package)
+                if not (files_only and is_directory) and regex.fullmatch(path))
+        return matches
+
+
+class PhaseTimer:
+    """Wall and CPU time per conversion phase, plus optional trace events.
+
+    Trace events use the Chrome trace-event format, so a run can be loaded
+    in chrome://tracing or Perfetto.
+    """
+
+    def __init__(self):
+        self.phases: dict[str, dict] = {}
+        self.events: list[dict] = []
+        self._origin = time.perf_counter()
+
+    @staticmethod
+    def _cpu_time() -> float:
+        # Includes reaped child processes, i.e. finished parse workers
+        times = os.times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time a phase; the yielded dict's "count" is reported alongside it"""
+        stats = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "count": 0})
+        counts = {"count": 0}
+        wall_started, cpu_started = time.perf_counter(), self._cpu_time()
+        try:
+            yield counts
+        finally:
+            finished = time.perf_counter()
+            stats["wall"] += finished - wall_started
+            stats["cpu"] += self._cpu_time() - cpu_started
+            stats["count"] += counts["count"]
+            self.span(name, wall_started, finished, category="phase", args=dict(counts))
+
+    def span(self, name: str, started: float, finished: float, pid: Optional[int] = None,
+             category: str = "file", args: Optional[dict] = None):
+        """Record a trace event between two time.perf_counter() readings"""
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (started - self._origin) * 1e6,
+            "dur": (finished - started) * 1e6,
+            "pid": pid if pid is not None else os.getpid(),
+            "tid": 0,
+            "args": args or {},
+        })
+
+    def report(self) -> list[str]:
+        """Lines of a per-phase timing table"""
+        lines = [f"{'phase':<10} {'wall ms':>10} {'cpu ms':>10} {'count':>8}"]
+        for name, stats in self.phases.items():
+            lines.append(f"{name:<10} {stats['wall'] * 1000:10.1f} {stats['cpu'] * 1000:10.1f} "
+                         f"{stats['count']:8d}")
+        return lines
+
+    def write_trace(self, path: Path):
+        """Write the recorded events as a Chrome trace JSON file"""
+        with atomic_open(path) as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+# Snapshot glob() uses and .bzl module table load() uses in a parse
+# worker, set once per worker by _init_parse_worker()
+_worker_snapshot: Optional[WorkspaceSnapshot] = None
+_worker_modules: Optional[BzlModules] = None
+
+
+def _init_parse_worker(snapshot: Optional[WorkspaceSnapshot], modules: Optional[BzlModules]):
+    global _worker_snapshot, _worker_modules
+    _worker_snapshot = snapshot
+    _worker_modules = modules
+
+
+def _parse_build_source(source: tuple[str, str, str]) -> tuple[list[BazelTarget], float, float, int]:
+    """Parse one (content, filename, package) with a fresh parser (process pool worker).
+
+    Returns the targets with the start and end time.perf_counter() readings
+    and the worker's pid, for tracing.
+    """
+    content, filename, package = source
+    started = time.perf_counter()
+    targets = BazelParser(snapshot=_worker_snapshot, modules=_worker_modules).parse_string(content, filename, package)
+    return targets, started, time.perf_counter(), os.getpid()
+
+
+def parse_build_files(build_files: list[Path], jobs: int = 1,
+                      contents: Optional[list[str]] = None,
+                      workspace_root: Optional[Path] = None,
+                      timer: Optional[PhaseTimer] = None,
+                      snapshot: Optional[WorkspaceSnapshot] = None,
+                      modules: Optional[BzlModules] = None) -> list[list[BazelTarget]]:
+    """Parse BUILD files, fanning out across `jobs` processes.
+
+    `contents` may supply already-read file contents. Package names are
+    taken relative to `workspace_root`; without one every file is parsed
+    as the root package. glob() matches against `snapshot`, which is
+    taken here if any file needs one and handed to every worker once;
+    load() evaluates .bzl files into `modules`, shared the same way.
+    Results are returned in the order of
+    `build_files` regardless of which worker finished first, so the
+    generated output is deterministic. Each file's parse is recorded as a
+    trace span on `timer`.
+    """
+    if contents is None:
+        contents = [build_file.read_text() for build_file in build_files]
+    packages = [package_name(build_file.parent.relative_to(workspace_root)) if workspace_root else ""
+                for build_file in build_files]
+    sources = [(content, str(build_file), package)
+               for content, build_file, package in zip(contents, build_files, packages)]
+
+    if snapshot is None and workspace_root is not None and any(map(uses_glob, contents)):
+        snapshot = WorkspaceSnapshot(workspace_root)
+    if modules is None and workspace_root is not None:
+        modules = BzlModules(workspace_root)
+
+    if jobs <= 1 or len(sources) <= 1:
+        _init_parse_worker(snapshot, modules)
+        try:
+            results = [_parse_build_source(source) for source in sources]
+        finally:
+            _init_parse_worker(None, None)
+    else:
+        if modules is not None and multiprocessing.get_start_method() == "fork":
+            # Evaluate the loaded .bzl files once here so forked workers
+            # inherit them; failures are reported by the worker that hits them
+            for path in set().union(*(loaded_bzl_files(content, Path(package or "."))
+                                      for content, package in zip(contents, packages))):
+                with contextlib.suppress(SyntaxError, StarlarkError, ValueError):
+                    modules.load(path)
+        # Batch files per task so small BUILD files don't drown in IPC overhead
+        chunksize = max(1, len(sources) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_parse_worker,
+                                 initargs=(snapshot, modules)) as executor:
+            results = list(executor.map(_parse_build_source, sources, chunksize=chunksize))
+
+    if timer is not None:
+        for (targets, started, finished, pid), build_file in zip(results, build_files):
+            timer.span(str(build_file), started, finished, pid, args={"targets": len(targets)})
+    return [targets for targets, _, _, _ in results]
+
+
+@functools.lru_cache(maxsize=None)
+def converter_version() -> str:
+    """Digest of this module's source, so cache entries die with code changes"""
+    return hashlib.sha256(Path(__file__).read_bytes()).hexdigest()
+
+
+class ConversionCache:
+    """On-disk cache of parsed targets and generated CMake text per BUILD file.
+
+    Entries are keyed by the BUILD file content, the converter version and
+    the generator options. The generated text is additionally tagged with
+    the package's context (subdirectories, hoisted external deps) and is
+    only reused when that context is unchanged.
+    """
+
+    def __init__(self, cache_dir: Path, options: dict):
+        self.cache_dir = cache_dir
+        self._salt = (converter_version() + json.dumps(options, sort_keys=True, default=str)).encode()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, content: str, inputs: Iterable[str] = ()) -> str:
+        """Cache key for a BUILD file's content and anything else its targets depend on"""
+        digest = hashlib.sha256(self._salt)
+        digest.update(b"\0")
+        digest.update(content.encode())
+        for value in inputs:
+            digest.update(b"\0")
+            digest.update(value.encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def load(self, key: str) -> Optional[dict]:
+        """Return the stored entry, or None if missing or unreadable"""
+        try:
+            with open(self._path(key), 'r') as f:
+                entry = json.load(f)
+            entry["targets"] = [BazelTarget.from_dict(t) for t in entry["targets"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def store(self, key: str, targets: list[BazelTarget], context: str, cmake_text: str):
+        """Store an entry, replacing any previous one atomically"""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        entry = {
+            "targets": [t.to_dict() for t in targets],
+            "context": context,
+            "cmake": cmake_text,
+        }
+        with atomic_open(path) as f:
+            json.dump(entry, f)
+
+
+class WorkspaceConverter:
+    """Converts every Bazel package under a workspace root in one process.
+
+    Parsed targets, the target graph and the rendered text of every package
+    are kept after convert(), so refresh() can re-convert a few packages
+    without touching the rest of the workspace.
+    """
+
+    def __init__(self, workspace_root: Path, generator: CMakeGenerator, jobs: int = 1,
+                 cache: Optional[ConversionCache] = None, timer: Optional[PhaseTimer] = None):
+        self.workspace_root = workspace_root
+        self.generator = generator
+        self.jobs = jobs
+        self.cache = cache
+        self.timer = timer or PhaseTimer()
+        self.packages: dict[Path, list[BazelTarget]] = {}
+        self.outputs: list[Path] = []
+        self.contents: dict[Path, str] = {}
+        self.layout: dict[Path, list[str]] = {}
+        self.rendered: dict[Path, str] = {}
+        self.external_deps: dict[Path, set[str]] = {}
+        # Which packages load each .bzl file, to know what a .bzl edit affects
+        self.bzl_dependents: dict[Path, set[Path]] = collections.defaultdict(set)
+        # Taken once per conversion if any BUILD file globs
+        self.snapshot: Optional[WorkspaceSnapshot] = None
+        self.modules = BzlModules(workspace_root)
+        generator.source_root = workspace_root
+
+    def convert(self) -> list[Path]:
+        """Parse all packages and write a CMakeLists.txt next to each BUILD file.
+
+        Returns the outputs whose content changed; identical files are not
+        rewritten. All outputs are recorded in `self.outputs`.
+        """
+        entries = self.parse()
+        if not self.packages:
+            return []
+
+        with self.timer.phase("generate") as stats:
+            self.layout = self.generator.workspace_layout(list(self.packages))
+            for package_dir in self.layout:
+                self.rendered[package_dir] = self._render(package_dir, entries.get(package_dir))
+            stats["count"] = len(self.rendered)
+
+        with self.timer.phase("write") as stats:
+            self.outputs = [self.workspace_root / package_dir / "CMakeLists.txt" for package_dir in self.layout]
+            written = self._write(self.layout)
+            stats["count"] = len(written)
+
+        return written
+
+    def parse(self) -> dict[Path, dict]:
+        """Parse all packages into `self.packages` and resolve the target graph.
+
+        Returns the cache entries of packages that were not re-parsed, so
+        convert() can reuse their rendered text too.
+        """
+        with self.timer.phase("discover") as stats:
+            build_files = find_build_files(self.workspace_root)
+            stats["count"] = len(build_files)
+        self.packages, self.contents, self.layout, self.rendered, self.external_deps = {}, {}, {}, {}, {}
+        self.bzl_dependents.clear()
+        self.outputs = []
+        if not build_files:
+            return {}
+        package_dirs = [build_file.parent.relative_to(self.workspace_root) for build_file in build_files]
+
+        with self.timer.phase("read") as stats:
+            contents = [build_file.read_text() for build_file in build_files]
+            self.contents = dict(zip(package_dirs, contents))
+            self.snapshot = WorkspaceSnapshot(self.workspace_root) if any(map(uses_glob, contents)) else None
+            self.modules = BzlModules(self.workspace_root)
+            stats["count"] = len(contents)
+
+        with self.timer.phase("parse") as stats:
+            # Only BUILD files without a cache entry need to be evaluated
+            entries: dict[Path, dict] = {}
+            if self.cache is not None:
+                for package_dir in package_dirs:
+                    entry = self.cache.load(self._cache_key(package_dir))
+                    if entry is not None:
+                        entries[package_dir] = entry
+            stale = [i for i, package_dir in enumerate(package_dirs) if package_dir not in entries]
+            parsed = parse_build_files([build_files[i] for i in stale], self.jobs,
+                                       [contents[i] for i in stale], self.workspace_root, self.timer,
+                                       self.snapshot, self.modules)
+            stats["count"] = len(stale)
+
+        parsed_packages = dict(zip((package_dirs[i] for i in stale), parsed))
+        self.packages = {
+            package_dir: entries[package_dir]["targets"] if package_dir in entries else parsed_packages[package_dir]
+            for package_dir in package_dirs
+        }
+        for package_dir, content in self.contents.items():
+            for path in self.modules.closure(loaded_bzl_files(content, package_dir)):
+                self.bzl_dependents[path].add(package_dir)
+
+        with self.timer.phase("resolve") as stats:
+            all_targets = [t for targets in self.packages.values() for t in targets]
+            self.generator.graph = TargetGraph(all_targets)
+            self.generator.invalidate()
+            errors = self.generator.graph.errors()
+            if errors:
+                raise ConversionError("\n".join(errors))
+            self.external_deps = {package_dir: self.generator._find_external_deps(targets)
+                                  for package_dir, targets in self.packages.items()}
+            stats["count"] = len(all_targets)
+
+        return entries
+
+    def refresh(self, package_dirs: Iterable[Path], force: Iterable[Path] = ()) -> list[Path]:
+        """Re-convert the given workspace-relative packages after an edit.
+
+        Packages may be new or deleted. Packages whose BUILD file is
+        unchanged are skipped unless listed in `force`, e.g. because a .bzl
+        file they load changed. Only the outputs the edit can affect
+        are rendered again: the packages themselves, packages with targets
+        depending on them, parents whose subdirectories changed and the root
+        when the set of external dependencies changed. Returns the outputs
+        whose content changed.
+        """
+        graph = self.generator.graph
+        if graph is None:
+            raise ConversionError("refresh() needs a prior convert()")
+
+        with self.timer.phase("read") as stats:
+            changed: dict[Path, tuple[Optional[Path], Optional[str]]] = {}
+            force = set(map(Path, force))
+            # Packages loading an edited .bzl file must be evaluated again
+            stale = self.modules.stale()
+            if stale:
+                force.update(package_dir for path in stale for package_dir in self.bzl_dependents.get(path, ()))
+                self.modules = BzlModules(self.workspace_root)
+            for package_dir in {*map(Path, package_dirs), *force}:
+                build_file = next((self.workspace_root / package_dir / name for name in BUILD_FILE_NAMES
+                                   if (self.workspace_root / package_dir / name).is_file()), None)
+                content = build_file.read_text() if build_file is not None else None
+                if content != self.contents.get(package_dir) or (package_dir in force and content is not None):
+                    changed[package_dir] = (build_file, content)
+            stats["count"] = len(changed)
+        if not changed:
+            return []
+
+        with self.timer.phase("parse") as stats:
+            present = [package_dir for package_dir, (_, content) in changed.items() if content is not None]
+            # Pick up source files added or removed next to the changed BUILD files
+            if self.snapshot is not None:
+                for package_dir in present:
+                    self.snapshot.rescan(package_name(package_dir))
+            elif any(uses_glob(changed[package_dir][1]) for package_dir in present):
+                self.snapshot = WorkspaceSnapshot(self.workspace_root)
+            parsed = parse_build_files([changed[package_dir][0] for package_dir in present], 1,
+                                       [changed[package_dir][1] for package_dir in present],
+                                       self.workspace_root, self.timer, self.snapshot, self.modules)
+            stats["count"] = len(present)
+        parsed_packages = dict(zip(present, parsed))
+
+        with self.timer.phase("resolve") as stats:
+            root_deps = set().union(*self.external_deps.values())
+            precompile_plan = self.generator.precompile_plan()
+            affected: set[str] = set()
+            for package_dir, (_, content) in changed.items():
+                for dependents in self.bzl_dependents.values():
+                    dependents.discard(package_dir)
+                for path in self.modules.closure(loaded_bzl_files(content or "", package_dir)):
+                    self.bzl_dependents[path].add(package_dir)
+                targets = parsed_packages.get(package_dir)
+                if targets is None:
+                    self.packages.pop(package_dir, None)
+                    self.contents.pop(package_dir, None)
+                    self.external_deps.pop(package_dir, None)
+                else:
+                    self.packages[package_dir] = targets
+                    self.contents[package_dir] = content
+                    self.external_deps[package_dir] = self.generator._find_external_deps(targets)
+                affected |= graph.replace_package(package_name(package_dir), targets or [])
+            self.generator.invalidate()
+            # State stays updated on error, so fixing the BUILD file and
+            # refreshing again recovers
+            errors = graph.errors(affected)
+            if errors:
+                raise ConversionError("\n".join(errors))
+            stats["count"] = len(affected)
+
+        with self.timer.phase("generate") as stats:
+            dirty = set(changed)
+            dirty.update(Path(graph.targets[label].package or ".") for label in affected if label in graph.targets)
+            if set().union(*self.external_deps.values()) != root_deps:
+                dirty.add(Path("."))
+            # A PCH can be shared with targets anywhere in the workspace
+            new_plan = self.generator.precompile_plan()
+            dirty.update(Path(graph.targets[label].package or ".") for label in precompile_plan.keys() | new_plan.keys()
+                         if label in graph.targets and precompile_plan.get(label) != new_plan.get(label))
+            # Only added or deleted packages change which subdirectories are added
+            if any((package_dir in self.layout) != (package_dir in self.packages) for package_dir in changed):
+                layout = self.generator.workspace_layout(list(self.packages))
+                dirty.update(package_dir for package_dir, subdirectories in layout.items()
+                             if self.layout.get(package_dir) != subdirectories)
+                for package_dir in set(self.rendered) - set(layout):
+                    del self.rendered[package_dir]
+                self.layout = layout
+                self.outputs = [self.workspace_root / package_dir / "CMakeLists.txt" for package_dir in layout]
+            dirty &= set(self.layout)
+            for package_dir in dirty:
+                self.rendered[package_dir] = self._render(package_dir)
+            stats["count"] = len(dirty)
+
+        with self.timer.phase("write") as stats:
+            written = self._write(dirty)
+            stats["count"] = len(written)
+
+        return written
+
+    def _render(self, package_dir: Path, entry: Optional[dict] = None) -> str:
+        """CMakeLists.txt text for one package, reusing a matching cache entry"""
+        graph = self.generator.graph
+        subdirectories = self.layout[package_dir]
+        is_root = package_dir == Path(".")
+        targets = self.packages.get(package_dir, [])
+        external_deps = set().union(*self.external_deps.values()) if is_root else None
+        # Target order, resolved deps, select() conditions and shared PCHs
+        # depend on other packages too, and unity groups on source sizes
+        precompile_plan = self.generator.precompile_plan()
+        context = json.dumps([
+            subdirectories,
+            sorted(external_deps) if is_root else None,
+            [[t.name] + self.generator._convert_deps_to_cmake(t.deps, t.package)
+             + [self.generator._condition(c, t.package) for c in t.conditions()]
+             + [precompile_plan.get(t.label), self.generator.unity_groups(t)]
+             for t in graph.sort_targets(targets)],
+        ])
+        if entry is not None and entry["context"] == context:
+            return entry["cmake"]
+        content = self.generator.render_cmake(targets, subdirectories, is_root=is_root,
+                                              external_deps=external_deps)
+        if self.cache is not None and package_dir in self.contents:
+            self.cache.store(self._cache_key(package_dir), targets, context, content)
+        return content
+
+    def _cache_key(self, package_dir: Path) -> str:
+        # Targets also depend on their package, the files a BUILD file
+        # globs and the .bzl files it loads
+        content = self.contents[package_dir]
+        inputs = [package_name(package_dir)]
+        if self.snapshot is not None and uses_glob(content):
+            inputs.extend(path for path, _ in self.snapshot.package_files(package_name(package_dir)))
+        loads = loaded_bzl_files(content, package_dir)
+        if loads:
+            inputs.append(self.modules.digest(loads))
+        return self.cache.key(content, inputs)
+
+    def _write(self, package_dirs: Iterable[Path]) -> list[Path]:
+        """Write the rendered text of the given packages, skipping identical files"""
+        return [self.workspace_root / package_dir / "CMakeLists.txt" for package_dir in sorted(package_dirs)
+                if write_if_changed(self.workspace_root / package_dir / "CMakeLists.txt",
+                                    self.rendered[package_dir])]
+
+
+def read_bazelrc(workspace_root: Path) -> dict[str, list[str]]:
+    """Compiler and linker flags set for every build by the workspace .bazelrc.
+
+    Collects --copt, --cxxopt, --conlyopt and --linkopt from `build` and
+    `common` lines, following import and try-import. Named configs
+    (build:asan) only apply with --config, so they are skipped.
+    """
+    flags: dict[str, list[str]] = {"copt": [], "cxxopt": [], "conlyopt": [], "linkopt": []}
+    seen: set[Path] = set()
+
+    def read(path: Path, required: bool):
+        if path in seen:
+            return
+        seen.add(path)
+        try:
+            text = path.read_text()
+        except OSError:
+            if required:
+                raise
+            return
+        for line in text.replace("\\\n", " ").splitlines():
+            words = shlex.split(line, comments=True)
+            if not words:
+                continue
+            if words[0] in ("import", "try-import") and len(words) == 2:
+                read(Path(words[1].replace("%workspace%", str(workspace_root))), words[0] == "import")
+            elif words[0] in ("build", "common"):
+                options = iter(words[1:])
+                for option in options:
+                    name, separator, value = option.partition("=")
+                    if name[2:] in flags and option.startswith("--"):
+                        flags[name[2:]].append(value if separator else next(options, ""))
+
+    read(workspace_root / ".bazelrc", False)
+    return flags
+
+
+class CompileFlags:
+    """Compiler arguments for parsed targets, as Bazel would pass them.
+
+    Each source file is compiled with the .bazelrc flags, the target's
+    copts and local_defines, and the defines and include directories of
+    the target and everything it depends on, as Bazel propagates them.
+    Package directories are on the include path like in the generated
+    CMake targets. Paths are relative to the workspace root.
+
+    select()ed flags are resolved for the host: @platforms//os conditions
+    and config_settings made of them hold when they match it, the
+    compilation mode is fastbuild and no --define is set.
+    """
+
+    CXX_EXTENSIONS = (".cc", ".cpp", ".cxx", ".c++", ".C")
+    C_EXTENSIONS = (".c",)
+    # sys.platform prefixes and the @platforms//os constraints they satisfy
+    HOST_OS = {"linux": ("linux",), "darwin": ("macos", "osx"), "win32": ("windows",), "freebsd": ("freebsd",)}
+
+    def __init__(self, graph: TargetGraph, bazelrc: dict[str, list[str]], cpp_standard: str = "20"):
+        self.graph = graph
+        self.bazelrc = bazelrc
+        self.cpp_standard = cpp_standard
+        self.cxx = os.environ.get("CXX", "c++")
+        self.cc = os.environ.get("CC", "cc")
+        self.host_os = next((names for prefix, names in self.HOST_OS.items() if sys.platform.startswith(prefix)), ())
+        # Include flags and defines each target passes on to its dependents
+        self._propagated: dict[str, tuple[tuple[str, ...], tuple[str, ...]]] = {}
+
+    def _holds(self, condition: str, package: str) -> bool:
+        label = canonical_label(condition, package)
+        if label.startswith("@platforms//os:"):
+            return label.rpartition(":")[2] in self.host_os
+        setting = self.graph.resolve(label)
+        if setting is None or setting.rule_type != "config_setting":
+            return False
+        return (all(self._holds(constraint, setting.package) for constraint in setting.constraint_values)
+                and all(value == "compilation_mode=fastbuild" for value in setting.values))
+
+    def configured(self, values: Iterable, package: str) -> list[str]:
+        """Plain values of an attribute plus the branch of each select() taken on the host"""
+        plain = []
+        for value in values:
+            if not isinstance(value, Select):
+                plain.append(value)
+                continue
+            branch = next((branch for condition, branch in value.branches.items()
+                           if condition != Select.DEFAULT and self._holds(condition, package)),
+                          value.branches.get(Select.DEFAULT, ()))
+            plain.extend(branch)
+        return plain
+
+    def _propagate(self):
+        for label in self.graph.topological_order():
+            target = self.graph.targets[label]
+            directory = target.package or "."
+            includes = dict.fromkeys([f"-I{directory}"] if target.rule_type.startswith("cc_") else [])
+            includes.update((f"-isystem{posixpath.normpath(posixpath.join(directory, include))}", None)
+                            for include in self.configured(target.includes, target.package))
+            defines = dict.fromkeys(f"-D{define}" for define in self.configured(target.defines, target.package))
+            for dep in self.graph.edges[label]:
+                if dep in self._propagated:
+                    dep_includes, dep_defines = self._propagated[dep]
+                    includes.update(dict.fromkeys(dep_includes))
+                    defines.update(dict.fromkeys(dep_defines))
+            self._propagated[label] = (tuple(includes), tuple(defines))
+
+    def sources(self, target: BazelTarget, every_branch: bool = False) -> list[str]:
+        """Package-relative C/C++ files the target compiles; select()ed ones on the host only
+        unless `every_branch`"""
+        srcs = flatten(target.srcs) if every_branch else self.configured(target.srcs, target.package)
+        return [src for src in srcs if src.endswith(self.CXX_EXTENSIONS + self.C_EXTENSIONS)]
+
+    def compiler(self, src: str) -> list[str]:
+        """Compiler and the .bazelrc flags for one source file, by language"""
+        if src.endswith(self.C_EXTENSIONS):
+            return [self.cc, *self.bazelrc["copt"], *self.bazelrc["conlyopt"]]
+        arguments = [self.cxx, *self.bazelrc["copt"], *self.bazelrc["cxxopt"]]
+        if not any(flag.startswith("-std=") for flag in arguments):
+            arguments.insert(1, f"-std=c++{self.cpp_standard}")
+        return arguments
+
+    def target_flags(self, target: BazelTarget) -> list[str]:
+        """copts, defines and include directories for the target's own sources"""
+        if not self._propagated:
+            self._propagate()
+        includes, defines = self._propagated[target.label]
+        return [*self.configured(target.copts, target.package), *defines,
+                *(f"-D{define}" for define in self.configured(target.local_defines, target.package)),
+                *dict.fromkeys(("-I.", *includes))]
+
+
+class CompileDatabase:
+    """compile_commands.json built straight from parsed targets, without configuring CMake.
+
+    Arguments come from CompileFlags. Every select()ed source gets an
+    entry, since tools want one for every file. Entries are streamed to
+    the output, so memory grows with the number of targets rather than
+    translation units.
+    """
+
+    def __init__(self, workspace_root: Path, graph: TargetGraph, bazelrc: Optional[dict[str, list[str]]] = None,
+                 cpp_standard: str = "20"):
+        self.directory = str(workspace_root.resolve())
+        self.graph = graph
+        self.flags = CompileFlags(graph, bazelrc if bazelrc is not None else read_bazelrc(workspace_root),
+                                  cpp_standard)
+
+    def entries(self) -> Iterator[dict]:
+        """One entry per C/C++ source file, package by package"""
+        for labels in self.graph.packages.values():
+            for label in labels:
+                target = self.graph.targets[label]
+                sources = self.flags.sources(target, every_branch=True)
+                if not sources:
+                    continue
+                flags = self.flags.target_flags(target)
+                for src in sources:
+                    path = posixpath.join(target.package, src) if target.package else src
+                    yield {"directory": self.directory, "file": path,
+                           "arguments": [*self.flags.compiler(src), *flags, "-c", path]}
+
+    def write(self, path: Path) -> int:
+        """Stream the database to `path`; returns the number of entries"""
+        count = 0
+        with atomic_open(path) as f:
+            f.write("[")
+            for entry in self.entries():
+                f.write(",\n" if count else "\n")
+                f.write(json.dumps(entry))
+                count += 1
+            f.write("\n]\n")
+        return count
+
+
+class ConversionResult:
+    """Targets parsed from one BUILD file and the CMakeLists.txt text generated from them"""
+
+    def __init__(self, targets: list[BazelTarget], cmake_text: str):
+        self.targets = targets
+        self.cmake_text = cmake_text
+
+
+def convert(source: Union[Path, str], *, project_name: str = "strong_typedefs", package: Optional[str] = None,
+            filename: Optional[str] = None, timer: Optional[PhaseTimer] = None,
+            workspace_root: Optional[Path] = None, modules: Optional[BzlModules] = None,
+            **generator_options) -> ConversionResult:
+    """Convert one BUILD file in memory.
+
+    `source` is either the Path of a BUILD file or its content as a string;
+    nothing is written and argv is not consulted, so callers can embed the
+    converter without paying interpreter startup per package. Extra
+    keyword arguments configure the CMakeGenerator.
+
+    load() and glob() resolve against `workspace_root`. For a BUILD file
+    Path it defaults to the nearest enclosing directory with a MODULE.bazel
+    or WORKSPACE file, and `package` to the BUILD file's directory relative
+    to it; without such a file the BUILD file is taken to be in `package`,
+    by default the root package. Callers converting several BUILD files of
+    one workspace can share `modules`, whose root is then the workspace
+    root, so each .bzl file is evaluated once.
+
+    Raises SyntaxError or StarlarkError for files that fail to evaluate and
+    ConversionError for targets that would produce a broken project.
+    """
+    timer = timer or PhaseTimer()
+    if isinstance(source, Path):
+        with timer.phase("read") as stats:
+            with open(source, 'r') as f:
+                content = f.read()
+            stats["count"] = 1
+        filename = filename or str(source)
+        workspace_root = workspace_root or (modules.workspace_root if modules is not None else None) \
+            or find_workspace_root(source.parent)
+        if workspace_root is None:
+            # No marker file: the root is as many levels up as the package is deep
+            workspace_root = source.parent
+            for _ in Path(package or "").parts:
+                workspace_root = workspace_root.parent
+        elif package is None:
+            package = package_name(source.parent.resolve().relative_to(workspace_root.resolve()))
+    else:
+        content = source
+        filename = filename or "BUILD.bazel"
+    package = package or ""
+
+    with timer.phase("parse") as stats:
+        started = time.perf_counter()
+        targets = BazelParser(modules=modules, workspace_root=workspace_root).parse_string(content, filename, package)
+        timer.span(filename, started, time.perf_counter(), args={"targets": len(targets)})
+        stats["count"] = 1
+
+    generator = CMakeGenerator(project_name, **generator_options)
+    generator.source_root = workspace_root
+    with timer.phase("resolve") as stats:
+        generator.graph = TargetGraph(targets)
+        errors = generator.graph.errors()
+        stats["count"] = len(targets)
+    if errors:
+        raise ConversionError("\n".join(errors))
+
+    with timer.phase("generate") as stats:
+        cmake_text = generator.render_cmake(targets)
+        stats["count"] = 1
+
+    return ConversionResult(targets, cmake_text)
+
+
+class ConversionServer(socketserver.UnixStreamServer):
+    """Keeps a converted workspace in memory and re-converts packages on request.
+
+    Clients send one JSON object per line and get one JSON object back:
+
+        {"op": "regenerate", "packages": ["a/b", "c"]}   refresh() those packages
+        {"op": "regenerate_all"}                         full convert()
+        {"op": "status"}                                 counts only
+        {"op": "shutdown"}                               stop after replying
+
+    Replies carry "ok", the outputs "written", package and target counts and
+    "elapsed_ms", or "ok": false with an "error". Requests are handled one
+    at a time, so the converter state needs no locking.
+    """
+
+    def __init__(self, socket_path: Path, converter: WorkspaceConverter):
+        self.converter = converter
+        self.stop_requested = False
+        if socket_path.exists():
+            # Refuse to steal the socket of a live server, remove a stale one
+            with contextlib.suppress(OSError), socket.socket(socket.AF_UNIX) as probe:
+                probe.connect(str(socket_path))
+                raise ConversionError(f"a server is already listening on {socket_path}")
+            socket_path.unlink()
+        super().__init__(str(socket_path), _ConversionRequestHandler)
+
+    def serve_until_shutdown(self):
+        """Handle requests until a client sends the shutdown op"""
+        try:
+            while not self.stop_requested:
+                self.handle_request()
+        finally:
+            self.server_close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.server_address)
+
+    def dispatch(self, request: dict) -> dict:
+        """Run one request against the in-memory workspace"""
+        started = time.perf_counter()
+        self.converter.timer = PhaseTimer()
+        op = request.get("op")
+        if op == "regenerate":
+            packages = request["packages"] if "packages" in request else [request["package"]]
+            written = self.converter.refresh(self._package_dir(package) for package in packages)
+        elif op == "regenerate_all":
+            written = self.converter.convert()
+        elif op in ("status", "shutdown"):
+            written = []
+            self.stop_requested = op == "shutdown"
+        else:
+            raise ValueError(f"unknown op {op!r}")
+        return {
+            "ok": True,
+            "written": [str(path) for path in written],
+            "packages": len(self.converter.packages),
+            "targets": sum(len(targets) for targets in self.converter.packages.values()),
+            "phases": {name: {"wall_ms": round(stats["wall"] * 1000, 3), "count": stats["count"]}
+                       for name, stats in self.converter.timer.phases.items()},
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+        }
+
+    @staticmethod
+    def _package_dir(package: str) -> Path:
+        """Workspace-relative directory for "a/b", "//a/b" or a BUILD file path"""
+        path = Path(package.lstrip("/") or ".")
+        return path.parent if path.name in BUILD_FILE_NAMES else path
+
+
+class _ConversionRequestHandler(socketserver.StreamRequestHandler):
+    """Answers JSON-line requests on one client connection"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("request must be a JSON object")
+                response = self.server.dispatch(request)
+            except (OSError, ValueError, KeyError, TypeError, SyntaxError, StarlarkError, ConversionError) as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            if self.server.stop_requested:
+                break
+
+
+def send_request(socket_path: Path, request: dict) -> dict:
+    """Send one request to a running ConversionServer and return its reply"""
+    with socket.socket(socket.AF_UNIX) as client:
+        client.connect(str(socket_path))
+        client.sendall(json.dumps(request).encode() + b"\n")
+        with client.makefile("rb") as replies:
+            return json.loads(replies.readline())
+
+
+class _Inotify:
+    """Minimal ctypes binding to Linux inotify"""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ONLYDIR = 0x1000000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    @classmethod
+    def create(cls) -> Optional["_Inotify"]:
+        """An inotify instance, or None where inotify is unavailable"""
+        try:
+            return cls()
+        except (AttributeError, OSError):
+            return None
+
+    def add_watch(self, path: Path) -> int:
+        """Watch a directory; returns the watch descriptor, or -1 if it is gone"""
+        return self._add_watch(self.fd, os.fsencode(path), self.MASK)
+
+    def read(self) -> list[tuple[int, int, str]]:
+        """Pending (watch descriptor, mask, name) events"""
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT.unpack_from(data, offset)
+            offset += self.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WorkspaceWatcher:
+    """Reports changed BUILD and .bzl files under a workspace in coalesced batches.
+
+    Uses inotify where available, so an idle watcher sleeps in select();
+    elsewhere it polls os.stat every `poll_interval` seconds, re-listing
+    only directories whose mtime changed. Events are coalesced until
+    `debounce` seconds pass without a new one, so by default an edit is
+    reported within about 100 ms either way.
+    """
+
+    def __init__(self, workspace_root: Path, debounce: float = 0.05, poll_interval: float = 0.05,
+                 use_inotify: bool = True):
+        self.workspace_root = workspace_root
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.inotify = _Inotify.create() if use_inotify else None
+        self._watches: dict[int, Path] = {}
+        # Polling state: (mtime, size) of every directory and watched file
+        self._directories: set[Path] = set()
+        self._stamps: dict[Path, Optional[tuple[int, int]]] = {}
+        self._overflowed = False
+        for directory in self._walk(Path(".")):
+            self._watch(directory)
+
+    @staticmethod
+    def is_watched(name: str) -> bool:
+        """Whether a file of this name can change the conversion"""
+        return name in BUILD_FILE_NAMES or name.endswith(".bzl")
+
+    @staticmethod
+    def _skipped(name: str) -> bool:
+        # Same directories find_build_files() skips
+        return name.startswith((".", "bazel-"))
+
+    def _walk(self, directory: Path) -> list[Path]:
+        """`directory` and every directory below it, workspace-relative"""
+        directories = []
+        for dirpath, dirnames, _ in os.walk(self.workspace_root / directory):
+            dirnames[:] = [d for d in dirnames if not self._skipped(d)]
+            directories.append(Path(dirpath).relative_to(self.workspace_root))
+        return directories
+
+    def _stamp(self, path: Path) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self.workspace_root / path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _watch(self, directory: Path):
+        """Start watching a directory and the watched files in it"""
+        if self.inotify is not None:
+            wd = self.inotify.add_watch(self.workspace_root / directory)
+            if wd >= 0:
+                self._watches[wd] = directory
+            return
+        self._directories.add(directory)
+        self._stamps[directory] = self._stamp(directory)
+        with contextlib.suppress(OSError):
+            for entry in os.scandir(self.workspace_root / directory):
+                if self.is_watched(entry.name) and entry.is_file():
+                    self._stamps[directory / entry.name] = self._stamp(directory / entry.name)
+
+    def changes(self) -> Iterator[Optional[set[Path]]]:
+        """Block until files change and yield them as workspace-relative paths.
+
+        Paths are watched files or directories that appeared or went away.
+        None means events were lost and everything should be re-read.
+        """
+        while True:
+            batch = self._collect(None)
+            while True:
+                more = self._collect(self.debounce)
+                if not more:
+                    break
+                batch |= more
+            if self._overflowed:
+                self._overflowed = False
+                yield None
+            else:
+                yield batch
+
+    def _collect(self, timeout: Optional[float]) -> set[Path]:
+        """Changes within `timeout` seconds; with None, wait for the first change"""
+        while True:
+            if self.inotify is not None:
+                ready, _, _ = select.select([self.inotify.fd], [], [], timeout)
+                changed = self._read_events() if ready else set()
+            else:
+                time.sleep(self.poll_interval if timeout is None else timeout)
+                changed = self._scan()
+            if changed or self._overflowed or timeout is not None:
+                return changed
+
+    def _read_events(self) -> set[Path]:
+        changed = set()
+        for wd, mask, name in self.inotify.read():
+            if mask & _Inotify.IN_Q_OVERFLOW:
+                self._overflowed = True
+                continue
+            if mask & _Inotify.IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = directory / name
+            if mask & _Inotify.IN_ISDIR:
+                if self._skipped(name):
+                    continue
+                changed.add(path)
+                if mask & (_Inotify.IN_CREATE | _Inotify.IN_MOVED_TO):
+                    for subdirectory in self._walk(path):
+                        self._watch(subdirectory)
+            elif self.is_watched(name):
+                changed.add(path)
+        return changed
+
+    def _scan(self) -> set[Path]:
+        changed = set()
+        for path, stamp in list(self._stamps.items()):
+            if path not in self._stamps:
+                continue  # under a directory removed earlier in this scan
+            new_stamp = self._stamp(path)
+            if new_stamp == stamp:
+                continue
+            if path not in self._directories:
+                changed.add(path)
+                if new_stamp is None:
+                    del self._stamps[path]
+                else:
+                    self._stamps[path] = new_stamp
+            elif new_stamp is None:
+                changed.add(path)
+                for gone in [p for p in self._stamps if p == path or path in p.parents]:
+                    del self._stamps[gone]
+                    self._directories.discard(gone)
+            else:
+                self._stamps[path] = new_stamp
+                changed |= self._relist(path)
+        return changed
+
+    def _relist(self, directory: Path) -> set[Path]:
+        """New watched files and directories in a directory whose mtime changed"""
+        changed = set()
+        try:
+            entries = list(os.scandir(self.workspace_root / directory))
+        except OSError:
+            return changed
+        for entry in entries:
+            path = directory / entry.name
+            if entry.is_dir():
+                if not self._skipped(entry.name) and path not in self._directories:
+                    changed.add(path)
+                    for subdirectory in self._walk(path):
+                        self._watch(subdirectory)
+            elif self.is_watched(entry.name) and path not in self._stamps:
+                changed.add(path)
+                self._stamps[path] = self._stamp(path)
+        return changed
+
+    def close(self):
+        if self.inotify is not None:
+            self.inotify.close()
+
+
+def watch_workspace(converter: WorkspaceConverter, watcher: WorkspaceWatcher, converted: bool = True) -> int:
+    """Regenerate the outputs affected by each batch of changes until interrupted.
+
+    Until a full conversion has succeeded (`converted`), every batch of
+    changes triggers another full conversion instead of a refresh.
+    """
+    root = converter.workspace_root
+    print(f"Watching {root} for changes", flush=True)
+    try:
+        for changes in watcher.changes():
+            started = time.perf_counter()
+            try:
+                if changes is None or not converted:
+                    written = converter.convert()
+                    converted = True
+                else:
+                    packages, force = set(), set()
+                    for path in changes:
+                        if path.name in BUILD_FILE_NAMES:
+                            packages.add(path.parent)
+                        elif path.suffix == ".bzl":
+                            force |= converter.bzl_dependents.get(path, set())
+                        else:
+                            # A directory appeared or went away, with any packages below it
+                            packages.update(p for p in converter.packages if p == path or path in p.parents)
+                            if (root / path).is_dir():
+                                packages.update(f.parent.relative_to(root) for f in find_build_files(root / path))
+                    written = converter.refresh(packages, force)
+            except (OSError, SyntaxError, StarlarkError, ConversionError) as e:
+                print(f"Error: {e}", flush=True)
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            for output in written:
+                print(f"Generated {output}")
+            print(f"Regenerated {len(written)} CMakeLists.txt files in {elapsed_ms:.1f} ms", flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+
+def main(argv: Optional[list[str]] = None):
     """Main function"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ["serve"]:
+        return serve_main(argv[1:])
+
     parser = argparse.ArgumentParser(
         description="Convert Bazel BUILD.bazel to CMakeLists.txt"
     )
     parser.add_argument(
         "--build-file",
         type=Path,
-        default="BUILD.bazel",
-        help="Path to BUILD.bazel file (default: BUILD.bazel)"
+        action="append",
+        help="Path to BUILD.bazel file; repeat to convert several in one run (default: BUILD.bazel)"
     )
     parser.add_argument(
         "--output",
         type=Path,
-        default="CMakeLists.txt",
-        help="Output CMakeLists.txt file (default: CMakeLists.txt)"
+        action="append",
+        help="Output CMakeLists.txt file, one per --build-file (default: CMakeLists.txt for a "
+             "single BUILD file, otherwise CMakeLists.txt next to each BUILD file)"
+    )
+    parser.add_argument(
+        "--manifest",
+        type=Path,
+        help="File listing one 'BUILD_FILE [OUTPUT]' pair per line, relative to the manifest; "
+             "converted together with any --build-file arguments"
     )
     parser.add_argument(
         "--project-name",
         default="strong_typedefs",
         help="CMake project name (default: strong_typedefs)"
     )
+    parser.add_argument(
+        "--workspace-root",
+        type=Path,
+        help="Convert every BUILD/BUILD.bazel file under this directory, "
+             "writing a CMakeLists.txt next to each (ignores --build-file, --output and --manifest)"
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=_non_negative_int,
+        default=1,
+        help="Number of processes used to parse BUILD files in workspace mode; "
+             "0 uses all CPUs (default: 1)"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="Directory for the incremental conversion cache used in workspace mode; "
+             "unchanged BUILD files are neither re-parsed nor re-generated"
+    )
+
+    _add_generator_arguments(parser)
+    parser.add_argument(
+        "--generator",
+        choices=("cmake", "ninja"),
+        default="cmake",
+        help="Build files to generate; ninja writes a single build.ninja for every package "
+             "under --workspace-root (default: .) and skips CMake entirely (default: cmake)"
+    )
+    parser.add_argument(
+        "--compile-commands",
+        type=Path,
+        metavar="OUTPUT",
+        help="Write a compile_commands.json for every package under --workspace-root "
+             "(default: .) instead of generating CMakeLists.txt"
+    )
+
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="In workspace mode, keep running and regenerate the packages affected "
+             "whenever a BUILD or .bzl file changes"
+    )
+
+    parser.add_argument(
+        "--timings",
+        action="store_true",
+        help="Print wall and CPU time per phase"
+    )
+    parser.add_argument(
+        "--profile",
+        type=Path,
+        help="Run under cProfile and write the stats to this file"
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        help="Write Chrome trace events (one span per phase and BUILD file) to this JSON file"
+    )
+
+    args = parser.parse_args(argv)
+    # These modes cover the whole --workspace-root, never single BUILD files
+    for flag, used in (("--compile-commands", args.compile_commands is not None),
+                       ("--generator ninja", args.generator == "ninja")):
+        if used and (args.build_file or args.output or args.manifest):
+            parser.error(f"{flag} converts every package under --workspace-root; "
+                         "it cannot be combined with --build-file, --output or --manifest")
+
+    timer = PhaseTimer()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if args.compile_commands is not None:
+            result = write_compile_commands(args, timer)
+        elif args.generator == "ninja":
+            result = write_ninja(args, timer)
+        elif args.workspace_root is not None:
+            result = convert_workspace(args, timer)
+        else:
+            result = convert_build_files(args, timer)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+
+    if args.timings:
+        print("\n".join(timer.report()))
+    if args.trace:
+        timer.write_trace(args.trace)
+    return result
+
+
+def _positive_int(text: str) -> int:
+    value = int(text)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"expected a positive integer, got {text}")
+    return value
 
-    args = parser.parse_args()
 
-    if not args.build_file.exists():
-        print(f"Error: BUILD file not found: {args.build_file}")
+def _non_negative_int(text: str) -> int:
+    value = int(text)
+    if value < 0:
+        raise argparse.ArgumentTypeError(f"expected a non-negative integer, got {text}")
+    return value
+
+
+def _label_file(path: str) -> list[str]:
+    """Labels listed one per line in a file, ignoring blank lines and # comments"""
+    try:
+        lines = Path(path).read_text().splitlines()
+    except OSError as e:
+        raise argparse.ArgumentTypeError(f"cannot read {path}: {e}")
+    return [label for label in (line.split("#", 1)[0].strip() for line in lines) if label]
+
+
+def _add_generator_arguments(parser: argparse.ArgumentParser):
+    """Options of the generated CMake project"""
+    parser.add_argument(
+        "--precompile-header",
+        action="append",
+        default=[],
+        metavar="HEADER",
+        help="Precompile this workspace-relative header (or //package:file label) in every target "
+             "that includes it directly; repeatable"
+    )
+    parser.add_argument(
+        "--precompile-min-users",
+        type=_positive_int,
+        default=0,
+        metavar="N",
+        help="Also precompile the headers of libraries that at least N compiled targets "
+             "depend on directly (default: off)"
+    )
+    parser.add_argument(
+        "--unity-build",
+        choices=("batch", "group"),
+        help="Merge each target's C++ sources into unity TUs: batch uses UNITY_BUILD_BATCH_SIZE, "
+             "group balances explicit UNITY_GROUPs by file size (default: off)"
+    )
+    parser.add_argument(
+        "--unity-batch-size",
+        type=_positive_int,
+        default=8,
+        metavar="N",
+        help="Sources per unity TU; in group mode, sources per group on average, as groups are "
+             "balanced by file size (default: 8)"
+    )
+    parser.add_argument(
+        "--unity-exclude",
+        action="append",
+        default=[],
+        metavar="LABEL",
+        help="Target (//pkg:target) to build without unity TUs, or source file (//pkg:file.cc) "
+             "to compile on its own; repeatable"
+    )
+    parser.add_argument(
+        "--compiler-launcher",
+        choices=CMakeGenerator.COMPILER_LAUNCHERS,
+        help="Compile through this launcher when find_program() finds it (default: none)"
+    )
+    parser.add_argument(
+        "--linker",
+        choices=sorted(CMakeGenerator.LINKERS),
+        help="Link with this linker when find_program() finds it, via CMAKE_LINKER_TYPE on "
+             "CMake 3.29+ and -fuse-ld otherwise (default: the compiler's)"
+    )
+    parser.add_argument(
+        "--link-pool-depth",
+        type=_non_negative_int,
+        default=0,
+        metavar="N",
+        help="Link at most N binaries and tests at once under Ninja (default: 0, unlimited)"
+    )
+    parser.add_argument(
+        "--heavy-pool-depth",
+        type=_non_negative_int,
+        default=0,
+        metavar="N",
+        help="Compile sources of at most N heavy targets at once under Ninja; targets are heavy when "
+             "tagged \"heavy\" or listed in --heavy-targets (default: 0, unlimited)"
+    )
+    parser.add_argument(
+        "--heavy-targets",
+        type=_label_file,
+        default=[],
+        metavar="FILE",
+        help="File listing one heavy target label per line; # starts a comment"
+    )
+    parser.add_argument(
+        "--gtest-discover-tests",
+        action="store_true",
+        help="Register each case of tests using GoogleTest as its own CTest test, discovered "
+             "when ctest runs (gtest_discover_tests with DISCOVERY_MODE PRE_TEST)"
+    )
+
+
+def _generator_options(args: argparse.Namespace) -> dict:
+    """CMakeGenerator keyword arguments from _add_generator_arguments() options"""
+    return {"precompile_headers": args.precompile_header, "precompile_min_users": args.precompile_min_users,
+            "unity_build": args.unity_build, "unity_batch_size": args.unity_batch_size,
+            "unity_exclude": args.unity_exclude, "compiler_launcher": args.compiler_launcher,
+            "linker": args.linker, "link_pool_depth": args.link_pool_depth,
+            "heavy_pool_depth": args.heavy_pool_depth, "heavy_targets": args.heavy_targets,
+            "gtest_discover_tests": args.gtest_discover_tests}
+
+
+def _build_file_pairs(args: argparse.Namespace) -> list[tuple[Path, Path]]:
+    """(BUILD file, output) pairs from --build-file/--output and --manifest"""
+    build_files = list(args.build_file or [])
+    outputs = list(args.output or [])
+    if outputs and len(outputs) != len(build_files):
+        raise ValueError(f"got {len(outputs)} --output for {len(build_files)} --build-file arguments")
+    if not build_files and not args.manifest:
+        build_files = [Path("BUILD.bazel")]
+    if not outputs:
+        if len(build_files) == 1 and not args.manifest:
+            outputs = [Path("CMakeLists.txt")]
+        else:
+            outputs = [build_file.parent / "CMakeLists.txt" for build_file in build_files]
+    pairs = list(zip(build_files, outputs))
+
+    if args.manifest:
+        base = args.manifest.parent
+        for number, line in enumerate(args.manifest.read_text().splitlines(), 1):
+            fields = line.split("#", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) > 2:
+                raise ValueError(f"{args.manifest}:{number}: expected 'BUILD_FILE [OUTPUT]'")
+            build_file = base / fields[0]
+            output = base / fields[1] if len(fields) == 2 else build_file.parent / "CMakeLists.txt"
+            pairs.append((build_file, output))
+
+    return pairs
+
+
+def convert_build_files(args: argparse.Namespace, timer: PhaseTimer) -> int:
+    """Convert every --build-file/--manifest entry in this one process"""
+    try:
+        pairs = _build_file_pairs(args)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    verbose = len(pairs) == 1
+    failures = 0
+    # One .bzl module table per workspace, shared by its BUILD files
+    modules: dict[Path, BzlModules] = {}
+    for build_file, output in pairs:
+        workspace_root = find_workspace_root(build_file.parent)
+        if workspace_root is not None and workspace_root not in modules:
+            modules[workspace_root] = BzlModules(workspace_root)
+        if convert_build_file(build_file, output, args.project_name, timer, verbose, _generator_options(args),
+                              modules.get(workspace_root)) != 0:
+            failures += 1
+
+    if not verbose:
+        print(f"Converted {len(pairs) - failures} of {len(pairs)} BUILD files")
+    return 1 if failures else 0
+
+
+def convert_build_file(build_file: Path, output: Path, project_name: str, timer: PhaseTimer,
+                       verbose: bool = True, generator_options: Optional[dict] = None,
+                       modules: Optional[BzlModules] = None) -> int:
+    """Convert a single BUILD file to `output`, loading .bzl files through `modules` if given"""
+    if not build_file.exists():
+        print(f"Error: BUILD file not found: {build_file}")
+        return 1
+
+    try:
+        result = convert(build_file, project_name=project_name, timer=timer, modules=modules,
+                         **(generator_options or {}))
+    except (SyntaxError, StarlarkError) as e:
+        print(f"Error: failed to parse {build_file}: {e}")
+        return 1
+    except ConversionError as e:
+        for error in str(e).splitlines():
+            print(f"Error: {build_file}: {error}")
+        return 1
+
+    if not result.targets:
+        print(f"No targets found in BUILD file {build_file}")
+        return 1
+
+    if verbose:
+        print(f"Found {len(result.targets)} targets:")
+        for target in result.targets:
+            print(f"  - {target.rule_type}: {target.name}")
+
+    with timer.phase("write") as stats:
+        written = write_if_changed(output, result.cmake_text)
+        stats["count"] = int(written)
+
+    if written:
+        print(f"Generated {output}")
+    else:
+        print(f"{output} is up to date")
+    return 0
+
+
+def convert_workspace(args: argparse.Namespace, timer: PhaseTimer) -> int:
+    """Convert all packages under --workspace-root"""
+    if not args.workspace_root.is_dir():
+        print(f"Error: workspace root not found: {args.workspace_root}")
+        return 1
+
+    jobs = args.jobs or os.cpu_count() or 1
+    generator = CMakeGenerator(args.project_name, **_generator_options(args))
+    cache = ConversionCache(args.cache_dir, generator.options()) if args.cache_dir else None
+    converter = WorkspaceConverter(args.workspace_root, generator, jobs, cache, timer)
+    try:
+        written = converter.convert()
+    except (SyntaxError, StarlarkError) as e:
+        print(f"Error: failed to parse BUILD file: {e}")
+        return watch_workspace(converter, WorkspaceWatcher(args.workspace_root), False) if args.watch else 1
+    except ConversionError as e:
+        for error in str(e).splitlines():
+            print(f"Error: {error}")
+        return watch_workspace(converter, WorkspaceWatcher(args.workspace_root), False) if args.watch else 1
+
+    if not converter.packages:
+        print(f"No BUILD files found under {args.workspace_root}")
+        return 1
+
+    target_count = sum(len(targets) for targets in converter.packages.values())
+    print(f"Found {target_count} targets in {len(converter.packages)} packages")
+    if cache is not None:
+        print(f"Cache: {cache.hits} hits, {cache.misses} misses")
+    print(f"Generated {len(written)} CMakeLists.txt files under {args.workspace_root} "
+          f"({len(converter.outputs) - len(written)} up to date)")
+    if args.watch:
+        return watch_workspace(converter, WorkspaceWatcher(args.workspace_root))
+    return 0
+
+
+def _parse_workspace(args: argparse.Namespace, timer: PhaseTimer) -> Optional[WorkspaceConverter]:
+    """Parse every package under --workspace-root (default: .) without generating CMake.
+
+    Prints the problem and returns None if the workspace cannot be used.
+    """
+    workspace_root = args.workspace_root if args.workspace_root is not None else Path(".")
+    if not workspace_root.is_dir():
+        print(f"Error: workspace root not found: {workspace_root}")
+        return None
+
+    jobs = args.jobs or os.cpu_count() or 1
+    generator = CMakeGenerator(args.project_name, **_generator_options(args))
+    cache = ConversionCache(args.cache_dir, generator.options()) if args.cache_dir else None
+    converter = WorkspaceConverter(workspace_root, generator, jobs, cache, timer)
+    try:
+        converter.parse()
+    except (SyntaxError, StarlarkError) as e:
+        print(f"Error: failed to parse BUILD file: {e}")
+        return None
+    except ConversionError as e:
+        for error in str(e).splitlines():
+            print(f"Error: {error}")
+        return None
+
+    if not converter.packages:
+        print(f"No BUILD files found under {workspace_root}")
+        return None
+    return converter
+
+
+def _read_bazelrc(workspace_root: Path) -> Optional[dict[str, list[str]]]:
+    try:
+        return read_bazelrc(workspace_root)
+    except (OSError, ValueError) as e:
+        print(f"Error: failed to read .bazelrc: {e}")
+        return None
+
+
+def write_compile_commands(args: argparse.Namespace, timer: PhaseTimer) -> int:
+    """Write --compile-commands from the packages under --workspace-root"""
+    converter = _parse_workspace(args, timer)
+    bazelrc = _read_bazelrc(converter.workspace_root) if converter is not None else None
+    if bazelrc is None:
         return 1
 
-    # Parse Bazel BUILD file
-    parser = BazelParser()
-    targets = parser.parse_file(args.build_file)
+    with timer.phase("write") as stats:
+        database = CompileDatabase(converter.workspace_root, converter.generator.graph, bazelrc,
+                                   converter.generator.cpp_standard)
+        stats["count"] = database.write(args.compile_commands)
+    print(f"Wrote {stats['count']} compile commands to {args.compile_commands}")
+    return 0
+
 
-    if not targets:
-        print("No targets found in BUILD file")
+def write_ninja(args: argparse.Namespace, timer: PhaseTimer) -> int:
+    """Write build.ninja at the root of --workspace-root"""
+    converter = _parse_workspace(args, timer)
+    bazelrc = _read_bazelrc(converter.workspace_root) if converter is not None else None
+    if bazelrc is None:
         return 1
 
-    print(f"Found {len(targets)} targets:")
-    for target in targets:
-        print(f"  - {target.rule_type}: {target.name}")
+    options = _generator_options(args)
+    generator = NinjaGenerator(args.project_name, link_pool_depth=options["link_pool_depth"],
+                               heavy_pool_depth=options["heavy_pool_depth"], heavy_targets=options["heavy_targets"])
+    generator.graph = converter.generator.graph
+    output = converter.workspace_root / "build.ninja"
+    with timer.phase("generate"):
+        text = generator.render_ninja(bazelrc)
+    with timer.phase("write") as stats:
+        written = write_if_changed(output, text)
+        stats["count"] = int(written)
+
+    target_count = sum(len(targets) for targets in converter.packages.values())
+    print(f"Found {target_count} targets in {len(converter.packages)} packages")
+    print(f"Generated {output}" if written else f"{output} is up to date")
+    return 0
 
-    # Generate CMakeLists.txt
-    generator = CMakeGenerator(args.project_name)
-    generator.generate_cmake(targets, args.output)
 
-    print(f"Generated {args.output}")
+def serve_main(argv: list[str]) -> int:
+    """Convert a workspace once, then serve incremental requests until shut down"""
+    parser = argparse.ArgumentParser(
+        prog="bazel_to_cmake.py serve",
+        description="Keep a converted workspace in memory and regenerate packages on request"
+    )
+    parser.add_argument(
+        "--socket",
+        type=Path,
+        required=True,
+        help="Unix socket to listen on for JSON-line requests"
+    )
+    parser.add_argument(
+        "--workspace-root",
+        type=Path,
+        default=Path("."),
+        help="Workspace to convert and keep in memory (default: .)"
+    )
+    parser.add_argument(
+        "--project-name",
+        default="strong_typedefs",
+        help="CMake project name (default: strong_typedefs)"
+    )
+    parser.add_argument(
+        "--jobs", "-j",
+        type=_non_negative_int,
+        default=1,
+        help="Number of processes used for full conversions; 0 uses all CPUs (default: 1)"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=Path,
+        help="Directory for the incremental conversion cache used by full conversions"
+    )
+    _add_generator_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if not args.workspace_root.is_dir():
+        print(f"Error: workspace root not found: {args.workspace_root}")
+        return 1
+
+    jobs = args.jobs or os.cpu_count() or 1
+    generator = CMakeGenerator(args.project_name, **_generator_options(args))
+    cache = ConversionCache(args.cache_dir, generator.options()) if args.cache_dir else None
+    converter = WorkspaceConverter(args.workspace_root, generator, jobs, cache)
+    try:
+        written = converter.convert()
+        print(f"Generated {len(written)} CMakeLists.txt files under {args.workspace_root}")
+    except (SyntaxError, StarlarkError, ConversionError) as e:
+        # Keep serving; a later request can pick up the fix
+        print(f"Error: {e}")
+
+    try:
+        server = ConversionServer(args.socket, converter)
+    except (OSError, ConversionError) as e:
+        print(f"Error: cannot listen on {args.socket}: {e}")
+        return 1
+    print(f"Serving {args.workspace_root} on {args.socket}", flush=True)
+    try:
+        server.serve_until_shutdown()
+    except KeyboardInterrupt:
+        pass
     return 0
 
 
@@ -0,0 +1,375 @@
+"""
+Benchmarks for the Bazel to CMake converter
+
+Usage:
+    python3 bazel_to_cmake_benchmark.py parse [--build-file BUILD.bazel] [--iterations N]
+    python3 bazel_to_cmake_benchmark.py memory [--targets N]
+    python3 bazel_to_cmake_benchmark.py workspace [--packages N] [--output results.json]
+                                                  [--compare baseline.json]
+
+Commands:
+- parse: per-file parse cost of exec() versus the Starlark evaluator and
+  the literal-call fast path. A cold evaluator parse includes ast.parse of
+  content not seen before, as on a first conversion, and is slower than
+  exec(); files made only of literal rule calls skip it on the fast path
+- memory: bytes per BazelTarget compared with the original dict-and-list
+  representation
+- workspace: end-to-end throughput on a synthetic monorepo, saved as JSON
+  so runs on different commits can be compared
+"""
+
+import argparse
+import ast
+import gc
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from pathlib import Path
+from typing import Optional
+
+from bazel_to_cmake import (BazelParser, BazelTarget, CMakeGenerator, TargetGraph,
+                            _parse_cached, find_build_files, parse_build_files)
+
+
+def _exec_parse(content: str):
+    """Parse the way the converter originally did, with exec()"""
+    parser = BazelParser()
+
+    def rule(rule_type: str):
+        def define(**kwargs):
+            target = BazelTarget(rule_type, kwargs.get("name", ""))
+            parser._populate_target(target, kwargs)
+            parser.targets.append(target)
+        return define
+
+    exec_globals = {
+        "load": lambda *args, **kwargs: None,
+        "cc_library": rule("cc_library"),
+        "cc_test": rule("cc_test"),
+        "cc_binary": rule("cc_binary"),
+    }
+    exec(content, exec_globals)
+
+
+def _evaluator_parse(content: str):
+    """Parse with the evaluator, including ast.parse of new content"""
+    _parse_cached.cache_clear()
+    BazelParser(fast_path=False).parse_string(content)
+
+
+def _ast_parse(content: str):
+    """ast.parse alone, the floor under a cold evaluator parse"""
+    ast.parse(content)
+
+
+def _cached_evaluator_parse(content: str):
+    """Parse with the evaluator, reusing the cached syntax tree"""
+    BazelParser(fast_path=False).parse_string(content)
+
+
+def _fast_path_parse(content: str):
+    """Parse with the literal-call fast path"""
+    BazelParser().parse_string(content)
+
+
+def benchmark_parse(build_file: Path, iterations: int) -> dict[str, float]:
+    """Return microseconds per parse of `build_file` for each strategy"""
+    content = build_file.read_text()
+    strategies = {
+        "exec": _exec_parse,
+        "evaluator (cold)": _evaluator_parse,
+        "ast.parse only": _ast_parse,
+        "evaluator (cached ast)": _cached_evaluator_parse,
+        "fast path": _fast_path_parse,
+    }
+
+    results = {}
+    for name, function in strategies.items():
+        function(content)  # warm up
+        seconds = min(timeit.repeat(lambda: function(content), number=iterations, repeat=5))
+        results[name] = seconds / iterations * 1e6
+    return results
+
+
+class _LegacyTarget:
+    """BazelTarget as originally written: per-instance __dict__ and lists"""
+
+    def __init__(self, rule_type: str, name: str):
+        self.rule_type = rule_type
+        self.name = name
+        self.hdrs: list[str] = []
+        self.srcs: list[str] = []
+        self.deps: list[str] = []
+        self.visibility: list[str] = []
+        self.data: list[str] = []
+
+    def add_attribute(self, attr_name: str, values: list[str]):
+        getattr(self, attr_name).extend(values)
+
+
+def _make_targets(target_class: type, count: int) -> list:
+    """Build `count` targets shaped like a typical cc_library.
+
+    Every string is built afresh, as evaluating a BUILD file would, so
+    labels shared between targets are only deduplicated by interning.
+    """
+    targets = []
+    for i in range(count):
+        package = f"pkg{i // 10}"
+        target = target_class("".join(["cc_", "library"]), f"lib{i}")
+        target.add_attribute("hdrs", [f"lib{i}.h"])
+        target.add_attribute("srcs", [f"lib{i}.cc"])
+        target.add_attribute("deps", [f"//{package}:lib{i - 1}", f"//base:lib{i % 7}",
+                                      "".join(["@com_google_googletest", "//:gtest"])])
+        target.add_attribute("visibility", [f"//visibility:{'public'}"])
+        targets.append(target)
+    return targets
+
+
+def benchmark_memory(count: int) -> dict[str, float]:
+    """Return bytes per target for the legacy and current representations"""
+    results = {}
+    for name, target_class in [("legacy", _LegacyTarget), ("BazelTarget", BazelTarget)]:
+        gc.collect()
+        tracemalloc.start()
+        targets = _make_targets(target_class, count)
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name] = size / count
+        del targets
+    return results
+
+
+def synthesize_workspace(root: Path, packages: int, targets_per_package: int, fan_out: int,
+                         external_deps: float, source_bytes: int, dynamic_fraction: float,
+                         seed: int) -> int:
+    """Write a synthetic workspace under `root` and return its target count.
+
+    Package i lives at group{i % 16}/pkg{i}. Each target depends on up to
+    `fan_out` targets defined before it, so the graph is acyclic, and on
+    GoogleTest with probability `external_deps`; the last target of every
+    package is a test. A `dynamic_fraction` of BUILD files use variables
+    and comprehensions so they exercise the evaluator instead of the
+    literal fast path. Source and header files are `source_bytes` long.
+    """
+    rng = random.Random(seed)
+    filler = "// synthetic source\n" * max(1, source_bytes // 20)
+    labels: list[str] = []
+
+    for i in range(packages):
+        package = f"group{i % 16}/pkg{i}"
+        package_dir = root / package
+        package_dir.mkdir(parents=True)
+        dynamic = rng.random() < dynamic_fraction
+
+        rules = []
+        for j in range(targets_per_package):
+            name = f"t{j}"
+            deps = rng.sample(labels, min(fan_out, len(labels)))
+            is_test = j == targets_per_package - 1
+            if is_test or rng.random() < external_deps:
+                deps.append("@com_google_googletest//:gtest_main" if is_test else "@com_google_googletest//:gtest")
+
+            for file_name in (f"{name}.cc", f"{name}.h"):
+                (package_dir / file_name).write_text(filler)
+
+            deps_text = ", ".join(f'"{dep}"' for dep in deps)
+            if is_test:
+                rules.append(f'cc_test(\n    name = "{name}",\n    srcs = ["{name}.cc"],\n'
+                             f'    deps = [{deps_text}],\n)\n')
+                continue
+            if dynamic:
+                rules.append(f'cc_library(\n    name = "{name}",\n    srcs = [n + ".cc" for n in ["{name}"]],\n'
+                             f'    hdrs = ["%s.h" % "{name}"],\n    deps = COMMON + [{deps_text}],\n)\n')
+            else:
+                rules.append(f'cc_library(\n    name = "{name}",\n    srcs = ["{name}.cc"],\n'
+                             f'    hdrs = ["{name}.h"],\n    deps = [{deps_text}],\n)\n')
+            labels.append(f"//{package}:{name}")
+
+        header = "COMMON = []\n\n" if dynamic else ""
+        (package_dir / "BUILD.bazel").write_text(header + "\n".join(rules))
+
+    return packages * targets_per_package
+
+
+def _git_revision() -> str:
+    """Current commit, or "unknown" outside a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def benchmark_workspace(root: Path, jobs: int) -> dict:
+    """Time each conversion phase over the workspace at `root`"""
+    phases = {}
+
+    def record(phase: str, started: float, items: int, unit: str):
+        seconds = time.perf_counter() - started
+        phases[phase] = {
+            "seconds": seconds,
+            "items": items,
+            "unit": unit,
+            "per_second": items / seconds if seconds else 0.0,
+        }
+
+    started = time.perf_counter()
+    build_files = find_build_files(root)
+    record("discover", started, len(build_files), "files")
+
+    started = time.perf_counter()
+    contents = [build_file.read_text() for build_file in build_files]
+    record("read", started, sum(len(content) for content in contents), "bytes")
+
+    started = time.perf_counter()
+    parsed = parse_build_files(build_files, jobs, contents, root)
+    targets = [target for package_targets in parsed for target in package_targets]
+    record("parse", started, len(build_files), "files")
+
+    started = time.perf_counter()
+    graph = TargetGraph(targets)
+    errors = graph.errors()
+    graph.topological_order()
+    record("resolve", started, len(targets), "targets")
+    if errors:
+        raise RuntimeError(f"synthetic workspace is invalid: {errors[:3]}")
+
+    started = time.perf_counter()
+    generator = CMakeGenerator("benchmark")
+    generator.graph = graph
+    package_dirs = [build_file.parent.relative_to(root) for build_file in build_files]
+    packages = dict(zip(package_dirs, parsed))
+    external_deps = generator._find_external_deps(targets)
+    output_bytes = 0
+    for package_dir, subdirectories in generator.workspace_layout(package_dirs).items():
+        is_root = package_dir == Path(".")
+        output_bytes += len(generator.render_cmake(
+            packages.get(package_dir, []), subdirectories,
+            is_root=is_root, external_deps=external_deps if is_root else None))
+    record("generate", started, len(targets), "targets")
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+    return {
+        "phases": phases,
+        "targets": len(targets),
+        "packages": len(build_files),
+        "output_bytes": output_bytes,
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+
+def _print_workspace_results(results: dict, baseline: Optional[dict]):
+    """Print a phase table, with ratios against `baseline` if given"""
+    print(f"{results['packages']} packages, {results['targets']} targets "
+          f"(revision {results['revision']}, peak RSS {results['peak_rss_mb']:.1f} MB)")
+    if baseline is not None and baseline["config"] != results["config"]:
+        print(f"Warning: baseline {baseline['revision']} used a different workspace configuration")
+    for phase, timing in results["phases"].items():
+        line = (f"  {phase:<10} {timing['seconds'] * 1000:9.1f} ms  "
+                f"{timing['per_second']:12.0f} {timing['unit']}/s")
+        if baseline is not None and phase in baseline["phases"]:
+            base_seconds = baseline["phases"][phase]["seconds"]
+            if base_seconds:
+                line += f"  ({timing['seconds'] / base_seconds:5.2f}x of {baseline['revision']})"
+        print(line)
+
+
+def main():
+    """Main function"""
+    parser = argparse.ArgumentParser(description="Benchmark the Bazel to CMake converter")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parse = commands.add_parser("parse", help="Compare per-file parse strategies")
+    parse.add_argument(
+        "--build-file",
+        type=Path,
+        default="BUILD.bazel",
+        help="BUILD file to parse (default: BUILD.bazel)"
+    )
+    parse.add_argument(
+        "--iterations",
+        type=int,
+        default=2000,
+        help="Parses per timing sample (default: 2000)"
+    )
+
+    memory = commands.add_parser("memory", help="Measure bytes per target")
+    memory.add_argument(
+        "--targets",
+        type=int,
+        default=100_000,
+        help="Number of targets to build (default: 100000)"
+    )
+
+    workspace = commands.add_parser("workspace", help="Benchmark a synthetic monorepo end to end")
+    workspace.add_argument("--packages", type=int, default=1000, help="Number of packages (default: 1000)")
+    workspace.add_argument("--targets-per-package", type=int, default=5,
+                           help="Targets in each package (default: 5)")
+    workspace.add_argument("--fan-out", type=int, default=3, help="Deps per target (default: 3)")
+    workspace.add_argument("--external-deps", type=float, default=0.2,
+                           help="Fraction of libraries depending on GoogleTest (default: 0.2)")
+    workspace.add_argument("--source-bytes", type=int, default=2048,
+                           help="Size of each generated source and header file (default: 2048)")
+    workspace.add_argument("--dynamic-fraction", type=float, default=0.1,
+                           help="Fraction of BUILD files that need full evaluation (default: 0.1)")
+    workspace.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    workspace.add_argument("--jobs", type=int, default=1, help="Parse processes (default: 1)")
+    workspace.add_argument("--workspace", type=Path,
+                           help="Keep the synthetic workspace in this (new) directory")
+    workspace.add_argument("--output", type=Path, help="Save results as JSON")
+    workspace.add_argument("--compare", type=Path, help="JSON results of a baseline run")
+
+    args = parser.parse_args()
+
+    if args.command == "parse":
+        results = benchmark_parse(args.build_file, args.iterations)
+        baseline = results["exec"]
+        print(f"Parse cost of {args.build_file}:")
+        for name, micros in results.items():
+            print(f"  {name:<24} {micros:8.1f} us  ({baseline / micros:4.1f}x vs exec)")
+        # Without the fast path a BUILD file read for the first time is a
+        # cold evaluation, so that is what the fast path saves
+        print(f"Fast path vs cold evaluator: {results['evaluator (cold)'] / results['fast path']:.1f}x")
+    elif args.command == "memory":
+        results = benchmark_memory(args.targets)
+        baseline = results["legacy"]
+        print(f"Memory per target ({args.targets} targets):")
+        for name, size in results.items():
+            print(f"  {name:<24} {size:8.1f} bytes  ({size / baseline:4.0%} of legacy)")
+    elif args.command == "workspace":
+        config = {key: getattr(args, key) for key in [
+            "packages", "targets_per_package", "fan_out", "external_deps",
+            "source_bytes", "dynamic_fraction", "seed", "jobs"]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            root = args.workspace or Path(tmpdir)
+            synthesize_workspace(root, **{k: v for k, v in config.items() if k != "jobs"})
+            results = benchmark_workspace(root, args.jobs)
+
+        results = {
+            "config": config,
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            **results,
+        }
+        baseline = json.loads(args.compare.read_text()) if args.compare else None
+        _print_workspace_results(results, baseline)
+        if args.output:
+            args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
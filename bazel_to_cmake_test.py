@@ -2,11 +2,21 @@
 Test script for the Bazel to CMake converter
 """
 
+import json
+import os
+import shutil
 import subprocess
 import tempfile
 import textwrap
+import time
 from pathlib import Path
 
+import pytest
+
+from bazel_to_cmake import (BazelParser, BazelTarget, BzlModules, CMakeGenerator, ConversionCache, ConversionError,
+                            StarlarkError, TargetGraph, WorkspaceConverter, WorkspaceWatcher, _StarlarkEvaluator,
+                            _scan_literal_calls, convert, main, send_request)
+
 
 def test_simple_library():
     """Test conversion of a simple library"""
@@ -258,3 +268,1235 @@ def test_header_only_library():
 
         # Verify INTERFACE include directories
         assert "target_include_directories(header_only INTERFACE" in cmake_content, "INTERFACE include dirs not set"
+
+
+def test_workspace_root_converts_every_package():
+    """Test that --workspace-root emits a CMakeLists.txt tree wired with add_subdirectory"""
+
+    packages = {
+        "": """
+            cc_library(
+                name = "core",
+                hdrs = ["core.h"],
+            )
+        """,
+        "lib/util": """
+            cc_library(
+                name = "util",
+                hdrs = ["util.h"],
+                srcs = ["util.cc"],
+                deps = ["//:core"],
+            )
+        """,
+        "lib/util/nested": """
+            cc_test(
+                name = "nested_test",
+                srcs = ["nested_test.cc"],
+                deps = [
+                    "//lib/util",
+                    "@com_google_googletest//:gtest_main",
+                ],
+            )
+        """,
+        "app": """
+            cc_binary(
+                name = "app",
+                srcs = ["main.cc"],
+                deps = ["//lib/util:util", "//other:util"],
+            )
+        """,
+        # Same target name as //lib/util; CMake target names are global
+        "other": """
+            cc_library(
+                name = "util",
+                hdrs = ["util.h"],
+            )
+        """,
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for package, content in packages.items():
+            (tmpdir / package).mkdir(parents=True, exist_ok=True)
+            (tmpdir / package / "BUILD.bazel").write_text(textwrap.dedent(content))
+        # Directories without BUILD files and Bazel output symlinks are not packages
+        (tmpdir / "lib" / "README.md").write_text("not a package")
+        (tmpdir / "bazel-out").mkdir()
+        (tmpdir / "bazel-out" / "BUILD").write_text("this is not valid python syntax {")
+
+        result = subprocess.run([
+            "python3", "bazel_to_cmake.py",
+            "--workspace-root", str(tmpdir),
+            "--project-name", "workspace_project"
+        ], capture_output=True, text=True)
+
+        assert result.returncode == 0, f"Converter failed: {result.stderr}"
+
+        root_content = (tmpdir / "CMakeLists.txt").read_text()
+        assert "project(workspace_project" in root_content, "Root CMakeLists.txt missing project()"
+        assert "FetchContent_MakeAvailable(googletest)" in root_content, "External deps not hoisted to root"
+        assert "add_library(core INTERFACE)" in root_content, "Root package target missing"
+        assert "add_subdirectory(app)" in root_content, "app package not added"
+        assert "add_subdirectory(lib/util)" in root_content, "lib/util package not added"
+        assert "add_subdirectory(lib/util/nested)" not in root_content, "Nested package added twice"
+
+        util_content = (tmpdir / "lib" / "util" / "CMakeLists.txt").read_text()
+        assert "project(" not in util_content, "Sub-package must not declare a project"
+        assert "add_library(lib_util_util" in util_content, "util target missing"
+        assert "add_library(lib::util::util ALIAS lib_util_util)" in util_content, "util alias missing"
+        assert "add_subdirectory(nested)" in util_content, "Nested package not added by its parent"
+
+        nested_content = (tmpdir / "lib" / "util" / "nested" / "CMakeLists.txt").read_text()
+        assert "add_test(NAME lib_util_nested_nested_test COMMAND lib_util_nested_nested_test)" in nested_content, \
+            "Nested test missing"
+        test_link_section = _extract_target_section(nested_content,
+                                                    "target_link_libraries(lib_util_nested_nested_test")
+        assert "lib_util_util" in test_link_section, "Cross-package dependency not linked"
+
+        app_link_section = _extract_target_section((tmpdir / "app" / "CMakeLists.txt").read_text(),
+                                                   "target_link_libraries(app_app")
+        assert "lib_util_util" in app_link_section and "other_util" in app_link_section, \
+            "Targets sharing a name in different packages must stay distinct"
+
+        assert (tmpdir / "app" / "CMakeLists.txt").exists(), "app CMakeLists.txt not generated"
+        assert not (tmpdir / "bazel-out" / "CMakeLists.txt").exists(), "bazel-* directories must be skipped"
+        assert not (tmpdir / "lib" / "CMakeLists.txt").exists(), "Non-package directories must be skipped"
+
+
+def test_parallel_parsing_matches_serial_output():
+    """Test that --jobs produces byte-identical output to serial parsing"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for i in range(8):
+            package = tmpdir / f"pkg{i}"
+            package.mkdir()
+            (package / "BUILD.bazel").write_text(textwrap.dedent(f"""
+                cc_library(
+                    name = "lib{i}",
+                    hdrs = ["lib{i}.h"],
+                    srcs = ["lib{i}.cc"],
+                    deps = ["@com_google_googletest//:gtest"] if {i} % 2 else [],
+                )
+            """))
+
+        outputs = {}
+        for jobs in ["1", "4"]:
+            result = subprocess.run([
+                "python3", "bazel_to_cmake.py",
+                "--workspace-root", str(tmpdir),
+                "--jobs", jobs,
+            ], capture_output=True, text=True)
+            assert result.returncode == 0, f"Converter failed with --jobs {jobs}: {result.stderr}"
+            outputs[jobs] = {p: p.read_text() for p in sorted(tmpdir.rglob("CMakeLists.txt"))}
+
+        assert len(outputs["1"]) == 9, "Expected one CMakeLists.txt per package plus the root"
+        assert outputs["1"] == outputs["4"], "Parallel parsing changed the generated output"
+
+        result = subprocess.run(["python3", "bazel_to_cmake.py", "--workspace-root", str(tmpdir), "--jobs", "-1"],
+                                capture_output=True, text=True)
+        assert result.returncode == 2 and "expected a non-negative integer" in result.stderr
+
+
+def test_cache_skips_unchanged_packages():
+    """Test that --cache-dir reuses entries for unchanged BUILD files only"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        workspace = tmpdir / "workspace"
+        cache_dir = tmpdir / "cache"
+        for name in ["a", "b"]:
+            (workspace / name).mkdir(parents=True)
+            (workspace / name / "BUILD.bazel").write_text(f'cc_library(name = "{name}", hdrs = ["{name}.h"])\n')
+
+        def run():
+            result = subprocess.run([
+                "python3", "bazel_to_cmake.py",
+                "--workspace-root", str(workspace),
+                "--cache-dir", str(cache_dir),
+            ], capture_output=True, text=True)
+            assert result.returncode == 0, f"Converter failed: {result.stderr}"
+            return result.stdout
+
+        assert "Cache: 0 hits, 2 misses" in run(), "Cold run should miss every package"
+        first_output = (workspace / "a" / "CMakeLists.txt").read_text()
+        assert "Cache: 2 hits, 0 misses" in run(), "Warm run should hit every package"
+        assert (workspace / "a" / "CMakeLists.txt").read_text() == first_output, "Cached output differs"
+
+        (workspace / "b" / "BUILD.bazel").write_text('cc_library(name = "b2", hdrs = ["b2.h"])\n')
+        assert "Cache: 1 hits, 1 misses" in run(), "Only the edited package should miss"
+        assert "add_library(b_b2 INTERFACE)" in (workspace / "b" / "CMakeLists.txt").read_text()
+
+        result = subprocess.run([
+            "python3", "bazel_to_cmake.py",
+            "--workspace-root", str(workspace),
+            "--cache-dir", str(cache_dir),
+            "--project-name", "other_project",
+        ], capture_output=True, text=True)
+        assert "Cache: 0 hits, 2 misses" in result.stdout, "Changing options must invalidate the cache"
+
+    # Identical BUILD files in different packages must not share cached targets
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for package in ("x", "y"):
+            (tmpdir / package).mkdir()
+            (tmpdir / package / "BUILD").write_text('cc_library(name = "lib", hdrs = ["lib.h"])\n')
+        for _ in range(2):
+            converter = WorkspaceConverter(tmpdir, CMakeGenerator(), cache=ConversionCache(tmpdir / ".cache", {}))
+            converter.convert()
+            assert [t.label for t in converter.packages[Path("y")]] == ["//y:lib"]
+        assert converter.cache.hits == 2
+        assert "add_library(y_lib INTERFACE)" in (tmpdir / "y" / "CMakeLists.txt").read_text()
+
+
+def test_identical_output_is_not_rewritten():
+    """Test that regenerating identical content leaves the file and its mtime untouched"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        build_file = tmpdir / "BUILD.bazel"
+        cmake_file = tmpdir / "CMakeLists.txt"
+        build_file.write_text('cc_library(name = "lib", hdrs = ["lib.h"])\n')
+
+        def run():
+            result = subprocess.run([
+                "python3", "bazel_to_cmake.py",
+                "--build-file", str(build_file),
+                "--output", str(cmake_file),
+            ], capture_output=True, text=True)
+            assert result.returncode == 0, f"Converter failed: {result.stderr}"
+            return result.stdout
+
+        assert f"Generated {cmake_file}" in run()
+        old_mtime = 1_000_000_000
+        os.utime(cmake_file, (old_mtime, old_mtime))
+
+        assert "is up to date" in run(), "Identical output should be reported as up to date"
+        assert cmake_file.stat().st_mtime == old_mtime, "Identical output must not be rewritten"
+
+        build_file.write_text('cc_library(name = "lib2", hdrs = ["lib.h"])\n')
+        assert f"Generated {cmake_file}" in run()
+        assert "add_library(lib2 INTERFACE)" in cmake_file.read_text()
+        assert sorted(p.name for p in tmpdir.iterdir()) == ["BUILD.bazel", "CMakeLists.txt"], \
+            "Temporary files left behind"
+
+
+def test_starlark_expressions():
+    """Test that the restricted evaluator handles the Starlark subset BUILD files use"""
+
+    build_content = textwrap.dedent("""
+        NAMES = ["alpha", "beta"]
+        COMMON_DEPS = [":base"]
+        PREFIX = "gen_"
+
+        cc_library(
+            name = "base",
+            hdrs = ["base.h"],
+        )
+
+        cc_library(
+            name = "alpha_dep",
+            hdrs = ["alpha_dep.h"],
+        )
+
+        [cc_library(
+            name = PREFIX + name,
+            srcs = ["%s.cc" % name],
+            hdrs = [name + ".h"],
+            deps = COMMON_DEPS + [dep for dep in [":alpha_dep"] if name == "alpha"],
+        ) for name in NAMES]
+
+        FLAGS = {"linux": "x", "mac": "y"}
+        cc_binary(
+            name = "tool",
+            srcs = sorted(["{}.cc".format(k) for k, v in FLAGS.items() if v != "y"]),
+            deps = [":" + PREFIX + "beta"] if len(NAMES) > 1 else [],
+        )
+    """)
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        build_file = tmpdir / "BUILD.bazel"
+        cmake_file = tmpdir / "CMakeLists.txt"
+        build_file.write_text(build_content)
+
+        result = subprocess.run([
+            "python3", "bazel_to_cmake.py",
+            "--build-file", str(build_file),
+            "--output", str(cmake_file),
+        ], capture_output=True, text=True)
+
+        assert result.returncode == 0, f"Converter failed: {result.stdout}{result.stderr}"
+        cmake_content = cmake_file.read_text()
+
+        alpha_section = _extract_target_section(cmake_content, "add_library(gen_alpha")
+        assert "alpha.cc" in alpha_section and "alpha.h" in alpha_section
+        alpha_link_section = _extract_target_section(cmake_content, "target_link_libraries(gen_alpha")
+        assert "base" in alpha_link_section and "alpha_dep" in alpha_link_section
+        beta_link_section = _extract_target_section(cmake_content, "target_link_libraries(gen_beta")
+        assert "alpha_dep" not in beta_link_section, "Comprehension filter not applied"
+
+        tool_section = _extract_target_section(cmake_content, "add_executable(tool")
+        assert "linux.cc" in tool_section and "mac.cc" not in tool_section
+        assert "gen_beta" in _extract_target_section(cmake_content, "target_link_libraries(tool")
+
+
+def test_evaluator_rejects_non_starlark_code():
+    """Test that BUILD files cannot escape the restricted evaluator or exhaust memory"""
+
+    cases = {
+        "import": "import os\n",
+        "dunder": 'cc_library(name = "x", hdrs = __import__("os").listdir("."))\n',
+        "attribute": 'cc_library(name = "x", hdrs = "".__class__.__subclasses__())\n',
+        "lambda": 'f = lambda: 1\n',
+        "memory": 'x = ["a"] * 100000000\n',
+        "extend": 'l = [0] * 1000; [l.extend(l) for _ in range(12)]\n',
+        "format": 'x = "{:>50000000}".format("x")\n',
+        "percent": 'x = "%50000000s" % "x"\n',
+        "integer": 'l = [3]; [l.append(l[-1] * l[-1]) for _ in range(40)]\n',
+        # Strings built from large operands are rejected before they are allocated
+        "str": 's = "x" * 1000000; x = str([s] * 800)\n',
+        "replace": 's = "x" * 1000000; x = s.replace("x", "xx")\n',
+        "format_args": 's = "x" * 1000000; x = ("{}" * 800).format(*([s] * 800))\n',
+        "join": 's = "x" * 1000000; x = s.join(["a"] * 800)\n',
+        "percent_args": 's = "x" * 1000000; x = "%s" % ([s] * 800,)\n',
+    }
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for case, content in cases.items():
+            build_file = tmpdir / f"{case}.bazel"
+            build_file.write_text(content)
+
+            result = subprocess.run([
+                "python3", "bazel_to_cmake.py",
+                "--build-file", str(build_file),
+                "--output", str(tmpdir / "CMakeLists.txt"),
+            ], capture_output=True, text=True)
+
+            assert result.returncode != 0, f"Expected {case} BUILD file to be rejected"
+            assert "Traceback" not in result.stderr, f"{case} error not reported cleanly:\n{result.stderr}"
+            assert f"{case}.bazel:1:" in result.stdout, f"{case} error lacks a location: {result.stdout}"
+
+    with pytest.raises(StarlarkError, match="nested too deeply"):
+        convert("x = " + " + ".join(['"a"'] * 20000))
+
+    # Size checks leave ordinary string building alone
+    convert(textwrap.dedent("""
+        x = str([1, "a", {"k": (2, 3)}]) + "{} {!r}".format("a", "b") + "%s-%d" % ("q", 3)
+        x += "a.b".replace(".", "/") + ",".join(["a", "b"])
+        if x != "[1, 'a', {'k': (2, 3)}]a 'b'q-3a/ba,b":
+            fail(x)
+    """))
+
+
+def test_literal_fast_path_matches_evaluator():
+    """Test that the literal-call fast path agrees with full evaluation and bails out on dynamic code"""
+
+    literal_content = Path("BUILD.bazel").read_text() + textwrap.dedent("""
+        # Trailing comment with "quotes" and 'apostrophes'
+        cc_binary(name = 'tool', srcs = ["main.cc",], deps = [":strong_typedefs"],)
+    """)
+    assert _scan_literal_calls(literal_content) is not None, "Literal BUILD file should take the fast path"
+
+    fast_targets = BazelParser().parse_string(literal_content)
+    evaluated_targets = BazelParser(fast_path=False).parse_string(literal_content)
+    assert [t.to_dict() for t in fast_targets] == [t.to_dict() for t in evaluated_targets]
+    assert [t.name for t in fast_targets] == ["strong_typedefs", "strong_typedefs_test", "tool"]
+
+    for dynamic_content in [
+        'SRCS = ["a.cc"]\ncc_library(name = "a", srcs = SRCS)',
+        'cc_library(name = "a", srcs = ["a.cc"] + ["b.cc"])',
+        'cc_library(name = "a", srcs = [s for s in ["a.cc"]])',
+        'cc_library(name = """a""")',
+        'cc_library(name = "a\\n")',
+    ]:
+        assert _scan_literal_calls(dynamic_content) is None, f"Fast path accepted dynamic code: {dynamic_content}"
+
+
+def test_targets_are_compact():
+    """Test that parsed targets are slotted, tuple-valued and share interned labels"""
+
+    targets = BazelParser().parse_string(textwrap.dedent("""
+        cc_library(name = "a", hdrs = ["a.h"], deps = ["//common:" + "base"])
+        cc_library(name = "b", hdrs = ["b.h"], deps = ["//common:base"])
+    """))
+
+    assert not hasattr(targets[0], "__dict__"), "BazelTarget should use __slots__"
+    assert isinstance(targets[0].deps, tuple) and isinstance(targets[0].srcs, tuple)
+    assert targets[0].deps[0] is targets[1].deps[0], "Identical labels should be interned"
+    assert BazelTarget.from_dict(targets[0].to_dict()).deps == ("//common:base",)
+
+
+def test_target_graph_resolution_and_validation():
+    """Test label canonicalization, topological ordering and dangling/cycle detection"""
+
+    targets = BazelParser().parse_string(textwrap.dedent("""
+        cc_binary(name = "app", srcs = ["main.cc"], deps = ["//lib:util", ":helpers"])
+        cc_library(name = "helpers", hdrs = ["helpers.h"], deps = ["//lib"])
+    """), package="app") + BazelParser().parse_string(textwrap.dedent("""
+        cc_library(name = "util", hdrs = ["util.h"], deps = [":lib"])
+        cc_library(name = "lib", hdrs = ["lib.h"], deps = ["@com_google_googletest//:gtest"])
+    """), package="lib")
+
+    graph = TargetGraph(targets)
+    assert graph.resolve("//lib").name == "lib"
+    assert graph.resolve(":helpers", "app").name == "helpers"
+    assert graph.resolve("helpers", "app").name == "helpers"
+    assert graph.edges["//lib:lib"] == (), "External deps are not graph edges"
+    assert graph.errors() == []
+
+    order = graph.topological_order()
+    for label, deps in graph.edges.items():
+        for dep in deps:
+            assert order.index(dep) < order.index(label), f"{dep} must come before {label}"
+
+    broken = TargetGraph(BazelParser().parse_string(textwrap.dedent("""
+        cc_library(name = "a", hdrs = ["a.h"], deps = [":b"])
+        cc_library(name = "b", hdrs = ["b.h"], deps = [":a", ":missing", "//elsewhere:ok"])
+        cc_library(name = "c", hdrs = ["c.h"], deps = [":c"])
+    """)))
+    errors = broken.errors()
+    assert "//:b depends on missing target //:missing" in errors
+    assert not any("elsewhere" in error for error in errors), "Deps into unparsed packages are not dangling"
+    assert sorted(map(sorted, broken.cycles())) == [["//:a", "//:b"], ["//:c"]]
+
+    # Targets in packages get package-qualified CMake names, which can still clash
+    clashing = [BazelTarget("cc_library", "c", package="a_b"), BazelTarget("cc_library", "b_c", package="a"),
+                BazelTarget("cc_library", "c", package="a")]
+    assert [target.cmake_name for target in clashing] == ["a_b_c", "a_b_c", "a_c"]
+    assert TargetGraph(clashing).errors() == ["targets share the CMake target name a_b_c: //a:b_c, //a_b:c"]
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        build_file = tmpdir / "BUILD.bazel"
+        build_file.write_text('cc_library(name = "a", hdrs = ["a.h"], deps = [":missing"])\n')
+        result = subprocess.run([
+            "python3", "bazel_to_cmake.py",
+            "--build-file", str(build_file),
+            "--output", str(tmpdir / "CMakeLists.txt"),
+        ], capture_output=True, text=True)
+        assert result.returncode != 0, "Dangling deps should fail the conversion"
+        assert "depends on missing target //:missing" in result.stdout
+        assert not (tmpdir / "CMakeLists.txt").exists()
+
+
+def test_workspace_benchmark_saves_results():
+    """Test that the synthetic workspace benchmark runs and saves comparable JSON results"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        results_file = tmpdir / "results.json"
+
+        result = subprocess.run([
+            "python3", "bazel_to_cmake_benchmark.py", "workspace",
+            "--packages", "20",
+            "--targets-per-package", "3",
+            "--dynamic-fraction", "0.5",
+            "--output", str(results_file),
+        ], capture_output=True, text=True)
+        assert result.returncode == 0, f"Benchmark failed: {result.stderr}"
+
+        results = json.loads(results_file.read_text())
+        assert results["targets"] == 60
+        assert set(results["phases"]) == {"discover", "read", "parse", "resolve", "generate"}
+        assert results["peak_rss_mb"] > 0
+
+        result = subprocess.run([
+            "python3", "bazel_to_cmake_benchmark.py", "workspace",
+            "--packages", "20",
+            "--targets-per-package", "3",
+            "--dynamic-fraction", "0.5",
+            "--compare", str(results_file),
+        ], capture_output=True, text=True)
+        assert result.returncode == 0, f"Benchmark comparison failed: {result.stderr}"
+        assert f"x of {results['revision']}" in result.stdout
+
+
+def test_parse_and_memory_benchmarks_run():
+    """Test that the parse and memory benchmarks run against the current converter"""
+
+    for command in (["parse", "--build-file", "BUILD.bazel", "--iterations", "2"], ["memory", "--targets", "100"]):
+        result = subprocess.run(["python3", "bazel_to_cmake_benchmark.py", *command], capture_output=True, text=True)
+        assert result.returncode == 0, f"{command[0]} benchmark failed: {result.stderr}"
+        assert "x vs exec" in result.stdout or "of legacy" in result.stdout
+
+
+def test_timings_profile_and_trace():
+    """Test that --timings, --profile and --trace report every phase and BUILD file"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        workspace = tmpdir / "workspace"
+        for name in ["a", "b", "c"]:
+            (workspace / name).mkdir(parents=True)
+            (workspace / name / "BUILD.bazel").write_text(f'cc_library(name = "{name}", hdrs = ["{name}.h"])\n')
+
+        result = subprocess.run([
+            "python3", "bazel_to_cmake.py",
+            "--workspace-root", str(workspace),
+            "--jobs", "2",
+            "--timings",
+            "--profile", str(tmpdir / "run.prof"),
+            "--trace", str(tmpdir / "trace.json"),
+        ], capture_output=True, text=True)
+        assert result.returncode == 0, f"Converter failed: {result.stderr}"
+
+        for phase in ["discover", "read", "parse", "resolve", "generate", "write"]:
+            assert f"\n{phase} " in result.stdout, f"Phase {phase} missing from timings:\n{result.stdout}"
+
+        assert (tmpdir / "run.prof").stat().st_size > 0, "Profile not written"
+
+        events = json.loads((tmpdir / "trace.json").read_text())["traceEvents"]
+        file_spans = [e for e in events if e["cat"] == "file"]
+        assert sorted(Path(e["name"]).parent.name for e in file_spans) == ["a", "b", "c"]
+        assert all(e["ph"] == "X" and e["dur"] >= 0 for e in events)
+
+
+def test_convert_in_process():
+    """Test the in-process API on BUILD text and on a BUILD file path"""
+
+    result = convert(textwrap.dedent("""
+        cc_library(name = "lib", hdrs = ["lib.h"], srcs = ["lib.cc"])
+        cc_test(name = "lib_test", srcs = ["lib_test.cc"], deps = [":lib", "@com_google_googletest//:gtest_main"])
+    """), project_name="in_process")
+
+    assert [t.name for t in result.targets] == ["lib", "lib_test"]
+    assert "project(in_process LANGUAGES CXX)" in result.cmake_text
+    assert "add_test(NAME lib_test COMMAND lib_test)" in result.cmake_text
+
+    from_file = convert(Path("BUILD.bazel"))
+    assert [t.name for t in from_file.targets] == ["strong_typedefs", "strong_typedefs_test"]
+    assert "add_library(strong_typedefs INTERFACE)" in from_file.cmake_text
+
+    with pytest.raises(ConversionError, match="missing target //:absent"):
+        convert('cc_library(name = "a", hdrs = ["a.h"], deps = [":absent"])')
+
+
+def test_batch_build_files_and_manifest():
+    """Test converting repeated --build-file/--output pairs and a manifest in one run"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for name in ["a", "b", "c", "d"]:
+            (tmpdir / name).mkdir()
+            (tmpdir / name / "BUILD.bazel").write_text(f'cc_library(name = "{name}", hdrs = ["{name}.h"])\n')
+        (tmpdir / "broken").mkdir()
+        (tmpdir / "broken" / "BUILD.bazel").write_text("this is not valid python syntax {")
+
+        (tmpdir / "manifest.txt").write_text(textwrap.dedent("""
+            # BUILD file            output
+            c/BUILD.bazel           c/out/CMakeLists.txt
+            d/BUILD.bazel
+            broken/BUILD.bazel
+        """))
+        (tmpdir / "c" / "out").mkdir()
+
+        result = subprocess.run([
+            "python3", "bazel_to_cmake.py",
+            "--build-file", str(tmpdir / "a" / "BUILD.bazel"), "--output", str(tmpdir / "a.cmake"),
+            "--build-file", str(tmpdir / "b" / "BUILD.bazel"), "--output", str(tmpdir / "b.cmake"),
+            "--manifest", str(tmpdir / "manifest.txt"),
+        ], capture_output=True, text=True)
+
+        assert result.returncode != 0, "A failing BUILD file should fail the batch"
+        assert "Converted 4 of 5 BUILD files" in result.stdout, result.stdout
+        assert "add_library(a INTERFACE)" in (tmpdir / "a.cmake").read_text()
+        assert "add_library(b INTERFACE)" in (tmpdir / "b.cmake").read_text()
+        assert "add_library(c INTERFACE)" in (tmpdir / "c" / "out" / "CMakeLists.txt").read_text()
+        assert "add_library(d INTERFACE)" in (tmpdir / "d" / "CMakeLists.txt").read_text()
+        assert "add_library(a" not in (tmpdir / "b.cmake").read_text(), "Targets leaked between files"
+
+        result = subprocess.run([
+            "python3", "bazel_to_cmake.py",
+            "--build-file", str(tmpdir / "a" / "BUILD.bazel"),
+            "--build-file", str(tmpdir / "b" / "BUILD.bazel"),
+            "--output", str(tmpdir / "only_one.cmake"),
+        ], capture_output=True, text=True)
+        assert result.returncode != 0, "Mismatched --output count should be rejected"
+
+    parser = BazelParser()
+    assert [t.name for t in parser.parse_string('cc_library(name = "first")')] == ["first"]
+    assert [t.name for t in parser.parse_string('cc_library(name = "second")')] == ["second"]
+
+
+def test_serve_regenerates_packages_incrementally():
+    """Test the conversion daemon against a fresh full conversion of the same tree"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / "lib").mkdir()
+        (tmpdir / "lib" / "BUILD.bazel").write_text('cc_library(name = "core", hdrs = ["core.h"])\n')
+        (tmpdir / "app").mkdir()
+        (tmpdir / "app" / "BUILD.bazel").write_text(
+            'cc_binary(name = "app", srcs = ["main.cc"], deps = ["//lib:core"])\n')
+        socket_path = tmpdir / "serve.sock"
+
+        server = subprocess.Popen([
+            "python3", "bazel_to_cmake.py", "serve",
+            "--socket", str(socket_path), "--workspace-root", str(tmpdir),
+        ], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        try:
+            deadline = time.monotonic() + 30
+            while not socket_path.exists():
+                assert server.poll() is None, server.stdout.read()
+                assert time.monotonic() < deadline, "Server did not start"
+                time.sleep(0.05)
+
+            (tmpdir / "lib" / "BUILD.bazel").write_text(
+                'cc_library(name = "core", hdrs = ["core.h"])\n'
+                'cc_library(name = "util", srcs = ["util.cc"], deps = [":core"])\n')
+            reply = send_request(socket_path, {"op": "regenerate", "packages": ["lib"]})
+            assert reply["ok"], reply
+            assert reply["written"] == [str(tmpdir / "lib" / "CMakeLists.txt")]
+            assert "add_library(lib_util" in (tmpdir / "lib" / "CMakeLists.txt").read_text()
+
+            (tmpdir / "app" / "BUILD.bazel").write_text(
+                'cc_binary(name = "app", srcs = ["main.cc"], deps = ["//lib:missing"])\n')
+            reply = send_request(socket_path, {"op": "regenerate", "package": "//app"})
+            assert not reply["ok"] and "//lib:missing" in reply["error"], reply
+
+            (tmpdir / "app" / "BUILD.bazel").write_text(
+                'cc_binary(name = "app", srcs = ["main.cc"], deps = ["//lib:util"])\n')
+            (tmpdir / "new").mkdir()
+            (tmpdir / "new" / "BUILD.bazel").write_text('cc_library(name = "fresh", hdrs = ["fresh.h"])\n')
+            reply = send_request(socket_path, {"op": "regenerate", "packages": ["app", "new/BUILD.bazel"]})
+            assert reply["ok"], reply
+            assert "add_subdirectory(new)" in (tmpdir / "CMakeLists.txt").read_text()
+            assert "    lib_util\n" in (tmpdir / "app" / "CMakeLists.txt").read_text()
+
+            reply = send_request(socket_path, {"op": "status"})
+            assert reply["ok"] and reply["packages"] == 3 and reply["targets"] == 4, reply
+            assert not send_request(socket_path, {"op": "bogus"})["ok"]
+
+            incremental = {path: path.read_text() for path in tmpdir.rglob("CMakeLists.txt")}
+            result = subprocess.run(["python3", "bazel_to_cmake.py", "--workspace-root", str(tmpdir)],
+                                    capture_output=True, text=True)
+            assert result.returncode == 0, result.stdout
+            assert "(4 up to date)" in result.stdout, "Incremental output differs from a full conversion"
+            assert incremental == {path: path.read_text() for path in tmpdir.rglob("CMakeLists.txt")}
+
+            assert send_request(socket_path, {"op": "shutdown"})["ok"]
+            assert server.wait(timeout=30) == 0
+            assert not socket_path.exists(), "Socket should be removed on shutdown"
+        finally:
+            if server.poll() is None:
+                server.kill()
+            server.stdout.close()
+
+
+def test_watch_regenerates_changed_packages():
+    """Test change detection with inotify and polling, and the --watch loop"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / "tools").mkdir()
+        (tmpdir / "tools" / "defs.bzl").write_text("def helper():\n    pass\n")
+        (tmpdir / "lib").mkdir()
+        (tmpdir / "lib" / "BUILD.bazel").write_text(
+            'load("//tools:defs.bzl", "helper")\ncc_library(name = "core", hdrs = ["core.h"])\n')
+
+        converter = WorkspaceConverter(tmpdir, CMakeGenerator())
+        converter.convert()
+        assert converter.bzl_dependents[Path("tools/defs.bzl")] == {Path("lib")}
+
+        for use_inotify in (True, False):
+            watcher = WorkspaceWatcher(tmpdir, poll_interval=0.05, use_inotify=use_inotify)
+            try:
+                for edit in range(3):
+                    (tmpdir / "lib" / "BUILD.bazel").write_text(
+                        (tmpdir / "lib" / "BUILD.bazel").read_text() + f"# edit {edit}\n")
+                (tmpdir / "tools" / "defs.bzl").write_text(f"def helper():\n    pass\n# {use_inotify}\n")
+                (tmpdir / "lib" / "notes.txt").write_text("not watched")
+                changes = next(watcher.changes())
+                assert changes == {Path("lib/BUILD.bazel"), Path("tools/defs.bzl")}, (use_inotify, changes)
+
+                (tmpdir / f"new_{use_inotify}").mkdir()
+                (tmpdir / f"new_{use_inotify}" / "BUILD").write_text('cc_library(name = "fresh")\n')
+                assert Path(f"new_{use_inotify}") in next(watcher.changes())
+            finally:
+                watcher.close()
+
+        # Without inotify, the default poll interval keeps an edit within the ~100 ms budget
+        watcher = WorkspaceWatcher(tmpdir, use_inotify=False)
+        try:
+            (tmpdir / "lib" / "BUILD.bazel").write_text('cc_library(name = "core", hdrs = ["core.h"])\n')
+            started = time.monotonic()
+            assert next(watcher.changes()) == {Path("lib/BUILD.bazel")}
+            assert time.monotonic() - started < 0.3, "Polling fallback reported the edit too late"
+        finally:
+            watcher.close()
+
+        watch = subprocess.Popen(["python3", "bazel_to_cmake.py", "--workspace-root", str(tmpdir), "--watch"],
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        try:
+            for line in watch.stdout:
+                if line.startswith("Watching"):
+                    break
+            (tmpdir / "lib" / "BUILD.bazel").write_text('cc_library(name = "watched", hdrs = ["w.h"])\n')
+            deadline = time.monotonic() + 30
+            while "add_library(lib_watched" not in (tmpdir / "lib" / "CMakeLists.txt").read_text():
+                assert watch.poll() is None and time.monotonic() < deadline, "Change was not picked up"
+                time.sleep(0.02)
+        finally:
+            watch.kill()
+            watch.wait()
+            watch.stdout.close()
+
+
+def test_glob_matches_workspace_snapshot():
+    """Test glob() include/exclude/exclude_directories semantics, serially and in parse workers"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for path in ["lib/a.cc", "lib/b.cc", "lib/a.h", "lib/impl/c.cc", "lib/impl/deep/d.cc",
+                     "lib/sub/e.cc", "other/f.cc", "lib/impl/CMakeLists.txt"]:
+            (tmpdir / path).parent.mkdir(parents=True, exist_ok=True)
+            (tmpdir / path).write_text("")
+        (tmpdir / "lib" / "BUILD.bazel").write_text(textwrap.dedent("""
+            cc_library(
+                name = "lib",
+                hdrs = glob(["*.h"]),
+                srcs = glob(["**/*.cc"], exclude = ["b.cc"]),
+            )
+            cc_library(
+                name = "everything",
+                data = glob(["*"], exclude_directories = 0),
+            )
+            cc_library(name = "text", data = glob(["**/*.txt"]))
+        """))
+        (tmpdir / "lib" / "sub" / "BUILD").write_text('cc_library(name = "sub", srcs = glob(["*.cc"]))\n')
+        (tmpdir / "other" / "BUILD").write_text('cc_library(name = "other", srcs = glob(["*.cc"]) + ["x.cc"])\n')
+
+        for jobs in (1, 2):
+            converter = WorkspaceConverter(tmpdir, CMakeGenerator(), jobs)
+            converter.convert()
+            lib, everything, text = converter.packages[Path("lib")]
+            assert lib.hdrs == ("a.h",)
+            assert lib.srcs == ("a.cc", "impl/c.cc", "impl/deep/d.cc"), "Subpackage files must not match"
+            assert everything.data == ("BUILD.bazel", "a.cc", "a.h", "b.cc", "impl"), "Generated files never match"
+            assert text.data == ("impl/CMakeLists.txt",), "Hand-written CMakeLists.txt files match like any file"
+            assert converter.packages[Path("lib/sub")][0].srcs == ("e.cc",)
+            assert converter.packages[Path("other")][0].srcs == ("f.cc", "x.cc")
+
+        (tmpdir / "lib" / "g.cc").write_text("")
+        (tmpdir / "lib" / "BUILD.bazel").write_text('cc_library(name = "lib", srcs = glob(["*.cc"]))\n')
+        converter.refresh([Path("lib")])
+        assert converter.packages[Path("lib")][0].srcs == ("a.cc", "b.cc", "g.cc")
+
+        result = convert(tmpdir / "other" / "BUILD", package="other")
+        assert result.targets[0].srcs == ("f.cc", "x.cc")
+
+    with pytest.raises(StarlarkError, match="invalid glob pattern"):
+        BazelParser().parse_string('cc_library(name = "x", srcs = glob(["../*.cc"]))')
+    with pytest.raises(StarlarkError, match="list of strings"):
+        BazelParser().parse_string('cc_library(name = "x", srcs = glob("*.cc"))')
+
+
+def test_bzl_macros_are_loaded_once(monkeypatch):
+    """Test load() of .bzl macros: one evaluation per run, native rules, cache and refresh"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / "tools").mkdir()
+        (tmpdir / "tools" / "common.bzl").write_text('TEST_SUFFIX = "_test"\n_PRIVATE = 1\n')
+        (tmpdir / "tools" / "defs.bzl").write_text(textwrap.dedent("""
+            load(":common.bzl", "TEST_SUFFIX")
+
+            def cc_module(name, srcs = [], deps = [], **kwargs):
+                native.cc_library(name = name, srcs = srcs, hdrs = [name + ".h"], deps = deps, **kwargs)
+                for src in srcs:
+                    if not src.endswith(".cc"):
+                        continue
+                    native.cc_test(name = name + TEST_SUFFIX, srcs = [name + "_test.cc"], deps = [":" + name])
+                    break
+                return native.package_name()
+        """))
+        for i in range(20):
+            (tmpdir / f"p{i}").mkdir()
+            (tmpdir / f"p{i}" / "BUILD.bazel").write_text(textwrap.dedent("""
+                load("//tools:defs.bzl", "cc_module")
+                load("@rules_cc//cc:defs.bzl", "cc_library", "cc_proto_library")
+                cc_module(name = "m", srcs = ["m.cc"])
+                cc_library(name = "extra", deps = [":m"])
+            """))
+        (tmpdir / "alias").mkdir()
+        (tmpdir / "alias" / "BUILD").write_text(
+            'load("//tools:defs.bzl", cc_library = "cc_module")\ncc_library(name = "x", srcs = ["x.cc"])\n')
+
+        converter = WorkspaceConverter(tmpdir, CMakeGenerator(), cache=ConversionCache(tmpdir / ".cache", {}))
+        converter.convert()
+        assert converter.modules.evaluations == 2, "Each .bzl file should be evaluated once per run"
+        assert set(converter.modules.exports[Path("tools/common.bzl")]) == {"TEST_SUFFIX"}
+        m, m_test, extra = converter.packages[Path("p3")]
+        assert (m.name, m.hdrs, m_test.name, m_test.deps, extra.name) == ("m", ("m.h",), "m_test", (":m",), "extra")
+        assert [t.name for t in converter.packages[Path("alias")]] == ["x", "x_test"], \
+            "A local load may rebind rule names, so it must not take the fast path"
+        assert converter.bzl_dependents[Path("tools/common.bzl")] == converter.bzl_dependents[Path("tools/defs.bzl")]
+
+        (tmpdir / "tools" / "common.bzl").write_text('TEST_SUFFIX = "_unittest"\n')
+        converter.refresh([])
+        assert converter.packages[Path("p3")][1].name == "m_unittest", "Editing a loaded .bzl file should re-parse"
+
+        converter = WorkspaceConverter(tmpdir, CMakeGenerator(), cache=ConversionCache(tmpdir / ".cache", {}))
+        converter.convert()
+        assert converter.packages[Path("p3")][1].name == "m_unittest", "Cache entries must track loaded .bzl files"
+
+    for content, message in [
+        ('def f():\n    f()\nf()\n', "called recursively"),
+        ('load("//missing:defs.bzl", "x")\n', "file not found"),
+        ('return 1\n', "return outside function"),
+    ]:
+        with pytest.raises(StarlarkError, match=message):
+            BazelParser().parse_string(content)
+
+    # Steps taken inside called functions count against the calling file's budget
+    looped_calls = 'def f():\n    return [i for i in range(100)]\n\nx = [f() for _ in range(100)]\n'
+    BazelParser().parse_string(looped_calls)
+    monkeypatch.setattr(_StarlarkEvaluator, "max_steps", 2000)
+    with pytest.raises(StarlarkError, match="exceeded 2000 steps"):
+        BazelParser().parse_string(looped_calls)
+
+
+def test_single_build_file_loads_from_workspace_root(monkeypatch):
+    """Test that a nested BUILD file converted on its own resolves //labels against the workspace root"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / "MODULE.bazel").write_text('module(name = "example")\n')
+        (tmpdir / "other").mkdir()
+        (tmpdir / "other" / "defs.bzl").write_text(
+            'def header_library(name):\n    native.cc_library(name = name, hdrs = native.glob(["*.h"]))\n')
+        (tmpdir / "pkg" / "nested").mkdir(parents=True)
+        (tmpdir / "pkg" / "nested" / "nested.h").write_text("")
+        build_file = tmpdir / "pkg" / "nested" / "BUILD.bazel"
+        build_file.write_text('load("//other:defs.bzl", "header_library")\nheader_library(name = "lib")\n')
+
+        result = convert(build_file)
+        assert [(t.label, t.hdrs) for t in result.targets] == [("//pkg/nested:lib", ("nested.h",))]
+
+        result = subprocess.run(["python3", "bazel_to_cmake.py", "--build-file", str(build_file),
+                                 "--output", str(build_file.parent / "CMakeLists.txt")],
+                                capture_output=True, text=True, cwd=Path(__file__).parent)
+        assert result.returncode == 0, result.stdout + result.stderr
+        assert "add_library(pkg_nested_lib INTERFACE)" in (build_file.parent / "CMakeLists.txt").read_text()
+
+        # BUILD files converted in one run share the .bzl module table of their workspace
+        (tmpdir / "pkg" / "top.h").write_text("")
+        (tmpdir / "pkg" / "BUILD").write_text(
+            'load("//other:defs.bzl", "header_library")\nheader_library(name = "top")\n')
+        (tmpdir / "files.txt").write_text("pkg/BUILD\npkg/nested/BUILD.bazel\n")
+        created = []
+        original_init = BzlModules.__init__
+
+        def record_init(self, workspace_root):
+            created.append(self)
+            original_init(self, workspace_root)
+
+        monkeypatch.setattr(BzlModules, "__init__", record_init)
+        assert main(["--manifest", str(tmpdir / "files.txt")]) == 0
+        assert [modules.evaluations for modules in created] == [1], "defs.bzl should be evaluated once per run"
+        assert "add_library(pkg_top INTERFACE)" in (tmpdir / "pkg" / "CMakeLists.txt").read_text()
+
+
+def test_select_emits_generator_expressions():
+    """Test that select() stays lazy and becomes generator expressions, not one target per configuration"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / "config").mkdir()
+        (tmpdir / "config" / "BUILD").write_text(textwrap.dedent("""
+            config_setting(name = "linux", constraint_values = ["@platforms//os:linux"])
+            config_setting(name = "linux_dbg", constraint_values = ["@platforms//os:linux"],
+                           values = {"compilation_mode": "dbg"})
+            config_setting(name = "tracing", define_values = {"tracing": "on"})
+        """))
+        (tmpdir / "lib").mkdir()
+        (tmpdir / "lib" / "BUILD").write_text(textwrap.dedent("""
+            cc_library(
+                name = "lib",
+                srcs = ["common.cc"] + select({
+                    "//config:linux": ["linux.cc"],
+                    "@platforms//os:windows": ["windows.cc"],
+                    "//conditions:default": ["posix.cc"],
+                }),
+                deps = select({"//config:tracing": [":trace"], "//conditions:default": []}),
+            )
+            cc_library(name = "trace", hdrs = ["trace.h"])
+            cc_test(name = "lib_test", srcs = select({"//config:linux_dbg": ["debug_test.cc"]}), deps = [":lib"])
+        """))
+
+        converter = WorkspaceConverter(tmpdir, CMakeGenerator(), cache=ConversionCache(tmpdir / ".cache", {}))
+        converter.convert()
+        lib = converter.packages[Path("lib")][0]
+        assert BazelTarget.from_dict(json.loads(json.dumps(lib.to_dict()))).to_dict() == lib.to_dict()
+        assert converter.generator.graph.edges["//lib:lib"] == \
+            ("//lib:trace", "//config:linux", "//config:tracing"), "Branches and conditions are graph edges"
+
+        cmake_content = (tmpdir / "lib" / "CMakeLists.txt").read_text()
+        for expected in [
+            "    common.cc\n",
+            "    $<$<PLATFORM_ID:Linux>:linux.cc>\n",
+            "    $<$<PLATFORM_ID:Windows>:windows.cc>\n",
+            "    $<$<NOT:$<OR:$<PLATFORM_ID:Linux>,$<PLATFORM_ID:Windows>>>:posix.cc>\n",
+            "    $<$<BOOL:${CONFIG_TRACING}>:lib_trace>\n",
+            'option(CONFIG_TRACING "Bazel condition //config:tracing" OFF)',
+            "    $<$<AND:$<PLATFORM_ID:Linux>,$<CONFIG:Debug>>:debug_test.cc>\n",
+        ]:
+            assert expected in cmake_content, f"Missing {expected!r} in:\n{cmake_content}"
+        assert cmake_content.count("add_library(lib_lib") == 1
+        assert "config_setting" not in (tmpdir / "config" / "CMakeLists.txt").read_text()
+
+        (tmpdir / "config" / "BUILD").write_text(textwrap.dedent("""
+            config_setting(name = "linux", constraint_values = ["@platforms//os:linux"])
+            config_setting(name = "linux_dbg", values = {"compilation_mode": "opt"})
+            config_setting(name = "tracing", values = {"compilation_mode": "dbg"})
+        """))
+        converter.refresh([Path("config")])
+        cmake_content = (tmpdir / "lib" / "CMakeLists.txt").read_text()
+        assert "$<$<CONFIG:Release>:debug_test.cc>" in cmake_content, "Users of a config_setting should be refreshed"
+        assert "$<$<CONFIG:Debug>:lib_trace>" in cmake_content and "option(" not in cmake_content
+
+    with pytest.raises(StarlarkError, match="select"):
+        BazelParser().parse_string('cc_library(name = "x", srcs = select([]))')
+
+
+def test_compile_commands_from_parsed_targets():
+    """Test that --compile-commands writes one entry per source with propagated flags"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / ".bazelrc").write_text(textwrap.dedent("""
+            # Shared flags
+            build --cxxopt='-std=c++20' --copt=-Wall
+            build:asan --copt=-fsanitize=address
+            try-import %workspace%/user.bazelrc
+        """))
+        (tmpdir / "user.bazelrc").write_text("common --cxxopt -fno-exceptions\n")
+        (tmpdir / "lib").mkdir()
+        (tmpdir / "lib" / "BUILD").write_text(textwrap.dedent("""
+            cc_library(
+                name = "lib",
+                srcs = ["lib.cc"] + select({"@platforms//os:linux": ["linux.cc"], "//conditions:default": ["posix.c"]}),
+                hdrs = ["lib.h"],
+                includes = ["include"],
+                defines = ["USE_LIB=1"],
+                local_defines = ["LIB_INTERNAL"],
+                copts = ["-O3"],
+            )
+        """))
+        (tmpdir / "app").mkdir()
+        (tmpdir / "app" / "BUILD").write_text(
+            'cc_binary(name = "app", srcs = ["main.cc", "util.h"], deps = ["//lib"], local_defines = ["APP"])\n')
+
+        output = tmpdir / "compile_commands.json"
+        result = subprocess.run(
+            ["python3", "bazel_to_cmake.py", "--workspace-root", str(tmpdir), "--compile-commands", str(output)],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+            env={name: value for name, value in os.environ.items() if name not in ("CC", "CXX")}
+        )
+        assert result.returncode == 0, result.stdout + result.stderr
+        assert "Wrote 4 compile commands" in result.stdout
+        assert not (tmpdir / "lib" / "CMakeLists.txt").exists()
+
+        entries = {entry["file"]: entry for entry in json.loads(output.read_text())}
+        assert sorted(entries) == ["app/main.cc", "lib/lib.cc", "lib/linux.cc", "lib/posix.c"]
+        assert all(entry["directory"] == str(tmpdir.resolve()) for entry in entries.values())
+        assert entries["lib/lib.cc"]["arguments"] == [
+            "c++", "-Wall", "-std=c++20", "-fno-exceptions", "-O3", "-DUSE_LIB=1", "-DLIB_INTERNAL",
+            "-I.", "-Ilib", "-isystemlib/include", "-c", "lib/lib.cc"]
+        assert entries["app/main.cc"]["arguments"][1:] == [
+            "-Wall", "-std=c++20", "-fno-exceptions", "-DUSE_LIB=1", "-DAPP",
+            "-I.", "-Iapp", "-Ilib", "-isystemlib/include", "-c", "app/main.cc"], \
+            "defines and includes of deps propagate, local_defines and copts do not"
+        assert entries["lib/posix.c"]["arguments"][:2] == ["cc", "-Wall"]
+
+        output.unlink()
+        result = subprocess.run(["python3", "bazel_to_cmake.py", "--compile-commands", str(output),
+                                 "--manifest", str(tmpdir / "manifest.txt")], capture_output=True, text=True)
+        assert result.returncode == 2 and "cannot be combined with --build-file" in result.stderr
+        assert not output.exists()
+
+    # The new attributes also reach the generated CMake targets
+    cmake_text = convert(textwrap.dedent("""
+        cc_library(name = "lib", srcs = ["lib.cc"], includes = ["include"], defines = ["USE_LIB"],
+                   local_defines = ["LIB_INTERNAL"], copts = ["-O3"])
+    """)).cmake_text
+    for expected in [
+        "target_include_directories(lib PUBLIC\n    $<BUILD_INTERFACE:${CMAKE_CURRENT_SOURCE_DIR}/include>\n)",
+        "target_compile_definitions(lib PUBLIC\n    USE_LIB\n)",
+        "target_compile_definitions(lib PRIVATE\n    LIB_INTERNAL\n)",
+        "target_compile_options(lib PRIVATE\n    -O3\n)",
+    ]:
+        assert expected in cmake_text, f"Missing {expected!r} in:\n{cmake_text}"
+
+
+def test_ninja_generator_writes_build_ninja():
+    """Test that --generator ninja writes a build.ninja that builds and runs tests without CMake"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for package in ("app", "lib", "hdr"):
+            (tmpdir / package).mkdir()
+        (tmpdir / "hdr" / "BUILD").write_text('cc_library(name = "hdr", hdrs = ["hdr.h"])\n')
+        (tmpdir / "hdr" / "hdr.h").write_text("inline int h() { return 1; }\n")
+        (tmpdir / "lib" / "BUILD").write_text(textwrap.dedent("""
+            cc_library(name = "lib", srcs = ["lib.cc", "util.cc", "util.c"], hdrs = ["lib.h"], deps = ["//hdr"],
+                       defines = ["LIBV=2"])
+            cc_test(name = "lib_test", srcs = ["lib_test.cc"], deps = [":lib"])
+        """))
+        (tmpdir / "lib" / "util.cc").write_text("int util_cxx() { return 0; }\n")
+        (tmpdir / "lib" / "util.c").write_text("int util_c(void) { return 0; }\n")
+        (tmpdir / "lib" / "lib.h").write_text("int lib();\n")
+        (tmpdir / "lib" / "lib.cc").write_text('#include "hdr/hdr.h"\nint lib() { return h() + LIBV; }\n')
+        (tmpdir / "lib" / "lib_test.cc").write_text('#include "lib.h"\nint main() { return lib() == 3 ? 0 : 1; }\n')
+        (tmpdir / "app" / "BUILD").write_text('cc_binary(name = "app", srcs = ["main.cc"], deps = ["//lib"])\n')
+        (tmpdir / "app" / "main.cc").write_text('#include "lib/lib.h"\nint main() { return lib() - 3; }\n')
+
+        result = subprocess.run(
+            ["python3", "bazel_to_cmake.py", "--workspace-root", str(tmpdir), "--generator", "ninja"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent
+        )
+        assert result.returncode == 0, result.stdout + result.stderr
+        assert not (tmpdir / "CMakeLists.txt").exists()
+
+        ninja_text = (tmpdir / "build.ninja").read_text()
+        for expected in [
+            "build $builddir/lib/_objs/lib/lib.cc.o: cxx lib/lib.cc\n",
+            # Sources differing only in extension get distinct objects
+            "build $builddir/lib/_objs/lib/util.cc.o: cxx lib/util.cc\n",
+            "build $builddir/lib/_objs/lib/util.c.o: cc lib/util.c\n",
+            "build $builddir/lib/liblib.a: ar $builddir/lib/_objs/lib/lib.cc.o $builddir/lib/_objs/lib/util.cc.o "
+            "$builddir/lib/_objs/lib/util.c.o\n",
+            "build $builddir/app/app: link $builddir/app/_objs/app/main.cc.o $builddir/lib/liblib.a\n",
+            "build run_lib_lib_test: run $builddir/lib/lib_test\n",
+            "build test: phony run_lib_lib_test\n",
+        ]:
+            assert expected in ninja_text, f"Missing {expected!r} in:\n{ninja_text}"
+        assert "-DLIBV=2" in ninja_text.split("# cc_binary: //app:app")[1], "defines propagate to dependents"
+        assert "hdr.a" not in ninja_text and "//hdr:hdr" not in ninja_text, "Header-only libraries have no edges"
+
+        if shutil.which("ninja") and shutil.which("c++"):
+            result = subprocess.run(["ninja", "all", "test"], capture_output=True, text=True, cwd=tmpdir)
+            assert result.returncode == 0, result.stdout + result.stderr
+            assert (tmpdir / "ninja-out" / "app" / "app").exists()
+
+        (tmpdir / "build.ninja").unlink()
+        result = subprocess.run(["python3", "bazel_to_cmake.py", "--generator", "ninja", "--workspace-root", str(tmpdir),
+                                 "--build-file", str(tmpdir / "lib" / "BUILD")], capture_output=True, text=True)
+        assert result.returncode == 2 and "--generator ninja converts every package" in result.stderr
+        assert not (tmpdir / "build.ninja").exists()
+
+
+def test_precompiled_headers_are_shared_between_targets():
+    """Test that heavy headers are precompiled once per set of flags and reused elsewhere"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        for package in ("a", "b", "base"):
+            (tmpdir / package).mkdir()
+        (tmpdir / "base" / "BUILD").write_text('cc_library(name = "base", srcs = ["base.cc"], hdrs = ["base.h"])\n')
+        (tmpdir / "a" / "BUILD").write_text('cc_binary(name = "a", srcs = ["a.cc"], deps = ["//base"])\n')
+        (tmpdir / "b" / "BUILD").write_text(textwrap.dedent("""
+            cc_test(name = "b", srcs = ["b.cc"], deps = ["//base"])
+            cc_test(name = "b_other", srcs = ["b.cc"], deps = ["//base"], local_defines = ["OTHER"])
+        """))
+
+        generator = CMakeGenerator(precompile_min_users=2)
+        converter = WorkspaceConverter(tmpdir, generator)
+        converter.convert()
+        assert generator.precompile_plan() == {
+            "//base:base": (("base/base.h",), None),
+            "//a:a": (("base/base.h",), "//base:base"),
+            "//b:b": (("base/base.h",), "//base:base"),
+            "//b:b_other": (("base/base.h",), None),
+        }, "Targets are grouped by flags and the builder is lowest in the graph"
+        reuse = 'cmake_language(DEFER DIRECTORY "${{PROJECT_SOURCE_DIR}}" CALL target_precompile_headers {} REUSE_FROM {})'
+        assert "target_precompile_headers(base_base PRIVATE\n    ${PROJECT_SOURCE_DIR}/base/base.h\n)" in \
+            (tmpdir / "base" / "CMakeLists.txt").read_text()
+        assert reuse.format("a_a", "base_base") in (tmpdir / "a" / "CMakeLists.txt").read_text()
+        b_text = (tmpdir / "b" / "CMakeLists.txt").read_text()
+        assert reuse.format("b_b", "base_base") in b_text and "target_precompile_headers(b_b_other PRIVATE" in b_text
+
+        # base no longer shares flags with its users, who now reuse the PCH of a
+        (tmpdir / "base" / "BUILD").write_text(
+            'cc_library(name = "base", srcs = ["base.cc"], hdrs = ["base.h"], copts = ["-O2"])\n')
+        written = converter.refresh([Path("base")])
+        assert tmpdir / "a" / "CMakeLists.txt" in written
+        assert "target_precompile_headers(a_a PRIVATE" in (tmpdir / "a" / "CMakeLists.txt").read_text()
+        assert reuse.format("b_b", "a_a") in (tmpdir / "b" / "CMakeLists.txt").read_text()
+
+        for value in ["0", "-2"]:
+            result = subprocess.run(["python3", "bazel_to_cmake.py", "--workspace-root", str(tmpdir),
+                                     "--precompile-min-users", value], capture_output=True, text=True)
+            assert result.returncode == 2 and "expected a positive integer" in result.stderr, value
+
+    cmake_text = convert('cc_library(name = "lib", srcs = ["lib.cc"], hdrs = ["lib.h"])',
+                         precompile_headers=["//:lib.h"]).cmake_text
+    assert "target_precompile_headers(lib PRIVATE\n    ${PROJECT_SOURCE_DIR}/lib.h\n)" in cmake_text
+
+
+def test_unity_build_groups_are_balanced_by_size():
+    """Test that unity groups have about equal source sizes and honor the opt-out list"""
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / "lib").mkdir()
+        sizes = {"a.cc": 40, "b.cc": 30, "c.cc": 20, "d.cc": 20, "e.cc": 10, "f.cc": 1, "g.cc": 50}
+        for name, kib in sizes.items():
+            (tmpdir / "lib" / name).write_text("x" * kib * 4096)
+        (tmpdir / "lib" / "BUILD").write_text(textwrap.dedent("""
+            cc_library(name = "lib", srcs = glob(["*.cc"]), hdrs = ["lib.h"])
+            cc_library(name = "solo", srcs = ["a.cc", "b.cc"])
+        """))
+
+        generator = CMakeGenerator(unity_build="group", unity_batch_size=3,
+                                   unity_exclude=["//lib:g.cc", "//lib:solo"])
+        WorkspaceConverter(tmpdir, generator).convert()
+        lib = generator.graph.targets["//lib:lib"]
+        assert generator.unity_groups(lib) == [["a.cc", "d.cc", "f.cc"], ["b.cc", "c.cc", "e.cc"]], \
+            "Largest files first into the smallest group"
+
+        cmake_content = (tmpdir / "lib" / "CMakeLists.txt").read_text()
+        for expected in [
+            "set_target_properties(lib_lib PROPERTIES\n    UNITY_BUILD ON\n    UNITY_BUILD_MODE GROUP\n)",
+            "set_source_files_properties(\n    a.cc\n    d.cc\n    f.cc\n    PROPERTIES UNITY_GROUP lib_lib_0\n)",
+            "set_source_files_properties(\n    g.cc\n    PROPERTIES SKIP_UNITY_BUILD_INCLUSION ON\n)",
+        ]:
+            assert expected in cmake_content, f"Missing {expected!r} in:\n{cmake_content}"
+        assert "set_target_properties(lib_solo" not in cmake_content
+
+    # Without file sizes, batches of a fixed size are used instead
+    cmake_text = convert('cc_library(name = "lib", srcs = ["a.cc", "b.cc", "c.cc"])', unity_build="group").cmake_text
+    assert "    UNITY_BUILD ON\n    UNITY_BUILD_BATCH_SIZE 8\n" in cmake_text
+
+
+def test_compiler_launcher_and_linker():
+    """Test that a compiler launcher and linker are used only when installed and not already set"""
+    cmake_text = convert('cc_binary(name = "app", srcs = ["app.cc"])',
+                         compiler_launcher="sccache", linker="lld").cmake_text
+
+    for expected in [
+        "find_program(SCCACHE_PROGRAM sccache)\nif(SCCACHE_PROGRAM AND NOT CMAKE_CXX_COMPILER_LAUNCHER)\n"
+        '    set(CMAKE_CXX_COMPILER_LAUNCHER "${SCCACHE_PROGRAM}")\nendif()',
+        "find_program(LLD_PROGRAM NAMES ld.lld lld)\nif(LLD_PROGRAM AND NOT CMAKE_LINKER_TYPE)",
+        "        set(CMAKE_LINKER_TYPE LLD)\n    elseif(NOT MSVC)\n        add_link_options(-fuse-ld=lld)",
+    ]:
+        assert expected in cmake_text, f"Missing {expected!r} in:\n{cmake_text}"
+    assert cmake_text.index("CMAKE_LINKER_TYPE") < cmake_text.index("add_executable(app"), \
+        "Settings must precede the targets they initialize"
+    assert "find_program" not in convert('cc_binary(name = "app", srcs = ["app.cc"])').cmake_text
+
+    with pytest.raises(ValueError, match="linker"):
+        CMakeGenerator(linker="gold")
+
+
+def test_job_pools_for_links_and_heavy_targets():
+    """Test that binaries and tests link in a bounded pool and heavy targets compile in another"""
+    build = textwrap.dedent("""
+        cc_library(name = "lib", srcs = ["lib.cc"], tags = ["heavy"])
+        cc_library(name = "light", srcs = ["light.cc"])
+        cc_binary(name = "app", srcs = ["app.cc"], deps = [":lib"])
+        cc_test(name = "app_test", srcs = ["app_test.cc"], deps = [":lib"])
+    """)
+    cmake_text = convert(build, link_pool_depth=4, heavy_pool_depth=2, heavy_targets=["//:app_test"]).cmake_text
+
+    for expected in [
+        "set_property(GLOBAL APPEND PROPERTY JOB_POOLS link_pool=4 heavy_compile_pool=2)\n",
+        "set_target_properties(lib PROPERTIES\n    JOB_POOL_COMPILE heavy_compile_pool\n)",
+        "set_target_properties(app PROPERTIES\n    JOB_POOL_LINK link_pool\n)",
+        "set_target_properties(app_test PROPERTIES\n    JOB_POOL_COMPILE heavy_compile_pool\n    JOB_POOL_LINK link_pool\n)",
+    ]:
+        assert expected in cmake_text, f"Missing {expected!r} in:\n{cmake_text}"
+    assert "set_target_properties(light" not in cmake_text
+    assert "JOB_POOL" not in convert(build).cmake_text
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        tmpdir = Path(tmpdir)
+        (tmpdir / "BUILD").write_text(build)
+        (tmpdir / "heavy.txt").write_text("# Known memory hogs\n//:app_test\n")
+        result = subprocess.run(
+            ["python3", "bazel_to_cmake.py", "--workspace-root", str(tmpdir), "--generator", "ninja",
+             "--link-pool-depth", "4", "--heavy-pool-depth", "2", "--heavy-targets", str(tmpdir / "heavy.txt")],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent
+        )
+        assert result.returncode == 0, result.stdout + result.stderr
+        ninja_text = (tmpdir / "build.ninja").read_text()
+        assert "pool link_pool\n  depth = 4\n" in ninja_text and "pool heavy_compile_pool\n  depth = 2\n" in ninja_text
+        assert "build $builddir/app_test: link $builddir/_objs/app_test/app_test.cc.o $builddir/liblib.a\n" \
+               "  pool = link_pool\n" in ninja_text
+        assert "build $builddir/_objs/app_test/app_test.cc.o: cxx app_test.cc\n  flags = $flags_3\n" \
+               "  pool = heavy_compile_pool\n" in ninja_text
+        assert "light.cc\n  flags = $flags_1\nbuild $builddir/liblight.a" in ninja_text
+
+        for flag in ["--link-pool-depth", "--heavy-pool-depth"]:
+            result = subprocess.run(["python3", "bazel_to_cmake.py", "--workspace-root", str(tmpdir), flag, "-1"],
+                                    capture_output=True, text=True, cwd=Path(__file__).parent)
+            assert result.returncode == 2 and "expected a non-negative integer" in result.stderr, flag
+
+
+def test_ctest_properties_from_test_attributes():
+    """Test that size, timeout, tags, flaky and shard_count become CTest scheduling metadata"""
+    result = convert(textwrap.dedent("""
+        cc_test(name = "unit", srcs = ["unit.cc"], size = "small", tags = ["fast", "exclusive"])
+        cc_test(name = "slow", srcs = ["slow.cc"], size = "small", timeout = "long", flaky = True)
+        cc_test(name = "big", srcs = ["big.cc"], shard_count = 2)
+        cc_test(name = "plain", srcs = ["plain.cc"])
+    """))
+    cmake_text = result.cmake_text
+
+    for expected in [
+        'set_tests_properties(unit PROPERTIES\n    TIMEOUT 60\n    LABELS "fast;exclusive"\n    RUN_SERIAL TRUE\n)',
+        "add_test(NAME slow COMMAND ${CMAKE_COMMAND} -DTEST_COMMAND=$<TARGET_FILE:slow> -DATTEMPTS=3 "
+        "-P ${CMAKE_CURRENT_BINARY_DIR}/run_flaky_test.cmake)\n"
+        "set_tests_properties(slow PROPERTIES\n    TIMEOUT 2700\n)",
+        "file(CONFIGURE OUTPUT ${CMAKE_CURRENT_BINARY_DIR}/run_flaky_test.cmake @ONLY CONTENT [=[",
+        "add_test(NAME big_shard_1_of_2 COMMAND big)\nset_tests_properties(big_shard_1_of_2 PROPERTIES\n"
+        '    TIMEOUT 300\n    ENVIRONMENT "GTEST_TOTAL_SHARDS=2;GTEST_SHARD_INDEX=0"\n)',
+        'add_test(NAME big_shard_2_of_2 COMMAND big)\nset_tests_properties(big_shard_2_of_2 PROPERTIES\n'
+        '    TIMEOUT 300\n    ENVIRONMENT "GTEST_TOTAL_SHARDS=2;GTEST_SHARD_INDEX=1"\n)',
+        # Tests without a size are medium, as in Bazel
+        "add_test(NAME plain COMMAND plain)\nset_tests_properties(plain PROPERTIES\n    TIMEOUT 300\n)",
+    ]:
+        assert expected in cmake_text, f"Missing {expected!r} in:\n{cmake_text}"
+    assert "add_test(NAME big COMMAND" not in cmake_text
+
+    slow = result.targets[1]
+    assert (slow.size, slow.timeout, slow.flaky, slow.shard_count) == ("small", "long", True, None)
+    assert BazelTarget.from_dict(json.loads(json.dumps(slow.to_dict()))).to_dict() == slow.to_dict()
+    assert "run_flaky_test" not in convert('cc_test(name = "t", srcs = ["t.cc"])').cmake_text
+
+
+def test_gtest_discover_tests_for_googletest_tests():
+    """Test that --gtest-discover-tests registers GoogleTest cases when ctest runs"""
+    build = textwrap.dedent("""
+        cc_test(name = "unit", srcs = ["unit.cc"], deps = ["@com_google_googletest//:gtest_main"],
+                size = "small", tags = ["fast", "exclusive"])
+        cc_test(name = "retry", srcs = ["retry.cc"], deps = ["@com_google_googletest//:gtest_main"], flaky = True)
+        cc_test(name = "plain", srcs = ["plain.cc"])
+    """)
+    cmake_text = convert(build, gtest_discover_tests=True).cmake_text
+
+    for expected in [
+        "include(GoogleTest)",
+        "gtest_discover_tests(unit\n    DISCOVERY_MODE PRE_TEST\n    TEST_PREFIX unit.\n)",
+        'file(CONFIGURE OUTPUT "${CMAKE_CURRENT_BINARY_DIR}/unit_test_properties.cmake" @ONLY CONTENT [=[\n'
+        'if(unit_TESTS)\n    set_tests_properties(${unit_TESTS} PROPERTIES\n'
+        '        TIMEOUT 60\n        LABELS "fast;exclusive"\n        RUN_SERIAL TRUE\n    )\nendif()\n]=])',
+        'set_property(DIRECTORY APPEND PROPERTY TEST_INCLUDE_FILES '
+        '"${CMAKE_CURRENT_BINARY_DIR}/unit_test_properties.cmake")',
+        # Discovered tests cannot be retried, so flaky tests keep add_test()
+        "add_test(NAME retry COMMAND ${CMAKE_COMMAND} -DTEST_COMMAND=$<TARGET_FILE:retry>",
+        "add_test(NAME plain COMMAND plain)",
+    ]:
+        assert expected in cmake_text, f"Missing {expected!r} in:\n{cmake_text}"
+    assert "add_test(NAME unit" not in cmake_text
+
+    default_text = convert(build).cmake_text
+    assert "include(GoogleTest)" not in default_text and "add_test(NAME unit COMMAND unit)" in default_text